@@ -4,28 +4,49 @@
 """
 
 # %% Import needed python libraryies and project config info
+import re
 import time
 import winsound
 import numpy as np
 import pandas as pd
+import pyarrow.compute as pc
 import rarfile
 import multiprocessing as mp
 
 from fuzzywuzzy import fuzz  # for fuzzy matching scorer
+from functools import lru_cache
 from functools import partial
 from string import printable
 
 from pathlib import Path
 from IPython.display import display
 from pprint import pprint
+from sklearn.neighbors import BallTree
 
 from mgbol.utils import timing
+from mgbol.utils import diagnostics
+from mgbol.utils import calc_haversine_km
+from mgbol.utils import EARTH_RADIUS_KM
 from mgbol.utils import drop_duplicated
-from mgbol.utils import outliers_get_quantiles
+from mgbol.utils import factorize_rows
+from mgbol.utils import dates_get_years
+from mgbol.utils import dates_replace_years
+from mgbol.utils import dates_diff_days
+from mgbol.utils import outliers_get_caps
+from mgbol.utils import outliers_get_group_caps
 from mgbol.utils_special import do_fuzzy_matching
 from mgbol.utils_special import do_parallel_works_with_list
+from mgbol.utils_special import transform_on_uniques
+from mgbol.utils_special import split_listed_items
+from mgbol.utils_special import encode_container_id_lists
 from mgbol.utils_special import preprocess_column_to_group
 from mgbol.utils_special import do_ngram_grouping
+from mgbol.utils_special import do_ngram_cascade_grouping
+from mgbol.utils_special import do_blocked_grouping
+from mgbol.utils_special import restore_long_words
+from mgbol.utils_special import EntityRegistry
+from mgbol.utils_special import EntityMappingStore
+from mgbol.utils_special import AddressCanonicalizer
 
 
 # ------------------------------------------------------------------------------
@@ -39,6 +60,36 @@ def valid_int(x):
         return False
 
 
+# The transforms of the single values for the handle_* functions.
+# They are applied over the unique values only w/ the transform_on_uniques()
+# The HTML tags w/ the whitespaces around them
+RE_HTML_TAGS = re.compile(r"\s*<[^>]*>\s*")
+
+
+class _PrintableTable(dict):
+    """Translate table keeping the printable symbols only: the other symbols
+    are deleted & cached on the first lookup, so str.translate() does the
+    filtering in C instead of the per-symbol membership test"""
+
+    def __init__(self):
+        super().__init__((ord(x), ord(x)) for x in printable)
+
+    def __missing__(self, key):
+        self[key] = None
+        return None
+
+
+PRINTABLE_TABLE = _PrintableTable()
+
+
+def clean_description(value):
+    """Remove unprintable symbols, strip the HTML tags and join unique parts
+    in order of appearance"""
+    value = value.translate(PRINTABLE_TABLE)
+    value = "; ".join(dict.fromkeys(filter(None, RE_HTML_TAGS.split(value))))
+    return np.nan if value == "N/A" else value
+
+
 # ------------------------------------------------------------------------------
 # --------------- L O A D I N G   &   S A V I N G    S T U F F -----------------
 # ------------------------------------------------------------------------------
@@ -166,212 +217,128 @@ def read_xport_us_rar_data(
 # ------------------------------------------------------------------------------
 
 
-def handle_actual_arrival_date(
-    df,
-    col_ade="arrival_date_estimate",
-    col_ada="arrival_date_actual",
-    col_report_month="report_month",
-):
-    """Find out the rows where the year of actual arrival date
-    significantly differs from the year of report. And replace them.
+def repair_arrival_dates(ada, ade, report_years, gap_year=360, gap=300):
+    """Repair the years of the actual & estimated arrival dates w/ all rules
+    in one pass over the datetime64 arrays. The years are replaced
+    arithmetically and the delays are updated for the repaired rows only.
+    The rules are applied in order:
+        'ada_year': the year of the actual date is far from the year of report:
+            take the year of the estimated date
+        'ade_year': the year of the estimated date is far from the year
+            of report: take the year of the actual date
+        'new_year_early', 'new_year_late': the dates passed through
+            the New Year: shift the estimated date 1 year down or up
+        'late', 'early': the super later or earlier arrival:
+            shift the estimated date 1 year up or down
 
     Args:
-        df (Pandas DataFrame): Dataframe w/ the estimated and actual date
-        col_ada (str): column's name w/ actual arrival dates
-        return_delay (bool): Either return the 'delay' column in DF
+        ada (np.array): datetime64 actual arrival dates
+        ade (np.array): datetime64 estimated arrival dates
+        report_years (np.array): years of the reports, NaN for unknown
+        gap_year (int, optional): delay in days for the year rules.
+            Defaults to 360.
+        gap (int, optional): delay in days for the other rules. Defaults to 300.
     Returns:
-        Pandas DataFrame : Data combined into one DF
+        tuple : repaired (ada, ade), delays in days (float64, NaN for NaT)
+            and pd.Series w/ # of the records repaired by each rule
     """
-    print(f"\nHandle the Actual Arrival Date .................................")
-    tic = time.time()
-
-    # * Handle the YEAR in the Actual Arrival Date
-    mask_a = (abs(df[col_ada].dt.year - df[col_report_month].dt.year) > 1) & (
-        abs(df[col_ada] - df[col_ade]).dt.days > 360
-    )
-    # View before processing
-    print(f"Records w/ mistakes in the 'year' in actual arrival date:")
-    print(f"\t# {sum(mask_a):,} ...")
-    print(f"\t% {sum(mask_a)/len(df) * 100} ...")
-    # Calc average delay
-    avg = (df[mask_a][col_ada] - df[mask_a][col_ade]).dt.days.mean()
-    print(f"Examples: Before: avg.delay = {avg} days.")
-    display(df.loc[mask_a, [col_ada, col_ade, col_report_month]])
-    # Replace YEAR in Actual with the YEAR of Estimated
-    # TODO: Find more quikly way to replace year
-    df[col_ada] = df[col_ada].mask(
-        mask_a,
-        pd.to_datetime(
-            df[col_ade].dt.year.astype("str") + df[col_ada].dt.strftime("%m%d"),
-            format="%Y%m%d",
-        ),
-    )
-    # View results
-    avg = (df[mask_a][col_ada] - df[mask_a][col_ade]).dt.days.mean()
-    print(f"Examples: After processing: avg.delay = {avg} days.")
-    display(df.loc[mask_a, [col_ada, col_ade, col_report_month]])
-
-    # * Handle the YEAR in the Estimate Arrival Date
-    mask_e = (abs(df[col_ade].dt.year - df[col_report_month].dt.year) > 1) & (
-        abs(df[col_ada] - df[col_ade]).dt.days > 360
+    # Keep the unit of the dates, e.g. the 'us' of pandas: the 'ns' overflows
+    # beyond the year 2262 and the columns would change their unit
+    dtype = np.result_type(np.asarray(ada).dtype, np.asarray(ade).dtype)
+    ada = np.array(ada, dtype=dtype)
+    ade = np.array(ade, dtype=dtype)
+    report_years = np.asarray(report_years, dtype=float)
+    delay = dates_diff_days(ada, ade)
+    counts = {}
+
+    def _replace_years(dates, mask, years):
+        dates[mask] = dates_replace_years(dates[mask], years)
+        delay[mask] = dates_diff_days(ada[mask], ade[mask])
+        return int(mask.sum())
+
+    # The NaT has NaN delay, so the masks are False for it
+    mask = (abs(dates_get_years(ada) - report_years) > 1) & (abs(delay) > gap_year)
+    counts["ada_year"] = _replace_years(ada, mask, dates_get_years(ade[mask]))
+
+    mask = (abs(dates_get_years(ade) - report_years) > 1) & (abs(delay) > gap_year)
+    counts["ade_year"] = _replace_years(ade, mask, dates_get_years(ada[mask]))
+
+    # Both the New Year masks are taken before the shifts
+    months_ada = ada.astype("M8[M]").astype(np.int64) % 12 + 1
+    months_ade = ade.astype("M8[M]").astype(np.int64) % 12 + 1
+    new_year = np.isin(months_ada, [1, 2, 3]) | np.isin(months_ade, [1, 2])
+    mask_early = new_year & (delay < -gap)
+    mask_late = new_year & (delay > gap)
+    counts["new_year_early"] = _replace_years(
+        ade, mask_early, dates_get_years(ade[mask_early]) - 1
     )
-    # View before processing
-    print(f"Records w/ mistakes in the 'year' in estimate arrival date:")
-    print(f"\t# {sum(mask_e):,} ...")
-    print(f"\t% {sum(mask_e)/len(df) * 100} ...")
-    # Calc average delay
-    avg = (df[mask_e][col_ada] - df[mask_e][col_ade]).dt.days.mean()
-    print(f"Examples: Before: avg.delay = {avg} days.")
-    display(df.loc[mask_e, [col_ada, col_ade, col_report_month]])
-    # Replace YEAR in Actual with the YEAR of Estimated
-    # TODO: Find more quikly way to replace year
-    df[col_ade] = df[col_ade].mask(
-        mask_e,
-        pd.to_datetime(
-            df[col_ada].dt.year.astype("str") + df[col_ade].dt.strftime("%m%d"),
-            format="%Y%m%d",
-        ),
+    counts["new_year_late"] = _replace_years(
+        ade, mask_late, dates_get_years(ade[mask_late]) + 1
     )
-    # View results
-    avg = (df[mask_e][col_ada] - df[mask_e][col_ade]).dt.days.mean()
-    print(f"Examples: After processing: avg.delay = {avg} days.")
-    display(df.loc[mask_e, [col_ada, col_ade, col_report_month]])
 
-    winsound.Beep(frequency=2000, duration=200)
-    print(f"Handled the Actual Arrival Date {timing(tic)}")
+    mask = delay > gap
+    counts["late"] = _replace_years(ade, mask, dates_get_years(ade[mask]) + 1)
 
-    return df
+    mask = delay < -gap
+    counts["early"] = _replace_years(ade, mask, dates_get_years(ade[mask]) - 1)
 
+    return ada, ade, delay, pd.Series(counts, name="records")
 
-def handle_estimated_arrival_date(
+
+def handle_arrival_dates(
     df,
     col_ade="arrival_date_estimate",
     col_ada="arrival_date_actual",
+    col_report_month="report_month",
     col_delay_name="arrival_date_delay",
+    gap=300,
     return_delay=True,
 ):
-    """Find out the rows where the difference between
-    Estimated Arrival Date and Actual Arrival Date is more then 360 days and
-    replace the year in the 'estimated arrival' with year from the 'actual'.
+    """Repair the mistakes in the years of the estimated and actual arrival
+    dates and calculate the delays, see repair_arrival_dates() for the rules.
 
     Args:
         df (Pandas DataFrame): Dataframe w/ the estimated and actual date
         col_ade (str): column's name w/ estimated arrival dates
         col_ada (str): column's name w/ actual arrival dates
+        col_report_month (str): column's name w/ month of BoL report
+        col_delay_name (str): column's name for the delays in days
+        gap (int): delay in days of the super later or earlier arrival
         return_delay (bool): Either return the 'delay' column in DF
     Returns:
-        Pandas DataFrame : Data combined into one DF
+        Pandas DataFrame : DF w/ the arrival dates repaired
     """
-    # col_ade = "estimate_arrival_date"
-    # col_ada = "actual_arrival_date"
-    print(f"\nHandle the Estimated Arrival Date ..............................")
+    print(f"\nHandle the Arrival Dates .......................................")
     tic = time.time()
 
-    # Calculate the delays
-    df[col_delay_name] = (df[col_ada] - df[col_ade]).dt.days
+    ada, ade, delay, counts = repair_arrival_dates(
+        df[col_ada].to_numpy(),
+        df[col_ade].to_numpy(),
+        df[col_report_month].dt.year.astype(float).to_numpy(),
+        gap=gap,
+    )
+    diagnostics.count("arrival_dates", **counts)
 
-    print(f"Handle the number-of-year mistakes ...............................")
-    gap = 300
+    def _get_repaired_rows():
+        def _changed(a, b):
+            # The NaT != NaT, so the NaT in both is not a change
+            return (a != b) & ~(np.isnat(a) & np.isnat(b))
 
-    # * Handle the records w/ dates passed through the New Year
-    mask_ny_pos = (df[col_delay_name] > gap) & (
-        (df[col_ada].dt.month == 1)
-        | (df[col_ada].dt.month == 2)
-        | (df[col_ada].dt.month == 3)
-        | (df[col_ade].dt.month == 1)
-        | (df[col_ade].dt.month == 2)
-    )
-    mask_ny_neg = (df[col_delay_name] < -gap) & (
-        (df[col_ada].dt.month == 1)
-        | (df[col_ada].dt.month == 2)
-        | (df[col_ada].dt.month == 3)
-        | (df[col_ade].dt.month == 1)
-        | (df[col_ade].dt.month == 2)
-    )
-    print(f"Records w/ the dates passed through the New Year:")
-    print(f"\t# {sum(mask_ny_pos) + sum(mask_ny_neg):,} ...")
-    print(f"\t% {(sum(mask_ny_pos) + sum(mask_ny_neg))/len(df) * 100} ...")
-    avg = df.loc[(mask_ny_pos | mask_ny_neg), col_delay_name].mean()
-    print(f"Examples: Before: avg.delay = {avg} days.")
-    display(df.loc[(mask_ny_pos | mask_ny_neg), [col_ada, col_ade, col_delay_name]])
-    # Shift 1 YEAR to DOWN for Estimated Date for super EARLIER arrival
-    df[col_ade] = df[col_ade].mask(
-        mask_ny_neg,
-        pd.to_datetime(
-            df[col_ade] + pd.offsets.DateOffset(years=-1),
-            format="%Y%m%d",
-        ),
-    )
-    # Shift 1 YEAR to UP for Estimated Date for super LATER arrival
-    df[col_ade] = df[col_ade].mask(
-        mask_ny_pos,
-        pd.to_datetime(
-            df[col_ade] + pd.offsets.DateOffset(years=1),
-            format="%Y%m%d",
-        ),
-    )
-    # ReCalculate the delays
-    df[col_delay_name] = (df[col_ada] - df[col_ade]).dt.days
-    # View results
-    avg = df.loc[(mask_ny_pos | mask_ny_neg), col_delay_name].mean()
-    print(f"Examples: After processing: avg.delay = {avg} days.")
-    display(df.loc[(mask_ny_pos | mask_ny_neg), [col_ada, col_ade, col_delay_name]])
-
-    # * Handle the records w/ super later arrival
-    mask_pos = df[col_delay_name] > gap
-    # View before processing
-    print(f"Records w/ the super LATER arrival. Days' gap > {gap} days:")
-    print(f"\t# {sum(mask_pos):,} ...")
-    print(f"\t% {sum(mask_pos)/len(df) * 100} ...")
-    # Calc average delay
-    avg = df.loc[mask_pos, col_delay_name].mean()
-    print(f"Examples: Before: avg.delay = {avg} days.")
-    display(df.loc[mask_pos, [col_ada, col_ade, col_delay_name]])
-    # Shift 1 YEAR to UP for Estimated Date for super LATER arrival
-    df[col_ade] = df[col_ade].mask(
-        mask_pos,
-        pd.to_datetime(
-            df[col_ade] + pd.offsets.DateOffset(years=1),
-            format="%Y%m%d",
-        ),
-    )
-    # ReCalculate the delays
-    df[col_delay_name] = (df[col_ada] - df[col_ade]).dt.days
-    # View results
-    avg = df.loc[mask_pos, col_delay_name].mean()
-    print(f"Examples: After processing: avg.delay = {avg} days.")
-    display(df.loc[mask_pos, [col_ada, col_ade, col_delay_name]])
-
-    # * Handle the records w/ super later arrival
-    mask_neg = df[col_delay_name] < -gap
-    # View before processing
-    print(f"Records w/ the super EARLIER arrival. Days' gap > -{gap} days:")
-    print(f"\t# {sum(mask_neg):,} ...")
-    print(f"\t% {sum(mask_neg)/len(df) * 100} ...")
-    # Calc average delay
-    avg = df.loc[mask_neg, col_delay_name].mean()
-    print(f"Examples: Before: avg.delay = {avg} days.")
-    display(df.loc[mask_neg, [col_ada, col_ade, col_delay_name]])
-    # Shift 1 YEAR to DOWN for Estimated Date for super EARLIER arrival
-    df[col_ade] = df[col_ade].mask(
-        mask_neg,
-        pd.to_datetime(
-            df[col_ade] + pd.offsets.DateOffset(years=-1),
-            format="%Y%m%d",
-        ),
-    )
-    # ReCalculate the delays
-    df[col_delay_name] = (df[col_ada] - df[col_ade]).dt.days
-    # View results
-    avg = df.loc[mask_neg, col_delay_name].mean()
-    print(f"Examples: After processing: avg.delay = {avg} days.")
-    display(df.loc[mask_neg, [col_ada, col_ade, col_delay_name]])
+        mask = _changed(df[col_ada].to_numpy(), ada) | _changed(df[col_ade].to_numpy(), ade)
+        return df.loc[mask, [col_ada, col_ade, col_report_month]].assign(
+            **{f"{col_ada}_repaired": ada[mask], f"{col_ade}_repaired": ade[mask]}
+        )
+
+    diagnostics.sample("arrival_dates", _get_repaired_rows)
 
-    if not return_delay:
-        df.drop(columns=[col_delay_name])
+    df[col_ada] = ada
+    df[col_ade] = ade
+    if return_delay:
+        has_nat = np.isnan(delay).any()
+        df[col_delay_name] = delay if has_nat else delay.astype(np.int64)
 
     winsound.Beep(frequency=2000, duration=200)
-    print(f"Handled the Estimated Arrival Date {timing(tic)}")
+    print(f"Handled the Arrival Dates {timing(tic)}")
 
     return df
 
@@ -424,20 +391,9 @@ def handle_vessels(
         inplace=True,
     )
 
-    num_vn_records_na = sum(df["vessel_name_bol"].isna())
-    num_vn_records = sum(df["vessel_name_bol"].notna())
-    num_vn_unique = len(df["vessel_name_bol"].dropna().unique())
     print(f"\nTotal records: # {len(df):,} records")
-    print(f"\tVessels Names N/A records: # {num_vn_records_na:,}")
-    print(f"\tVessels Names records: # {num_vn_records:,}")
-    print(f"\tVessels Names uniques: # {num_vn_unique:,}")
-
-    num_imo_records_na = sum(df["vessel_imo_bol"].isna())
-    num_imo_records = sum(df["vessel_imo_bol"].notna())
-    num_imo_unique = len(df["vessel_imo_bol"].dropna().unique())
-    print(f"\n\tVessels IMO N/A records: # {num_imo_records_na:,}")
-    print(f"\tVessels IMO records: # {num_imo_records:,}")
-    print(f"\tVessels IMO uniques: # {num_imo_unique:,}")
+    diagnostics.count_values("vessels", df["vessel_name_bol"])
+    diagnostics.count_values("vessels", df["vessel_imo_bol"])
 
     # df[df["vessel_name_bol"].str.contains("\d{7}", na=False, regex=True)]
 
@@ -480,25 +436,18 @@ def handle_vessels(
     df["vessel_match_score"] = [100 if isinstance(x, str) else 0 for x in df["vessel_name"]]
 
     # Print results
-    matched_imo_records = len(df[df["vessel_imo_bol"].notna() & df["vessel_imo"].notna()])
-    notmatched_imo_records = len(df[df["vessel_imo_bol"].notna() & df["vessel_imo"].isna()])
-
-    matched_imo_unique = len(
-        df[df["vessel_imo_bol"].notna() & df["vessel_name"].notna()]["vessel_imo_bol"].unique()
-    )
-    notmatched_imo_unique = len(
-        df[df["vessel_imo_bol"].notna() & df["vessel_name"].isna()]["vessel_imo_bol"].unique()
-    )
-
-    prc_records = round(100 * matched_imo_records / num_imo_records, 2)
-    prc_unique = round(100 * matched_imo_unique / num_imo_unique, 2)
-
-    print(f"Vessels Names records (imo-like): # {num_imo_records:,}")
-    print(f"\t# {matched_imo_records:,} got IMOs - % {prc_records}")
-    print(f"\t# {notmatched_imo_records:,} w/o IMOs")
-    print(f"Vessels Names unique (imo-like): # {num_imo_unique:,}")
-    print(f"\t# {matched_imo_unique:,} got IMOs - % {prc_unique}")
-    print(f"\t# {notmatched_imo_unique:,} w/o IMOs")
+    if diagnostics.counters:
+        has_imo_bol = df["vessel_imo_bol"].notna().to_numpy()
+        has_imo = df["vessel_imo"].notna().to_numpy()
+        has_name = df["vessel_name"].notna().to_numpy()
+        imos_bol = df["vessel_imo_bol"]
+        diagnostics.count(
+            "vessels",
+            imo_bol_matched_records=(has_imo_bol & has_imo).sum(),
+            imo_bol_notmatched_records=(has_imo_bol & ~has_imo).sum(),
+            imo_bol_matched_uniques=lambda: imos_bol[has_imo_bol & has_name].nunique(),
+            imo_bol_notmatched_uniques=lambda: imos_bol[has_imo_bol & ~has_name].nunique(),
+        )
 
     # Get results
     list_notmatched_bol = (
@@ -643,19 +592,18 @@ def handle_vessels(
     df["vessel_name"] = df["vessel_name"].str.upper()
 
     # Get final results
-    not_matched_records = sum(df["vessel_imo"].isna())
-    not_matched_unique = len(df[df["vessel_imo"].isna()]["vessel_name_bol"].unique())
-    matched_records = sum(df["vessel_imo"].notna())
-    matched_unique = len(df[df["vessel_imo"].notna()]["vessel_name_bol"].unique())
-    prc_records = round(100 * matched_records / num_vn_records, 2)
-    prc_unique = round(100 * matched_unique / num_vn_unique, 2)
-
     print(f"\nFinally total records: # {len(df):,}")
-    print(f"\t# {matched_records:,} got IMOs - % {prc_records}")
-    print(f"\t# {not_matched_records:,} w/o IMOs")
-    print(f"\nFinally unique vessels names in BoL: # {num_vn_unique:,}")
-    print(f"\t# {matched_unique:,} got IMOs - % {prc_unique}")
-    print(f"\t# {not_matched_unique:,} w/o IMOs")
+    if diagnostics.counters:
+        has_imo = df["vessel_imo"].notna().to_numpy()
+        names_bol = df["vessel_name_bol"]
+        diagnostics.count(
+            "vessels",
+            matched_records=has_imo.sum(),
+            notmatched_records=(~has_imo).sum(),
+            matched_uniques=lambda: names_bol[has_imo].nunique(),
+            notmatched_uniques=lambda: names_bol[~has_imo].nunique(),
+        )
+        diagnostics.sample("vessels", lambda: df.loc[~has_imo, ["vessel_name_bol"]])
 
     if not return_match_score:
         df.drop(columns=["vessel_match_score"], inplace=True)
@@ -670,60 +618,398 @@ def handle_vessels(
             inplace=True,
         )
 
-    df = df[sorted(df.columns)]
     winsound.Beep(frequency=2000, duration=200)
     print(f"Handled the Vessels {timing(tic_main)}")
 
     return df
 
 
-def handle_ports(
-    df,
+def _file_version(path):
+    """Version of the data file: its modification time and size"""
+    stat = Path(path).stat()
+    return stat.st_mtime_ns, stat.st_size
+
+
+@lru_cache(maxsize=4)
+def _read_port_data(
     path_to_port_data,
-    port_data_col_code="Port Code",
-    port_data_cols_join=["lat", "lon", "country", "continent"],
-    port_to_handle="port_of_lading",
+    port_data_version,
+    port_data_col_code,
+    port_data_cols_join,
 ):
-    print(f"\nHandle the {port_to_handle.upper()}.............................")
-    tic_main = time.time()
-    col_code = f"{port_to_handle}_code"
-
+    """Read the Port data once per file version.
+    The 'port_data_version' is not used inside but makes the cache key.
+    """
     print(f"Get the Port data ................................................")
     df_pt = pd.read_csv(
         path_to_port_data,
-        usecols=[port_data_col_code] + port_data_cols_join,
+        usecols=[port_data_col_code] + list(port_data_cols_join),
         dtype={port_data_col_code: "str"},
     )
-    df_pt.rename(
-        columns=dict(
-            zip(
-                [port_data_col_code] + port_data_cols_join,
-                [col_code] + [port_to_handle + "_" + i for i in port_data_cols_join],
-            )
-        ),
-        inplace=True,
-    )
     # TODO: Normalize the Port data? pandas.Series.str.normalize
     # Clear Port data from the cases when port' name has several codes
     df_pt = (
-        df_pt.sort_values([col_code], na_position="last")
-        .groupby([col_code], as_index=False)
+        df_pt.sort_values([port_data_col_code], na_position="last")
+        .groupby([port_data_col_code])
         .first()
     )
-    # df_pt.info()
+    return df_pt
 
-    print(f"Make merging for Port Codes ......................................")
-    df = pd.merge(
-        df,
-        df_pt,
-        how="left",
-        left_on=col_code,
-        right_on=col_code,
+
+def get_port_data(
+    path_to_port_data,
+    port_data_col_code="Port Code",
+    port_data_cols_join=["lat", "lon", "country", "continent"],
+):
+    """Get the Port data indexed by the unique port codes.
+    The data is read once and memoized till the file will be changed.
+
+    Args:
+        path_to_port_data (str or Path): Path to CSV file w/ Port data
+        port_data_col_code (str): column's name w/ port codes
+        port_data_cols_join (list of str): columns' names w/ port attributes
+    Returns:
+        Pandas DataFrame : Port data. Do not modify it in place, it is shared.
+    """
+    return _read_port_data(
+        str(path_to_port_data),
+        _file_version(path_to_port_data),
+        port_data_col_code,
+        tuple(port_data_cols_join),
     )
 
-    df = df[sorted(df.columns)]
+
+class PortGeoIndex:
+    """Ball tree over the ports' lat/lon on the unit sphere (haversine metric).
+    Answers the batched nearest-port and ports-within-radius queries
+    and resolves the ports by their names w/ the proximity check.
+
+    Args:
+        df_pt (Pandas DataFrame): Port data indexed by the port codes
+        col_lat (str): column's name w/ latitude in degrees
+        col_lon (str): column's name w/ longitude in degrees
+        col_name (str or None): column's name w/ port names
+    """
+
+    def __init__(self, df_pt, col_lat="lat", col_lon="lon", col_name=None):
+        df_pt = df_pt.dropna(subset=[col_lat, col_lon])
+        self.codes = df_pt.index.to_numpy()
+        self.lat = df_pt[col_lat].to_numpy(dtype=float)
+        self.lon = df_pt[col_lon].to_numpy(dtype=float)
+        self.tree = BallTree(
+            np.radians(np.column_stack([self.lat, self.lon])),
+            metric="haversine",
+        )
+        # Positions of the ports for each normalized name
+        self.names_idxs = {}
+        if col_name is not None:
+            names = self.normalize_names(df_pt[col_name])
+            self.names_idxs = (
+                pd.Series(np.arange(len(names))).groupby(names.to_numpy()).indices
+            )
+
+    @staticmethod
+    def normalize_names(names):
+        return (
+            pd.Series(names, dtype=object)
+            .str.upper()
+            .str.replace(r"[^\w\s]+", " ", regex=True)
+            .str.replace(r"\s+", " ", regex=True)
+            .str.strip()
+        )
+
+    def _to_radians(self, lat, lon):
+        return np.radians(np.column_stack([np.atleast_1d(lat), np.atleast_1d(lon)]).astype(float))
+
+    def query_nearest(self, lat, lon, k=1):
+        """Get the k nearest ports for each point.
+
+        Returns:
+            tuple of numpy arrays : (codes, distances in km) of shape (n_points, k)
+        """
+        dist, idxs = self.tree.query(self._to_radians(lat, lon), k=k)
+        return self.codes[idxs], dist * EARTH_RADIUS_KM
+
+    def query_radius(self, lat, lon, radius_km):
+        """Get the ports within the radius for each point, the nearest first.
+
+        Returns:
+            tuple of lists : (codes, distances in km) arrays for each point
+        """
+        idxs, dist = self.tree.query_radius(
+            self._to_radians(lat, lon),
+            r=radius_km / EARTH_RADIUS_KM,
+            return_distance=True,
+            sort_results=True,
+        )
+        return [self.codes[i] for i in idxs], [d * EARTH_RADIUS_KM for d in dist]
+
+    def resolve_by_name(self, names, max_km=50, anchors=None):
+        """Get the port code for each name by the name plus the proximity.
+        The name w/ the anchor point (e.g. where the rows w/ the same name
+        and the known codes are) gets the nearest port within 'max_km'
+        from the anchor w/ the batched radius query: of the same name
+        if any, otherwise the nearest one.
+        For the other names, when several ports have the same name, the one
+        nearest to their centre is taken if all of them lie within 'max_km'
+        from it, i.e. they are the same place, otherwise the name stays
+        unresolved.
+
+        Args:
+            names (array-like): ports' names
+            max_km (int): max distance to the anchor or between the ports
+            anchors (Pandas DataFrame or None): ['lat', 'lon'] indexed
+                by the normalized names, see normalize_names()
+        Returns:
+            numpy array : ports' codes or NaN for the unresolved names
+        """
+        names = self.normalize_names(names)
+        uniques = names.dropna().unique()
+        resolved = {}
+
+        if anchors is not None:
+            anchors = anchors.dropna(subset=["lat", "lon"])
+            anchors = anchors[anchors.index.isin(uniques)]
+        if anchors is not None and len(anchors) > 0:
+            codes, _ = self.query_radius(anchors["lat"], anchors["lon"], max_km)
+            for name, codes_near in zip(anchors.index, codes):
+                if len(codes_near) == 0:
+                    continue
+                codes_named = self.codes[self.names_idxs.get(name, [])]
+                is_named = np.isin(codes_near, codes_named)
+                # The codes are sorted by the distance: take the nearest
+                resolved[name] = codes_near[is_named][0] if is_named.any() else codes_near[0]
+
+        for name in uniques:
+            if name in resolved:
+                continue
+            idxs = self.names_idxs.get(name)
+            if idxs is None:
+                continue
+            if len(idxs) > 1:
+                # Centre of the candidates through the mean of the unit vectors
+                lat, lon = np.radians(self.lat[idxs]), np.radians(self.lon[idxs])
+                x = (np.cos(lat) * np.cos(lon)).mean()
+                y = (np.cos(lat) * np.sin(lon)).mean()
+                z = np.sin(lat).mean()
+                lat_c = np.degrees(np.arctan2(z, np.hypot(x, y)))
+                lon_c = np.degrees(np.arctan2(y, x))
+                dist = calc_haversine_km(self.lat[idxs], self.lon[idxs], lat_c, lon_c)
+                if dist.max() > max_km:
+                    continue
+                idxs = idxs[[dist.argmin()]]
+            resolved[name] = self.codes[idxs[0]]
+
+        return names.map(resolved).to_numpy(dtype=object)
+
+
+@lru_cache(maxsize=4)
+def _build_port_geo_index(
+    path_to_port_data,
+    port_data_version,
+    port_data_col_code,
+    port_data_cols_join,
+    port_data_col_name,
+):
+    df_pt = _read_port_data(
+        path_to_port_data,
+        port_data_version,
+        port_data_col_code,
+        port_data_cols_join,
+    )
+    return PortGeoIndex(df_pt, col_name=port_data_col_name)
+
+
+def get_port_geo_index(
+    path_to_port_data,
+    port_data_col_code="Port Code",
+    port_data_cols_join=["lat", "lon", "port_name"],
+    port_data_col_name="port_name",
+):
+    """Get the PortGeoIndex built once per Port data file version.
+    The 'port_data_cols_join' have to contain 'lat', 'lon' & 'port_data_col_name'.
+    E.g. for the ports within 100km around the points for Superset filters:
+        codes, dist = get_port_geo_index(path).query_radius(lats, lons, 100)
+    """
+    return _build_port_geo_index(
+        str(path_to_port_data),
+        _file_version(path_to_port_data),
+        port_data_col_code,
+        tuple(port_data_cols_join),
+        port_data_col_name,
+    )
+
+
+def handle_ports(
+    df,
+    path_to_port_data,
+    port_data_col_code="Port Code",
+    port_data_cols_join=["lat", "lon", "country", "continent"],
+    ports_to_handle=["port_of_lading", "port_of_unlading"],
+    port_data_col_name=None,
+    resolve_max_km=50,
+):
+    """Add the Port data attributes for the ports' codes.
+    Instead of merging the codes are mapped onto the Port data's index
+    and the attributes are taken by the array indexing.
+    The codes not found in the Port data can be resolved by the port's name.
+
+    Args:
+        df (Pandas DataFrame): Dataframe w/ the '<port>_code' columns
+        path_to_port_data (str or Path): Path to CSV file w/ Port data
+        port_data_col_code (str): column's name w/ port codes in Port data
+        port_data_cols_join (list of str): columns' names to add from Port data
+        ports_to_handle (str or list of str): ports' columns prefixes
+        port_data_col_name (str or None): column's name w/ port names in Port data.
+            If None the unknown codes are not resolved by the names.
+        resolve_max_km (int): max distance to the anchor of the name or between
+            the ports w/ the same name. See PortGeoIndex.resolve_by_name()
+    Returns:
+        Pandas DataFrame : Data w/ the '<port>_<attribute>' columns
+    """
+    if isinstance(ports_to_handle, str):
+        ports_to_handle = [ports_to_handle]
+
+    print(f"\nHandle the {', '.join(ports_to_handle).upper()} ..................")
+    tic_main = time.time()
+
+    port_data_cols_read = list(port_data_cols_join)
+    if port_data_col_name is not None:
+        port_data_cols_read = list(
+            dict.fromkeys(port_data_cols_read + ["lat", "lon", port_data_col_name])
+        )
+        geo_index = get_port_geo_index(
+            path_to_port_data,
+            port_data_col_code=port_data_col_code,
+            port_data_cols_join=port_data_cols_read,
+            port_data_col_name=port_data_col_name,
+        )
+
+    df_pt = get_port_data(
+        path_to_port_data,
+        port_data_col_code=port_data_col_code,
+        port_data_cols_join=port_data_cols_read,
+    )
+    # Attributes' arrays w/ NaN at the end to be taken for the unknown codes
+    port_values = {
+        col: np.append(df_pt[col].to_numpy(), np.nan) for col in port_data_cols_join
+    }
+
+    print(f"Map the Port Codes onto the Port data ............................")
+    for port in ports_to_handle:
+        # The unknown codes & NaNs get -1, i.e. the last NaN item
+        idxs = pd.Categorical(df[f"{port}_code"], categories=df_pt.index).codes.copy()
+        mask = (idxs == -1) & df[f"{port}_code"].notna().to_numpy()
+        print(f"\t[{port}_code] not found in Port data: # {mask.sum():,}")
+        if port_data_col_name is not None and mask.any():
+            # The anchors of the names: where the ports w/ the known codes are
+            known = idxs != -1
+            anchors = (
+                pd.DataFrame(
+                    {
+                        "name": geo_index.normalize_names(df.loc[known, port]).to_numpy(),
+                        "lat": df_pt["lat"].to_numpy(dtype=float)[idxs[known]],
+                        "lon": df_pt["lon"].to_numpy(dtype=float)[idxs[known]],
+                    }
+                )
+                .groupby("name")[["lat", "lon"]]
+                .median()
+            )
+            codes = geo_index.resolve_by_name(
+                df.loc[mask, port],
+                max_km=resolve_max_km,
+                anchors=anchors,
+            )
+            idxs[mask] = df_pt.index.get_indexer(codes)
+            print(f"\t[{port}_code] resolved by the name: # {(idxs[mask] != -1).sum():,}")
+        for col in port_data_cols_join:
+            df[f"{port}_{col}"] = port_values[col][idxs]
+
     winsound.Beep(frequency=2000, duration=200)
-    print(f"Handled the {port_to_handle.upper()} {timing(tic_main)}")
+    print(f"Handled the {', '.join(ports_to_handle).upper()} {timing(tic_main)}")
+
+    return df
+
+
+def handle_trade_lanes(
+    df,
+    port_from="port_of_lading",
+    port_to="port_of_unlading",
+    col_lane="lane",
+    lane_aggs={"teu": "sum", "arrival_date_delay": "median"},
+):
+    """Add the trade lane's features for each shipment:
+        '<col_lane>_id' : '<port_from_code>-<port_to_code>'
+        '<col_lane>_distance_km' : great-circle distance between the ports'
+            median lat/lon over the lane's rows
+        '<col_lane>_shipments' : number of shipments on the lane
+        '<col_lane>_<col>_<agg>' : lane-level aggregates from 'lane_aggs'
+    Everything is calculated over the unique lanes and broadcasted to rows.
+
+    Args:
+        df (Pandas DataFrame): Dataframe w/ the ports' codes and lat/lon
+        port_from (str): prefix of the columns for the port of origin
+        port_to (str): prefix of the columns for the port of destination
+        col_lane (str): prefix for the columns to add
+        lane_aggs (dict): {column: aggregation} to calculate per lane
+    Returns:
+        Pandas DataFrame : Data w/ the lane's columns
+    """
+    print(f"\nHandle the Trade Lanes .........................................")
+    tic = time.time()
+
+    # Get the lane's index for each row: -1 when any code is unknown
+    from_idxs, from_codes = pd.factorize(df[f"{port_from}_code"])
+    to_idxs, to_codes = pd.factorize(df[f"{port_to}_code"])
+    mask = (from_idxs != -1) & (to_idxs != -1)
+    pair_idxs = from_idxs[mask].astype(np.int64) * len(to_codes) + to_idxs[mask]
+    lane_idxs = np.full(len(df), -1, dtype=np.int64)
+    lane_idxs[mask] = pd.factorize(pair_idxs)[0]
+    num_lanes = lane_idxs.max(initial=-1) + 1
+    print(f"Unique lanes: # {num_lanes:,}")
+
+    # Get the first row for each lane to take the lane's codes
+    lanes, rows = np.unique(lane_idxs, return_index=True)
+    rows = rows[lanes != -1]
+
+    def broadcast(values):
+        # The last NaN item is taken for the rows w/o lane
+        return np.append(values, np.nan)[lane_idxs]
+
+    lane_ids = (
+        from_codes[from_idxs[rows]].astype(str) + "-" + to_codes[to_idxs[rows]].astype(str)
+    )
+    df[f"{col_lane}_id"] = broadcast(np.asarray(lane_ids, dtype=object))
+
+    # The lat/lon of the lane's rows may differ (the codes resolved by the names)
+    # or be NaN (the codes not in the Port data): the median of the known ones
+    cols_coords = [f"{port}_{x}" for port in (port_from, port_to) for x in ("lat", "lon")]
+    coords = (
+        df.loc[mask, cols_coords]
+        .astype(float)
+        .groupby(lane_idxs[mask])
+        .median()
+        .reindex(range(num_lanes))
+    )
+    df[f"{col_lane}_distance_km"] = broadcast(
+        calc_haversine_km(*(coords[col].to_numpy() for col in cols_coords))
+    )
+    df[f"{col_lane}_shipments"] = broadcast(
+        np.bincount(lane_idxs[mask], minlength=num_lanes)
+    )
+
+    for col, agg in lane_aggs.items():
+        lane_values = (
+            df.loc[mask, col]
+            .groupby(lane_idxs[mask])
+            .agg(agg)
+            .reindex(range(num_lanes))
+            .to_numpy()
+        )
+        df[f"{col_lane}_{col}_{agg}"] = broadcast(lane_values)
+
+    winsound.Beep(frequency=2000, duration=200)
+    print(f"Handled the Trade Lanes {timing(tic)}")
 
     return df
 
@@ -740,13 +1026,19 @@ def split_column_by_pattern(
     print(f"\nHandle the {col_to_split.upper()} ..............................")
     tic = time.time()
 
-    df[[first_col_name, second_col_name]] = df[col_to_split].str.split(
-        pat=pattert_for_split,
-        n=1,
-        expand=True,
-    )
-    # Remove punctuation
-    df[second_col_name] = df[second_col_name].str.replace(r"[^\w\s]+", "", regex=True)
+    def split(uniques):
+        parts = uniques.str.split(pat=pattert_for_split, n=1, expand=True)
+        # The 2nd part is all-NaN if no value has the pattern
+        parts = parts.reindex(columns=[0, 1]).astype(object)
+        # Remove punctuation
+        parts[1] = parts[1].str.replace(r"[^\w\s]+", "", regex=True)
+        return parts
+
+    df[[first_col_name, second_col_name]] = transform_on_uniques(
+        df[col_to_split],
+        split,
+        vectorized=True,
+    ).to_numpy()
 
     if fill_na:
         df.fillna(
@@ -757,7 +1049,6 @@ def split_column_by_pattern(
     if not return_original_col:
         df.drop(columns=[col_to_split], inplace=True)
 
-    df = df[sorted(df.columns)]
     winsound.Beep(frequency=2000, duration=200)
     print(f"Handled the {col_to_split.upper()} {timing(tic)}")
 
@@ -767,215 +1058,453 @@ def split_column_by_pattern(
 def handle_listed_data(
     df,
     cols_to_handle: list,
+    as_lists=False,
 ):
+    """Normalize the columns w/ the comma separated items: remove whitespaces,
+    empty & duplicated items.
+
+    Args:
+        df (Pandas DF): DF with the listed data
+        cols_to_handle (list): columns' names
+        as_lists (bool, optional): Whether return the items as the lists,
+            written to parquet as the native list columns. Otherwise
+            as the strings w/ items joined by ', '. Defaults to False.
+    Returns:
+        Pandas DF: DF with the listed data handled
+    """
     for col in cols_to_handle:
         print(f"\nHandle the {col.upper()} ...................................")
         tic = time.time()
         # Split the data, remove empty strings from resulting list and get uniques
-        df[col] = (
-            df[col]
-            .fillna("N/A")
-            .replace(r"\s+", "", regex=True)
-            .str.split(pat=",", expand=False)
-            .apply(lambda x: ", ".join(set(filter(None, x))))
-        )
-        df[col].replace({"N/A": np.nan}, inplace=True)
+        lists = split_listed_items(df[col], sep=",")
+        if as_lists:
+            df[col] = pd.Series(lists.to_pandas(), index=df.index)
+        else:
+            df[col] = pd.Series(pc.binary_join(lists, ", ").to_pandas(), index=df.index)
         winsound.Beep(frequency=2000, duration=200)
         print(f"Handled the {col.upper()} {timing(tic)}")
 
     return df
 
 
-def handle_company(
+def handle_container_ids(
     df,
+    col_to_handle="container_id",
+):
+    """Encode the lists of the container IDs into the lists of int64 keys
+    w/ the ISO 6346 codec, see encode_container_ids().
+
+    Args:
+        df (Pandas DF): DF with the column of the lists of container IDs
+        col_to_handle (str, optional): Defaults to "container_id".
+    Returns:
+        Pandas DF: DF with the lists of keys
+    """
+    print(f"\nHandle the {col_to_handle.upper()} ...........................")
+    tic = time.time()
+
+    df[col_to_handle], valid = encode_container_id_lists(
+        df[col_to_handle],
+        return_valid=True,
+    )
+    print(f"\tContainer IDs: # {len(valid):,}, not valid ISO 6346: # {(~valid).sum():,}")
+
+    winsound.Beep(frequency=2000, duration=200)
+    print(f"Handled the {col_to_handle.upper()} {timing(tic)}")
+
+    return df
+
+
+def resolve_company(
+    df_pairs,
     col_name: str,
     col_address: str,
-    return_original_cols=False,
+    registry_path=None,
+    ncores=1,
+    engine="cascade",
+    ram_budget_gb=None,
     **kwargs,
 ):
     """Group (deduplicating) strings for <NAME> column
     with following deduplicating for <ADDRESS> column
+    over the unique pairs of (<NAME>, <ADDRESS>)
 
     Args:
-        df (Pandas DF): DF with <NAME> & <ADDRESS> columns
+        df_pairs (Pandas DF): DF with the unique <NAME> & <ADDRESS> pairs
         col_name (str): column's name for <NAME>
         col_address (str): column's name for <ADDRESS>
-        return_original_cols (bool, optional): Defaults to False.
+        registry_path (Path or None, optional): Path to EntityRegistry.
+            If given the names are resolved incrementally against the registry
+            w/ the stable groups instead of regrouping all names.
+            Defaults to None.
+        ncores (int, optional): number of processes. If > 1 the names are
+            grouped by blocks in the process pool. Defaults to 1.
+        engine (str, optional): engine to group the names w/o registry & blocks:
+            'cascade' - NgramCascadeGrouper over the shrinking representatives
+            'string_grouper' - passes of 'group_similar_strings'
+            'minhash' - passes of MinHash LSH, for the very large sets of names
+            Defaults to 'cascade'.
+        ram_budget_gb (float or None, optional): RAM budget of the grouping
+            w/ 'cascade' & 'string_grouper' engines. If given the block layout
+            is planned before grouping. Defaults to None.
         **kwarg: kwarg for 'group_similar_strings' func
             see more: https://github.com/Bergvca/string_grouper
+            Only 'max_n_matches' is applicable for 'cascade' & blocks.
     Returns:
-        Pandas DF: DF with grouped entities
+        Pandas DF: the pairs w/ the '<NAME>_grouped' & '<ADDRESS>_grouped'
+            (and the registry's '<NAME>_group_id' if 'registry_path')
     """
 
     MIN_SIMILARITY = 0.8
     col_name_grouped = f"{col_name}_grouped"
     col_address_grouped = f"{col_address}_grouped"
 
-    print(f"\nHandle the {col_name.upper()} ..................................")
+    print(f"\nResolve the {col_name.upper()} .................................")
     tic_main = time.time()
 
-    # Get info
-    num_cn_records_na = sum(df[col_name].isna())
-    num_cn_records = sum(df[col_name].notna())
-    num_cn_dupes = sum(df[col_name].duplicated())
-    num_cn_unique = len(df[col_name].dropna().unique())
-    print(f"\nInitial dataset: # {len(df):,} records")
-    print(f"\t[{col_name}] NA records: # {num_cn_records_na:,}")
-    print(f"\t[{col_name}] records: # {num_cn_records:,}")
-    print(f"\t[{col_name}] duplicates: # {num_cn_dupes:,}")
-    print(f"\t[{col_name}] unique: # {num_cn_unique:,}")
-
-    print(f"Strip & UPPER data ...")
-    df[col_name] = df[col_name].str.strip().str.upper()
-    df[col_address] = df[col_address].str.strip().str.upper()
-
-    # Create DF to work for grouping
-    _df = df[[col_name]].copy()
-
-    # Drop full duplicates and NaNs
-    dups = sum(_df.duplicated())
-    nans = sum(_df[col_name].isna())
-
-    _df.drop_duplicates(inplace=True)
-    _df.dropna(inplace=True)
-
-    print(f"\nHave been dropped NaNs # {nans:,}")
-    print(f"Have been dropped duplicated # {dups:,}")
+    print(f"Strip & UPPER data, canonicalize addresses ...")
+    df_pairs[col_name] = df_pairs[col_name].str.strip().str.upper()
+    df_pairs[col_address] = AddressCanonicalizer().canonicalize(df_pairs[col_address])
+
+    # Create DF to work for grouping w/o duplicates and NaNs
+    _df = df_pairs[[col_name]].drop_duplicates().dropna()
     print(f"Total rows to dedupe before preprocessing: # {len(_df):,}")
 
     # Preprocess data
-    _df, long_words_idxs, processed_col_name = preprocess_column_to_group(
+    _df, long_words_col_name, processed_col_name = preprocess_column_to_group(
         _df,
         col=col_name,
         decode=True,
         puncts=True,
+        ncores=ncores,
     )
 
-    _df, _ = do_ngram_grouping(
-        _df,
-        n_gram=6,
-        min_similarity=MIN_SIMILARITY,
-        col_name=processed_col_name,
-        **kwargs,
+    if registry_path is not None:
+        print(f"\nResolve names w/ the entity registry ...........................")
+        if Path(registry_path).exists():
+            registry = EntityRegistry.load(registry_path)
+        else:
+            registry = EntityRegistry(ngram_size=3, min_similarity=MIN_SIMILARITY)
+        cols_added = ["group_id", "group"]
+        _df[cols_added] = registry.resolve(_df[processed_col_name], **kwargs)
+        registry.save(registry_path)
+    elif ncores > 1:
+        print(f"\nGroup names by blocks in parallel ..............................")
+        cols_added = ["group_id", "group"]
+        groups = do_blocked_grouping(
+            _df[processed_col_name],
+            n_grams=[6, 5, 4, 3, 3],
+            min_similarity=MIN_SIMILARITY,
+            ncores=ncores,
+            **kwargs,
+        )
+        _df[cols_added] = groups[cols_added]
+    elif engine == "cascade":
+        _df, cols_added = do_ngram_cascade_grouping(
+            _df,
+            n_grams=[6, 5, 4, 3, 3],
+            min_similarity=MIN_SIMILARITY,
+            col_name=processed_col_name,
+            ram_budget_gb=ram_budget_gb,
+            **kwargs,
+        )
+    else:
+        # The string_grouper's kwargs are not applicable for the other engines
+        if engine == "string_grouper":
+            engine_kwargs = dict(kwargs, ram_budget_gb=ram_budget_gb)
+        else:
+            engine_kwargs = {}
+        col_to_group = processed_col_name
+        for n_gram in [6, 5, 4, 3, 3]:
+            _df, cols_added = do_ngram_grouping(
+                _df,
+                n_gram=n_gram,
+                min_similarity=MIN_SIMILARITY,
+                col_name=col_to_group,
+                engine=engine,
+                **engine_kwargs,
+            )
+            col_to_group = cols_added[1]
+
+    print(f"\nUnique names in & out:")
+    diagnostics.count(
+        "companies",
+        **{
+            f"{col_name}_uniques_in": _df[processed_col_name].nunique,
+            f"{col_name_grouped}_uniques_out": _df[cols_added[1]].nunique,
+        },
     )
-    _df, _ = do_ngram_grouping(_df, 5, MIN_SIMILARITY, None, **kwargs)
-    _df, _ = do_ngram_grouping(_df, 4, MIN_SIMILARITY, None, **kwargs)
-    _df, _ = do_ngram_grouping(_df, 3, MIN_SIMILARITY, None, **kwargs)
-    _df, cols_added = do_ngram_grouping(_df, 3, MIN_SIMILARITY, None, **kwargs)
-
-    print(f"\nUnique '{col_name}' in: # {len(_df.iloc[:, 1].unique()):,}")
-    print(f"Unique '{col_name_grouped}' out: # {len(_df.iloc[:, -1].unique()):,}")
 
     print(f"\nReturn the long words in their places ..........................")
-    _df["group"] = _df[cols_added[1]].copy()
-    for pair, idxs in long_words_idxs.items():
-        # Get the group_id which was transformed through long words
-        group_ids = _df.loc[idxs][cols_added[0]].unique().tolist()
-        idxs_new = _df[_df[cols_added[0]].isin(group_ids)].index.tolist()
-
-        print(f"{pair[1]} -> {pair[0]} : all # {len(idxs_new):,} \ grouped # {len(group_ids):,}")
-
-        _df.loc[idxs_new, "group"] = _df.loc[idxs_new, "group"].str.replace(pair[1], pair[0])
-    _df.rename(columns={"group": col_name_grouped}, inplace=True)
-    winsound.Beep(frequency=2000, duration=200)
+    _df[col_name_grouped] = restore_long_words(
+        groups=_df[cols_added[1]],
+        group_ids=_df[cols_added[0]],
+        bitmasks=_df[long_words_col_name],
+    )
 
-    print(f"\nMerge results with initial dataset .............................")
-    df = pd.merge(
-        df,
-        _df[
-            [
-                col_name,
-                col_name_grouped,
-            ]
-        ],
-        how="left",
-        left_on=col_name,
-        right_on=col_name,
+    # Map the grouped names onto the pairs
+    df_pairs[col_name_grouped] = df_pairs[col_name].map(
+        _df.set_index(col_name)[col_name_grouped]
     )
+    if registry_path is not None:
+        # The registry's stable IDs are kept by the EntityMappingStore
+        df_pairs[f"{col_name}_group_id"] = df_pairs[col_name].map(
+            _df.set_index(col_name)[cols_added[0]]
+        )
 
     print(f"\nHandle {col_address} ...........................................")
-    print(f"\tUnique '{col_address}' in: # {len(df[col_address].unique()):,}")
-    df[col_address_grouped] = df.groupby([col_name_grouped])[col_address].transform("first")
+    diagnostics.count("companies", **{f"{col_address}_uniques_in": df_pairs[col_address].nunique})
+    # The pairs are in order of their first rows, so 'first' is the same as for rows
+    df_pairs[col_address_grouped] = df_pairs.groupby([col_name_grouped])[
+        col_address
+    ].transform("first")
 
     # Replace NA in grouped address with non-digit original address
-    df.loc[
-        np.logical_and(
-            df[col_address_grouped].isna(),
-            np.logical_not(df[col_address].str.isdigit()),
-        ),
-        col_address_grouped,
-    ] = df[col_address]
+    mask = df_pairs[col_address_grouped].isna() & ~df_pairs[col_address].str.isdigit().fillna(
+        True
+    ).astype(bool)
+    df_pairs.loc[mask, col_address_grouped] = df_pairs.loc[mask, col_address]
 
-    num_address = len(df[col_address_grouped].unique())
-    print(f"\tUnique '{col_address_grouped}' out: # {num_address:,}")
+    diagnostics.count(
+        "companies", **{f"{col_address_grouped}_uniques_out": df_pairs[col_address_grouped].nunique}
+    )
 
-    df = drop_duplicated(df)
+    winsound.Beep(frequency=2000, duration=200)
+    print(f"Resolved the {col_name.upper()} {timing(tic_main)}")
 
-    # Get final results
-    num_gcn_dupes = sum(df[col_name_grouped].duplicated())
-    num_gcn_unique = len(df[col_name_grouped].dropna().unique())
+    return df_pairs
 
-    print(f"\nBefore grouping: # {len(df):,} all records")
-    print(f"\t[{col_name}] duplicates: # {num_cn_dupes:,}")
-    print(f"\t[{col_name}] unique: # {num_cn_unique:,}")
-    print(f"After grouping: # {len(df):,} all records")
-    print(f"\tGrouped [{col_name}] duplicates: # {num_gcn_dupes:,}")
-    print(f"\tGrouped [{col_name}] unique: # {num_gcn_unique:,}")
 
-    if not return_original_cols:
-        df.drop(columns=[col_name, col_address], inplace=True)
-        df.rename(
-            columns={
-                col_name_grouped: col_name,
-                col_address_grouped: col_address,
-            },
-            inplace=True,
+def _resolve_company_task(task):
+    """Resolve the company in the pool's worker. The worker's diagnostics
+    get the parent's level (the 'spawn' workers don't inherit it) and their log
+    is returned w/ the mapping to be kept by the parent"""
+    df_pairs, col_name, col_address, kwargs, level = task
+    diagnostics.set_level(level)
+    diagnostics.log = []
+    df_pairs = resolve_company(df_pairs, col_name, col_address, **kwargs)
+    return df_pairs, diagnostics.log
+
+
+def handle_companies(
+    df,
+    companies: list,
+    return_original_cols=False,
+    concurrent=True,
+    registry_dir=None,
+    ram_budget_gb=None,
+    mapping_dir=None,
+    address_table_path=None,
+    **kwargs,
+):
+    """Group (deduplicating) the names & addresses of the companies' columns.
+    For each company the unique pairs of (<NAME>, <ADDRESS>) are extracted and
+    resolved into the small mapping tables, concurrently in the separate processes
+    if 'concurrent'. All mappings are applied to the DF at once at the end.
+
+    Args:
+        df (Pandas DF): DF with <NAME> & <ADDRESS> columns
+        companies (list of tuples): [(<NAME> column, <ADDRESS> column), ...]
+        return_original_cols (bool, optional): Defaults to False.
+        concurrent (bool, optional): Whether resolve the companies in parallel.
+            In the workers the names are grouped w/o blocks in the pool.
+            Defaults to True.
+        registry_dir (Path or None, optional): Folder for the EntityRegistry
+            of each <NAME> column. Defaults to None.
+        ram_budget_gb (float or None, optional): total RAM budget of the grouping,
+            shared by the concurrent workers. Defaults to None.
+        mapping_dir (Path or None, optional): Folder to save the EntityMappingStore
+            of raw names -> entities for each <NAME> column, w/ the registry's
+            group IDs if 'registry_dir'. Defaults to None.
+        address_table_path (Path or None, optional): Path to the addresses' side
+            table. If given the grouped <ADDRESS> is returned as int64
+            '<ADDRESS>_key' column w/ the canonical text kept in the side table,
+            see AddressCanonicalizer. Defaults to None.
+        **kwargs: kwargs for resolve_company()
+    Returns:
+        Pandas DF: DF with grouped entities
+    """
+    print(f"\nHandle the COMPANIES: {[x[0] for x in companies]} ................")
+    tic_main = time.time()
+
+    tasks, codes = [], []
+    for col_name, col_address in companies:
+        # Unique pairs in order of their first rows
+        pair_codes, first_rows = factorize_rows(df, [col_name, col_address])
+        df_pairs = df.iloc[first_rows][[col_name, col_address]].reset_index(drop=True)
+        print(f"[{col_name}] & [{col_address}] unique pairs: # {len(df_pairs):,}")
+
+        task_kwargs = dict(kwargs)
+        if registry_dir is not None:
+            task_kwargs["registry_path"] = Path(registry_dir) / col_name
+        if concurrent:
+            task_kwargs["ncores"] = 1
+        if ram_budget_gb is not None:
+            n_workers = len(companies) if concurrent else 1
+            task_kwargs["ram_budget_gb"] = ram_budget_gb / n_workers
+        tasks.append((df_pairs, col_name, col_address, task_kwargs))
+        codes.append(pair_codes)
+
+    if concurrent and len(tasks) > 1:
+        pool = mp.Pool(len(tasks))
+        results = pool.map(
+            _resolve_company_task, [task + (diagnostics.level,) for task in tasks]
         )
+        pool.close()  # close out processes
+        pool.join()  # join processes
+        mappings = [df_pairs for df_pairs, _ in results]
+        for _, log in results:
+            diagnostics.log.extend(log)
+    else:
+        mappings = [resolve_company(x[0], x[1], x[2], **x[3]) for x in tasks]
+
+    if mapping_dir is not None:
+        print(f"\nSave the entity mapping stores .................................")
+        for (col_name, col_address), df_pairs in zip(companies, mappings):
+            EntityMappingStore.build(
+                Path(mapping_dir) / col_name,
+                names=df_pairs[col_name],
+                groups=df_pairs[f"{col_name}_grouped"],
+                addresses=df_pairs[f"{col_address}_grouped"],
+                group_ids=df_pairs.get(f"{col_name}_group_id"),
+            )
+
+    print(f"\nApply the mappings to the initial dataset ......................")
+    cols, cols_to_drop, address_tables = {}, [], []
+    for (col_name, col_address), df_pairs, pair_codes in zip(companies, mappings, codes):
+        cols_grouped = [f"{col_name}_grouped", f"{col_address}_grouped"]
+        if return_original_cols:
+            cols_from = [col_name, col_address] + cols_grouped
+            cols_to = list(cols_from)
+        else:
+            cols_from = cols_grouped
+            cols_to = [col_name, col_address]
+        if address_table_path is not None:
+            # Carry the int64 keys instead of the grouped addresses
+            df_pairs[cols_grouped[1]], table = AddressCanonicalizer().encode(
+                df_pairs[cols_grouped[1]], canonical=True
+            )
+            address_tables.append(table)
+            if not return_original_cols:
+                cols_to_drop.append(cols_to[-1])
+            cols_to[-1] = f"{cols_to[-1]}_key"
+        for col_from, col_to in zip(cols_from, cols_to):
+            cols[col_to] = df_pairs[col_from].to_numpy()[pair_codes]
+    df = df.drop(columns=cols_to_drop).assign(**cols)
+
+    if address_table_path is not None:
+        AddressCanonicalizer.save_table(pd.concat(address_tables), address_table_path)
+
+    df = drop_duplicated(df)
+
+    print(f"After grouping unique names:")
+    for col_name, _ in companies:
+        col = col_name if not return_original_cols else f"{col_name}_grouped"
+        diagnostics.count("companies", **{f"{col_name}_uniques": df[col].nunique})
 
-    df = df[sorted(df.columns)]
     winsound.Beep(frequency=2000, duration=200)
-    print(f"Handled the {col_name.upper()} {timing(tic_main)}")
+    print(f"Handled the COMPANIES {timing(tic_main)}")
 
     return df
 
 
+def handle_company(
+    df,
+    col_name: str,
+    col_address: str,
+    return_original_cols=False,
+    registry_path=None,
+    **kwargs,
+):
+    """Group (deduplicating) strings for <NAME> column
+    with following deduplicating for <ADDRESS> column
+
+    Args:
+        df (Pandas DF): DF with <NAME> & <ADDRESS> columns
+        col_name (str): column's name for <NAME>
+        col_address (str): column's name for <ADDRESS>
+        return_original_cols (bool, optional): Defaults to False.
+        registry_path (Path or None, optional): Path to EntityRegistry.
+            Defaults to None.
+        **kwargs: kwargs for resolve_company()
+    Returns:
+        Pandas DF: DF with grouped entities
+    """
+    return handle_companies(
+        df,
+        companies=[(col_name, col_address)],
+        return_original_cols=return_original_cols,
+        concurrent=False,
+        registry_path=registry_path,
+        **kwargs,
+    )
+
+
 def handle_numeric_outliers(
     df,
     cols_to_handle=["teu", "quantity", "cif"],
     cols_name_suffix="outliers_off",
     outliers_treshold=0.99,
     return_original_cols=False,
+    sketch_dir=None,
+    period="all",
+    update_sketches=True,
+    group_cols=None,
+    min_group_size=1000,
 ):
+    """Cap the outliers of the numeric columns by the quantile sketches,
+    see outliers_get_caps(), or by the groups w/ the fallback to those caps,
+    see outliers_get_group_caps().
+
+    Args:
+        df (Pandas DF): DF w/ the numeric columns
+        cols_to_handle (list of str, optional): Defaults to ["teu", "quantity", "cif"].
+        cols_name_suffix (str, optional): Defaults to "outliers_off".
+        outliers_treshold (float, optional): Defaults to 0.99.
+        return_original_cols (bool, optional): Defaults to False.
+        sketch_dir (Path or None, optional): dir w/ the sketches of the periods
+            processed, for the same caps over all of them. Defaults to None.
+        period (str, optional): name of the data period. Defaults to "all".
+        update_sketches (bool, optional): Whether save the sketches of the period
+            before capping (the one pass), else the period's sketches have to be
+            saved by the 1st pass over all the periods. Defaults to True.
+        group_cols (list of str or None, optional): columns of the groups
+            for the caps, e.g. ["hscode_02", "container_size"]. W/ 'sketch_dir'
+            the groups' sketches are merged over the periods too. Defaults to None.
+        min_group_size (int, optional): the groups w/ less values get
+            the global caps. Defaults to 1000.
+    Returns:
+        Pandas DF: DF w/ the capped columns
+    """
     print(f"\nHandle the numeric column(s) ...................................")
     tic_main = time.time()
 
     # Fix the negative values
     df[cols_to_handle] = df[cols_to_handle].abs()
 
-    # Get outliers' indexes & limits
-    df_out, cutoffs = outliers_get_quantiles(
+    # Get outliers' limits
+    caps = outliers_get_caps(
         df,
         cols_to_handle,
         treshold=outliers_treshold,
+        sketch_dir=sketch_dir,
+        period=period,
+        update_sketches=update_sketches,
     )
+    if group_cols is not None:
+        caps = outliers_get_group_caps(
+            df,
+            cols_to_handle,
+            group_cols,
+            caps_global=caps,
+            treshold=outliers_treshold,
+            min_group_size=min_group_size,
+            sketch_dir=sketch_dir,
+            period=period,
+            update_sketches=update_sketches,
+        )
+    df = _cap_outliers(df, caps, cols_name_suffix, return_original_cols)
 
-    cols_lim = [f"{x}_{cols_name_suffix}" for x in cols_to_handle]
-
-    print(f"\nLimit the outliers w/ tresholds ...")
-    for i, col in enumerate(cols_to_handle):
-
-        df[cols_lim[i]] = df[col].copy()
-        # Limit the data
-        df.loc[df_out[col], cols_lim[i]] = cutoffs[col]
-
-    # # Checkout
-    # df.loc[df_out.sum(axis=1) > 0, cols_to_handle + cols_lim]
-
-    if not return_original_cols:
-        df.drop(columns=cols_to_handle, inplace=True)
-        df.rename(columns=dict(zip(cols_lim, cols_to_handle)), inplace=True)
-
-    df = df[sorted(df.columns)]
     winsound.Beep(frequency=2000, duration=200)
     print(f"Handled the numeric column(s) {timing(tic_main)}")
 
@@ -988,7 +1517,13 @@ def handle_weight_outliers(
     cols_name_suffix="outliers_off",
     outliers_treshold=0.99,
     return_original_cols=False,
+    sketch_dir=None,
+    period="all",
+    update_sketches=True,
 ):
+    """Cap the outliers of the weights' columns: the values over the cap
+    of their own column get the least of the caps,
+    see handle_numeric_outliers() for the args"""
 
     print(f"\nHandle the WEIGHTs column(s) ...................................")
     tic_main = time.time()
@@ -996,34 +1531,235 @@ def handle_weight_outliers(
     # Fix the negative values
     df[cols_to_handle] = df[cols_to_handle].abs()
 
-    # Get outliers' indexes & limits
-    df_out, cutoffs = outliers_get_quantiles(
+    # Get outliers' limits
+    caps = outliers_get_caps(
         df,
         cols_to_handle,
         treshold=outliers_treshold,
+        sketch_dir=sketch_dir,
+        period=period,
+        update_sketches=update_sketches,
+    )
+    # The least cap of the columns w/ the outliers
+    caps_out = [cap for col, cap in caps.items() if (df[col] > cap).any()]
+    cutoff_wight = min(caps_out) if caps_out else np.nan
+    df = _cap_outliers(
+        df,
+        caps,
+        cols_name_suffix,
+        return_original_cols,
+        caps_fill={col: cutoff_wight for col in cols_to_handle},
     )
 
-    cutoff_wight = min(cutoffs.values())
-    cols_lim = [f"{x}_{cols_name_suffix}" for x in cols_to_handle]
+    winsound.Beep(frequency=2000, duration=200)
+    print(f"Handled the WEIGHTs column(s) {timing(tic_main)}")
+
+    return df
+
 
+def _cap_outliers(df, caps, cols_name_suffix, return_original_cols, caps_fill=None):
+    """Limit the columns by their caps: a scalar or an array of the caps
+    for each row. The NaN cap leaves the value as is. If 'caps_fill' is given
+    the values over their caps get the {column: value} instead of the caps"""
     print(f"\nLimit the outliers w/ tresholds ...")
-    for i, col in enumerate(cols_to_handle):
-        df[cols_lim[i]] = df[col].copy()
-        # Limit the data
-        df.loc[df_out[col], cols_lim[i]] = cutoff_wight
+    cols = {}
+    for col, cap in caps.items():
+        values = df[col].to_numpy(dtype=np.float64, na_value=np.nan)
+        is_out = values > cap  # False for the NaNs
+        diagnostics.count("outliers", **{f"{col}_capped": is_out.sum()})
+        values = np.where(is_out, cap if caps_fill is None else caps_fill[col], values)
+        cols[col if not return_original_cols else f"{col}_{cols_name_suffix}"] = values
+    return df.assign(**cols)
+
+
+class HSCodeResolver:
+    """Resolver of the HS codes into the chapters' & headings' descriptions
+    by the longest prefix over the sorted index of the 6/4/2-digit codes.
+    The 2-digit entries are the fallback of the ranges: the codes of a chapter
+    w/o their own heading get the last heading of the chapter's range.
+    The normalized multi-code cells are cached between the calls.
 
-    # # Checkout
-    # df.loc[df_out.sum(axis=1) > 0, cols_to_handle + cols_lim]
+    Args:
+        df_hts (Pandas DF): HS codes table w/ 'hscode_02_range',
+            'hscode_02_desc_short', 'hscode_04', 'hscode_04_desc_short'
+            and optional 'hscode_06' columns
+    """
 
-    if not return_original_cols:
-        df.drop(columns=cols_to_handle, inplace=True)
-        df.rename(columns=dict(zip(cols_lim, cols_to_handle)), inplace=True)
+    LEVELS = (6, 4, 2)
+    COLS = ["hscode_04", "hscode_02_desc_short", "hscode_04_desc_short"]
+
+    def __init__(self, df_hts):
+        entries = []
+        if "hscode_06" in df_hts.columns:
+            _df = df_hts.dropna(subset=["hscode_06"]).assign(prefix=df_hts["hscode_06"])
+            entries.append(_df.assign(level=6))
+        entries.append(df_hts.assign(prefix=df_hts["hscode_04"], level=4))
+
+        # The last codes of the ranges are the fallback for their chapters
+        last_codes = [x.split()[2] for x in df_hts["hscode_02_range"].unique()]
+        _df = df_hts[df_hts["hscode_04"].isin(last_codes)]
+        entries.append(_df.assign(prefix=_df["hscode_04"].str[:2], level=2))
+
+        index = pd.concat(entries, ignore_index=True)
+        index["key"] = self._get_keys(index["prefix"], index["level"])
+        index = (
+            index.dropna(subset=["key"])
+            .drop_duplicates("key")
+            .sort_values("key")
+            .reset_index(drop=True)
+        )
+        self.keys = index["key"].to_numpy(dtype=np.int64)
+        self.values = index[self.COLS]
+        self.cells = pd.DataFrame(columns=["hscode", "cargo_count"], dtype=object)
+
+        print(f"HS codes index: # {len(self.keys):,} prefixes")
+        for _, x in index[index["level"] == 2].iterrows():
+            print(f"{x['prefix']}: {x['hscode_04']}: {x['hscode_02_desc_short']}")
+
+    @staticmethod
+    def _get_keys(prefixes, level):
+        """Keys of the prefixes w/ their length: int(prefix) * 10 + length"""
+        keys = pd.to_numeric(prefixes.where(prefixes.str.len() == level), errors="coerce")
+        return keys * 10 + level
+
+    def lookup(self, codes):
+        """Get the positions in 'values' of the longest prefixes of the codes,
+        -1 if no one prefix is found.
+        """
+        codes = pd.Series(codes, dtype=object)
+        idxs = np.full(len(codes), -1, dtype=np.int64)
+        for level in self.LEVELS:
+            pending = np.flatnonzero(idxs == -1)
+            keys = self._get_keys(codes.iloc[pending].str[:level], level)
+            keys = keys.fillna(-1).to_numpy(dtype=np.int64)
+            pos = np.searchsorted(self.keys, keys).clip(max=len(self.keys) - 1)
+            found = self.keys[pos] == keys
+            idxs[pending[found]] = pos[found]
+        return idxs
+
+    def split_cells(self, sr):
+        """Normalize the multi-code cells over the cache of the cells seen before.
+
+        Returns:
+            Pandas DF : ['hscode', 'cargo_count'] aligned w/ the Series
+        """
+        codes, uniques = pd.factorize(sr)
+        uniques = pd.Index(uniques)
+        new = uniques[~uniques.isin(self.cells.index)]
+        if len(new) > 0:
+            lists = split_listed_items(pd.Series(new, dtype=object), sep=",")
+            _df = pd.DataFrame(
+                {
+                    "hscode": pc.binary_join(lists, ",").to_numpy(zero_copy_only=False),
+                    "cargo_count": pc.list_value_length(lists).to_numpy(zero_copy_only=False),
+                },
+                index=new,
+            )
+            self.cells = pd.concat([self.cells, _df]) if len(self.cells) else _df
+        print(f"\tUnique cells: # {len(uniques):,}, new of them: # {len(new):,}")
+        idxs = self.cells.index.get_indexer(uniques)
+        # The code -1 of NaNs gets NaN
+        return self.cells.iloc[idxs].reset_index(drop=True).reindex(codes).set_axis(
+            sr.index, axis=0
+        )
 
-    df = df[sorted(df.columns)]
-    winsound.Beep(frequency=2000, duration=200)
-    print(f"Handled the WEIGHTs column(s) {timing(tic_main)}")
+    def resolve(self, sr):
+        """Resolve the first codes of the cells into the descriptions.
+
+        Returns:
+            Pandas DF : ['hscode_04', 'hscode_02_desc_short', 'hscode_04_desc_short']
+                aligned w/ the Series, 'hscode_04' is the code's prefix if not found
+        """
+        codes, uniques = pd.factorize(sr)
+        uniques = pd.Series(uniques, dtype=object)
+        idxs = self.lookup(uniques)
+        found = idxs != -1
+        _df = self.values.iloc[idxs.clip(min=0)].reset_index(drop=True)
+        _df.loc[~found, self.COLS] = np.nan
+        _df.loc[~found, "hscode_04"] = uniques[~found].str[:4]
+        print(f"\tUnique codes: # {len(uniques):,}, not resolved: # {(~found).sum():,}")
+        return _df.reindex(codes).set_axis(sr.index, axis=0)
+
+
+@lru_cache(maxsize=4)
+def _build_hscode_resolver(path_to_hscodes_table, hscodes_table_version):
+    """Build the HSCodeResolver once per table version.
+    The 'hscodes_table_version' is not used inside but makes the cache key.
+    """
+    print(f"Get the HS Codes data ............................................")
+    df_hts = pd.read_csv(
+        path_to_hscodes_table,
+        usecols=lambda x: x
+        in [
+            "hscode_02_range",
+            "hscode_02_desc_short",
+            "hscode_04",
+            "hscode_04_desc_short",
+            "hscode_06",
+        ],
+        dtype={"hscode_04": object, "hscode_06": object},
+    )
+    return HSCodeResolver(df_hts)
+
+
+def get_hscode_resolver(path_to_hscodes_table):
+    return _build_hscode_resolver(
+        path_to_hscodes_table,
+        _file_version(path_to_hscodes_table),
+    )
 
-    return df
+
+SHIPMENT_KEY_COLS = [
+    "bill_of_lading",
+    "bill_of_lading_master",
+    "manifest_no",
+    "arrival_date_actual",
+]
+
+
+def get_shipment_ids(df, cols=SHIPMENT_KEY_COLS):
+    """Stable int64 key of the shipment: the hash of its identifying columns"""
+    return pd.util.hash_pandas_object(df[cols], index=False).to_numpy().view(np.int64)
+
+
+def make_hscode_bridge(
+    df,
+    resolver,
+    col_to_handle="hscode",
+    col_shipment_id="shipment_id",
+):
+    """Make the bridge table of the shipments & their HS codes:
+    the multi-code cells are exploded w/ the Arrow list kernels
+    and each code is resolved into its heading & descriptions.
+
+    Args:
+        df (Pandas DF): DF w/ the shipments' keys & the normalized HS codes
+        resolver (HSCodeResolver): resolver of the HS codes
+        col_to_handle (str, optional): Defaults to "hscode".
+        col_shipment_id (str, optional): Defaults to "shipment_id".
+    Returns:
+        Pandas DF: [<col_shipment_id>, 'hscode', 'hscode_02', 'hscode_04',
+            'hscode_02_desc_short', 'hscode_04_desc_short']
+    """
+    print(f"Make the shipments-to-HS codes bridge table ......................")
+    lists = split_listed_items(df[col_to_handle], sep=",")
+    rows = pc.list_parent_indices(lists).to_numpy()
+    df_bridge = pd.DataFrame(
+        {
+            col_shipment_id: df[col_shipment_id].to_numpy()[rows],
+            "hscode": pc.list_flatten(lists).to_numpy(zero_copy_only=False),
+        }
+    ).drop_duplicates(ignore_index=True)
+
+    df_bridge[resolver.COLS] = resolver.resolve(df_bridge["hscode"]).to_numpy()
+    df_bridge["hscode_02"] = transform_on_uniques(
+        df_bridge["hscode_04"],
+        lambda x: x.str[:2],
+        vectorized=True,
+    )
+    print(f"\tBridge table: # {len(df_bridge):,} shipment-code pairs")
+
+    return df_bridge
 
 
 def handle_hscode(
@@ -1031,104 +1767,79 @@ def handle_hscode(
     path_to_hscodes_table,
     col_to_handle="hscode",
     return_cargo_count=True,
+    col_shipment_id=None,
 ):
+    """Normalize the multi-code cells of the HS codes and add the headings
+    & descriptions of the first code of each cell.
+
+    Args:
+        df (Pandas DF): DF with the HS codes
+        path_to_hscodes_table (Path or str): HS codes table
+        col_to_handle (str, optional): Defaults to "hscode".
+        return_cargo_count (bool, optional): Defaults to True.
+        col_shipment_id (str or None, optional): column w/ the shipments' keys.
+            If given the bridge table of all codes of the shipments is returned
+            as well, see make_hscode_bridge(). Defaults to None.
+    Returns:
+        Pandas DF or tuple of DFs: DF with the HS codes handled
+            (and the bridge table)
+    """
     print(f"\nHandle the {col_to_handle.upper()} column(s) ...................")
     tic_main = time.time()
 
-    # Split the data, remove empty strings from resulting list and get uniques
-    df[col_to_handle] = (
-        df[col_to_handle]
-        .fillna("N/A")
-        .replace(r"\s+", "", regex=True)
-        .str.split(pat=",", expand=False)
-        .apply(lambda x: ",".join(set(filter(None, x))))
-    )
-    df[col_to_handle].replace({"N/A": np.nan}, inplace=True)
+    resolver = get_hscode_resolver(path_to_hscodes_table)
 
+    # Split the data, remove empty strings from resulting list and get uniques
+    cells = resolver.split_cells(df[col_to_handle])
+    df[col_to_handle] = cells["hscode"]
     if return_cargo_count:
-        df["cargo_count"] = (
-            df[col_to_handle].replace(r"\s+", "", regex=True).str.split(",").str.len()
-        )
+        df["cargo_count"] = cells["cargo_count"].astype(float)
 
     # Derive groups
     df["hscode_02"] = df[col_to_handle].str[:2]
-    df["hscode_04"] = df[col_to_handle].str[:4]
 
-    # * Get the HS Codes data
-    df_hts = pd.read_csv(
-        path_to_hscodes_table,
-        # header=0,
-        usecols=[
-            "hscode_02_range",
-            "hscode_02_desc_short",
-            "hscode_04",
-            "hscode_04_desc_short",
-        ],
-        dtype={"hscode_02": object, "hscode_04": object},
-    )
-    # Add the HS Codes data
-    df = pd.merge(
-        df,
-        df_hts.drop(columns=["hscode_02_range"]),
-        how="left",
-        on="hscode_04",
-    )
+    # Add the HS Codes data by the longest prefix
+    df[resolver.COLS] = resolver.resolve(df[col_to_handle]).to_numpy()
 
-    print(f"Fix some problems w/ wrong 'hscode_04' ...........................")
-    # Create dict w/ last range codes for replacing later
-    last_codes = df_hts["hscode_02_range"].unique().tolist()
-    last_codes = [x.split()[2] for x in last_codes]
-    # Create list of lists w/ descriptions
-    codes_list = df_hts[df_hts["hscode_04"].isin(last_codes)][
-        ["hscode_04", "hscode_02_desc_short", "hscode_04_desc_short"]
-    ].values.tolist()
-    # Create dictionary w/ codes & descriptions
-    codes_dict = dict(zip([x[0][:2] for x in codes_list], codes_list))
-
-    # Replase wrong codes
-    for k, v in codes_dict.items():
-        print(f"{k}: {v[0]}: {v[1]}")
-        df.loc[
-            (df["hscode_02_desc_short"].isna()) & (df["hscode_02"] == k),
-            ["hscode_04", "hscode_02_desc_short", "hscode_04_desc_short"],
-        ] = (
-            v[0],
-            v[1],
-            v[2],
-        )
+    if col_shipment_id is not None:
+        df_bridge = make_hscode_bridge(df, resolver, col_to_handle, col_shipment_id)
 
-    df = df[sorted(df.columns)]
     winsound.Beep(frequency=2000, duration=200)
     print(f"Handled the {col_to_handle.upper()} {timing(tic_main)}")
 
+    if col_shipment_id is not None:
+        return df, df_bridge
     return df
 
 
 def handle_description(
     df,
     col_to_handle="product_desc",
+    ncores=1,
 ):
+    """Clean the descriptions: done over the unique descriptions only,
+    in the parallel chunks if ncores > 1.
+
+    Args:
+        df (Pandas DF): DF with the descriptions
+        col_to_handle (str, optional): Defaults to "product_desc".
+        ncores (int or None, optional): number of processes,
+            None for all CPUs. Defaults to 1.
+    Returns:
+        Pandas DF: DF with the descriptions cleaned
+    """
     print(f"\nHandle the {col_to_handle.upper()} column(s) ...................")
     tic_main = time.time()
-
-    # Remove unprintable simbols
-    df[col_to_handle] = (
-        df[[col_to_handle]]
-        .fillna("N/A")
-        .applymap(lambda y: "".join(filter(lambda x: x in printable, y)))
-    )
-
-    # strip the HTML tags from a string and remove duplicated descriptions
-    df[col_to_handle] = (
-        df[col_to_handle]
-        .fillna("N/A")
-        .str.split(r"<.*?>", expand=False, regex=True)
-        .apply(lambda x: "; ".join(set(filter(None, x))))
+    ncores = mp.cpu_count() if ncores is None else ncores
+
+    # Remove unprintable simbols, strip the HTML tags from a string
+    # and remove duplicated descriptions
+    df[col_to_handle] = transform_on_uniques(
+        df[col_to_handle],
+        clean_description,
+        ncores=ncores,
     )
 
-    df[col_to_handle].replace({"N/A": np.nan}, inplace=True)
-
-    df = df[sorted(df.columns)]
     winsound.Beep(frequency=2000, duration=200)
     print(f"Handled the {col_to_handle.upper()} {timing(tic_main)}")
 
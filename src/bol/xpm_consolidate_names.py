@@ -26,10 +26,16 @@ from mgbol.data.xpm.utils import handle_company
 
 
 # %% MAIN -----------------------------------------------------------------------
-def pool_names(entity_type):
+def pool_names(entity_type, incremental=False):
     # entity_type = "notify_party"
 
     FILE_NAME = f"xpm_pooled_{entity_type}_US"
+    # The registry keeps the groups stable between runs: w/ incremental=True
+    # only the names not seen before are grouped
+    REGISTRY_PATH = s3_data_local_path / f"registry/xpm/us/{entity_type}"
+    # The mapping of raw names to the entities for the downstream lookups,
+    # see EntityMappingStore
+    MAPPING_DIR = s3_data_local_path / "mapping/xpm/us"
 
     PROCESSED_FOLDER_PATH = s3_data_local_path / "processed/xpm/us"
     PROCESSED_FILES_NAMES = [
@@ -49,6 +55,7 @@ def pool_names(entity_type):
         processed_files_names=PROCESSED_FILES_NAMES,
         cols_to_read=COLS_TO_READ,
         drop_dupes=True,
+        address_table_path=PROCESSED_FOLDER_PATH / "xpm_addresses_US.parquet",
     )
 
     col_name = COLS_TO_READ[0]
@@ -58,7 +65,8 @@ def pool_names(entity_type):
         col_name=col_name,
         col_address=col_address,
         return_original_cols=False,  #! False
-        n_blocks="auto",
+        registry_path=REGISTRY_PATH if incremental else None,
+        mapping_dir=MAPPING_DIR,
     )
     df = df.drop_duplicates()
 
@@ -1,73 +1,90 @@
 """
     LOAD raw data from xportmine
     and PROCESS data
-    and RETURN & SAVE data frame with columns:
-
-    Data columns (total 61 columns):
-    #   Column                      Dtype
-    ---  ------                      -----
-    0   ada_month                   datetime64[ns]
-    1   arrival_date_actual         datetime64[ns]
-    2   arrival_date_delay          int64
-    3   arrival_date_estimate       datetime64[ns]
-    4   bill_of_lading              object
-    5   bill_of_lading_master       object
-    6   cargo_count                 float64
-    7   carrier_code                object
-    8   carrier_name                object
-    9   cif                         float64
-    10  cif_outliers_off            float64
-    11  consignee_address           object
-    12  consignee_name              object
-    13  container_desc_code         object
-    14  container_id                object
-    15  container_load_status       object
-    16  container_size              object
-    17  container_type              object
-    18  container_type_of_service   object
-    19  country_exp                 object
-    20  country_exp_code            object
-    21  country_imp                 object
-    22  hscode                      object
-    23  hscode_02                   object
-    24  hscode_02_desc_short        object
-    25  hscode_04                   object
-    26  hscode_04_desc_short        object
-    27  manifest_no                 object
-    28  marks_n_numbers             object
-    29  notify_party_address        object
-    30  notify_party_name           object
-    31  place_of_receipt            object
-    32  port_of_lading              object
-    33  port_of_lading_code         object
-    34  port_of_lading_continent    object
-    35  port_of_lading_country      object
-    36  port_of_lading_lat          float64
-    37  port_of_lading_lon          float64
-    38  port_of_unlading            object
-    39  port_of_unlading_code       object
-    40  port_of_unlading_continent  object
-    41  port_of_unlading_country    object
-    42  port_of_unlading_lat        float64
-    43  port_of_unlading_lon        float64
-    44  product_desc                object
-    45  quantity                    float64
-    46  quantity_outliers_off       float64
-    47  quantity_unit               object
-    48  report_month                period[M]
-    49  shipper_address             object
-    50  shipper_name                object
-    51  teu                         float64
-    52  teu_outliers_off            float64
-    53  vessel_imo                  object
-    54  vessel_name                 object
-    55  vessel_type                 object
-    56  weight                      float64
-    57  weight_kg                   float64
-    58  weight_kg_outliers_off      float64
-    59  weight_outliers_off         float64
-    60  weight_unit                 object
-    dtypes: datetime64[ns](3), float64(15), int64(1), object(41), period[M](1)
+    and RETURN & SAVE data frame with columns (sorted at writing):
+
+    Data columns (total 67 columns):
+    #   Column                          Dtype
+    ---  ------                          -----
+    0   ada_month                       datetime64[ns]
+    1   arrival_date_actual             datetime64[ns]
+    2   arrival_date_delay              int16
+    3   arrival_date_estimate           datetime64[ns]
+    4   bill_of_lading                  object
+    5   bill_of_lading_master           object
+    6   cargo_count                     float32
+    7   carrier_code                    category
+    8   carrier_name                    category
+    9   cif                             float64
+    10  cif_outliers_off                float64
+    11  consignee_address_key           int64
+    12  consignee_name                  object
+    13  container_desc_code             object(list)
+    14  container_id                    object(list)
+    15  container_load_status           object(list)
+    16  container_size                  object(list)
+    17  container_type                  object(list)
+    18  container_type_of_service       object(list)
+    19  country_exp                     category
+    20  country_exp_code                category
+    21  country_imp                     category
+    22  hscode                          object
+    23  hscode_02                       category
+    24  hscode_02_desc_short            category
+    25  hscode_04                       category
+    26  hscode_04_desc_short            category
+    27  lane_arrival_date_delay_median  float32
+    28  lane_distance_km                float64
+    29  lane_id                         category
+    30  lane_shipments                  float32
+    31  lane_teu_outliers_off_sum       float64
+    32  manifest_no                     object
+    33  marks_n_numbers                 object
+    34  notify_party_address_key        int64
+    35  notify_party_name               object
+    36  place_of_receipt                category
+    37  port_of_lading                  category
+    38  port_of_lading_code             category
+    39  port_of_lading_continent        category
+    40  port_of_lading_country          category
+    41  port_of_lading_lat              float64
+    42  port_of_lading_lon              float64
+    43  port_of_unlading                category
+    44  port_of_unlading_code           category
+    45  port_of_unlading_continent      category
+    46  port_of_unlading_country        category
+    47  port_of_unlading_lat            float64
+    48  port_of_unlading_lon            float64
+    49  product_desc                    object
+    50  quantity                        float64
+    51  quantity_outliers_off           float64
+    52  quantity_unit                   category
+    53  report_month                    category
+    54  shipment_id                     int64
+    55  shipper_address_key             int64
+    56  shipper_name                    object
+    57  teu                             float64
+    58  teu_outliers_off                float64
+    59  vessel_imo                      object
+    60  vessel_name                     object
+    61  vessel_type                     category
+    62  weight                          float64
+    63  weight_kg                       float64
+    64  weight_kg_outliers_off          float64
+    65  weight_outliers_off             float64
+    66  weight_unit                     category
+    dtypes: category(23), datetime64[ns](3), float32(3), float64(16), int16(1),
+        int64(4), object(17)
+
+    The dtypes are compacted by cols_compact_dtypes() & widened over the years
+    by the persisted schema, so they depend on the data, e.g. the low cardinality
+    strings are 'category'. The object(list) columns are the native list columns,
+    the 'container_id' is the list of the ISO 6346 int64 keys. The companies'
+    addresses are the int64 '*_address_key' into the addresses' side table.
+
+    and the bridge table of the shipments & all their HS codes:
+    [shipment_id (int64), hscode, hscode_02, hscode_02_desc_short,
+    hscode_04, hscode_04_desc_short]
 
     @author: mikhail.galkin
 """
@@ -90,15 +107,21 @@ sys.path.extend([".", "./.", "././.", "..", "../..", "../../.."])
 from mgbol.config import s3_data_local_path
 
 from mgbol.utils import timing
+from mgbol.utils import write_parquet_sorted_cols
+from mgbol.utils import cols_compact_dtypes
+from mgbol.utils import diagnostics
+from mgbol.utils import outliers_update_sketches
 from mgbol.data.xpm.utils import read_xport_us_rar_data
 
-from mgbol.data.xpm.utils import handle_actual_arrival_date
-from mgbol.data.xpm.utils import handle_estimated_arrival_date
+from mgbol.data.xpm.utils import handle_arrival_dates
 from mgbol.data.xpm.utils import handle_vessels
 from mgbol.data.xpm.utils import handle_ports
+from mgbol.data.xpm.utils import handle_trade_lanes
 from mgbol.data.xpm.utils import handle_listed_data
-from mgbol.data.xpm.utils import handle_company
+from mgbol.data.xpm.utils import handle_container_ids
+from mgbol.data.xpm.utils import handle_companies
 from mgbol.data.xpm.utils import handle_hscode
+from mgbol.data.xpm.utils import get_shipment_ids
 from mgbol.data.xpm.utils import handle_description
 from mgbol.data.xpm.utils import handle_numeric_outliers
 from mgbol.data.xpm.utils import handle_weight_outliers
@@ -109,6 +132,9 @@ from mgbol.data.xpm.utils import split_column_by_pattern
 def main(
     rars_folder_path,
     rars_names=None,
+    data_period="all",
+    outliers_sketches_only=False,
+    ncores=None,  # for the descriptions, None for all CPUs
     **kwargs,
 ):
 
@@ -118,10 +144,31 @@ def main(
     FILE_VESSEL_DATA = "shipdb_export_04_2021.zip"
     FILE_PORT_DATA = "port_codes_geo-2022-06-01.csv"
     FILE_HSCODES_TABLE = "ft_hscodes_table.csv"
+    FILE_ADDRESS_TABLE = "xpm_addresses_US.parquet"
+    FILE_SCHEMA = "xpm_processed_US_schema.json"
+    FILE_HSCODES_SCHEMA = "xpm_processed_US_hscodes_schema.json"
 
     path_to_vessel_data = DIR_VESSEL_DATA + FILE_VESSEL_DATA
     path_to_port_data = DIR_PORT_DATA + FILE_PORT_DATA
     path_to_hscodes_table = s3_data_local_path / "hscodes" / FILE_HSCODES_TABLE
+    # The companies' addresses are carried as int64 keys w/ the text in it
+    path_to_address_table = s3_data_local_path / "processed/xpm/us" / FILE_ADDRESS_TABLE
+    path_to_schema = s3_data_local_path / "processed/xpm/us" / FILE_SCHEMA
+    path_to_hscodes_schema = s3_data_local_path / "processed/xpm/us" / FILE_HSCODES_SCHEMA
+    # The quantile sketches of all the periods give the same outliers' caps:
+    # they are saved by the 1st pass w/ 'outliers_sketches_only' over the periods
+    dir_outliers_sketches = s3_data_local_path / "processed/xpm/us/outliers_sketches"
+
+    RAM_BUDGET_GB = 24  # for the names grouping
+
+    COLS_LISTED = [
+        "container_desc_code",
+        "container_id",
+        "container_load_status",
+        "container_size",
+        "container_type",
+        "container_type_of_service",
+    ]
 
     COLS = None  # None if want to read ALL columns
     COLS_DATETIME = ["Estimate Arrival Date", "Actual Arrival Date"]
@@ -159,21 +206,43 @@ def main(
         inplace=True,
     )
 
-    df = handle_actual_arrival_date(
+    df = handle_arrival_dates(
         df,
         col_ade="arrival_date_estimate",
         col_ada="arrival_date_actual",
         col_report_month="report_month",
-    )
-
-    df = handle_estimated_arrival_date(
-        df,
-        col_ade="arrival_date_estimate",
-        col_ada="arrival_date_actual",
         col_delay_name="arrival_date_delay",
         return_delay=True,
     )
 
+    if outliers_sketches_only:
+        # Only the groups' columns are made for the sketches of the groups
+        df = handle_listed_data(df, cols_to_handle=["container_size"], as_lists=False)
+        df = handle_hscode(
+            df,
+            path_to_hscodes_table,
+            col_to_handle="hscode",
+            return_cargo_count=False,
+        )
+        cols_numeric = ["teu", "quantity", "cif"]
+        cols_weight = ["weight_kg", "weight"]
+        df[cols_numeric + cols_weight] = df[cols_numeric + cols_weight].abs()
+        outliers_update_sketches(
+            df,
+            cols_numeric,
+            sketch_dir=dir_outliers_sketches,
+            period=data_period,
+            group_cols=["hscode_02", "container_size"],
+        )
+        outliers_update_sketches(
+            df,
+            cols_weight,
+            sketch_dir=dir_outliers_sketches,
+            period=data_period,
+        )
+        print(f"\nDONE. Outliers' sketches {timing(tic)}")
+        return None, None
+
     df["ada_month"] = df["arrival_date_actual"] + pd.tseries.offsets.MonthEnd(1)
 
     df = handle_vessels(
@@ -221,15 +290,9 @@ def main(
         path_to_port_data,
         port_data_col_code="port_code",
         port_data_cols_join=["lat", "lon", "country", "continent"],
-        port_to_handle="port_of_lading",
-    )
-
-    df = handle_ports(
-        df,
-        path_to_port_data,
-        port_data_col_code="port_code",
-        port_data_cols_join=["lat", "lon", "country", "continent"],
-        port_to_handle="port_of_unlading",
+        ports_to_handle=["port_of_lading", "port_of_unlading"],
+        port_data_col_name="port_name",  # resolves the unknown codes
+        resolve_max_km=50,
     )
 
     df = split_column_by_pattern(
@@ -244,55 +307,43 @@ def main(
 
     df = handle_listed_data(
         df,
-        cols_to_handle=[
-            "container_desc_code",
-            "container_id",
-            "container_load_status",
-            "container_size",
-            "container_type",
-            "container_type_of_service",
-        ],
-    )
-
-    df = handle_company(
-        df,
-        col_name="shipper_name",
-        col_address="shipper_address",
-        return_original_cols=False,  #! False
-        n_blocks="auto",
-    )
-
-    df = handle_company(
-        df,
-        col_name="consignee_name",
-        col_address="consignee_address",
-        return_original_cols=False,  #! False
-        n_blocks="auto",
+        cols_to_handle=COLS_LISTED,
+        as_lists=False,  #! False: the lists are made at the end
     )
 
-    df = handle_company(
+    df = handle_companies(
         df,
-        col_name="notify_party_name",
-        col_address="notify_party_address",
+        companies=[
+            ("shipper_name", "shipper_address"),
+            ("consignee_name", "consignee_address"),
+            ("notify_party_name", "notify_party_address"),
+        ],
         return_original_cols=False,  #! False
-        n_blocks="auto",
+        concurrent=True,
+        ram_budget_gb=RAM_BUDGET_GB,
+        address_table_path=path_to_address_table,
     )
 
-    df = handle_hscode(
+    # The shipment key joins the bridge table of the HS codes
+    df["shipment_id"] = get_shipment_ids(df)
+    df, df_hscodes = handle_hscode(
         df,
         path_to_hscodes_table,
         col_to_handle="hscode",
         return_cargo_count=True,  #! True
+        col_shipment_id="shipment_id",
     )
 
     df = handle_description(
         df,
         col_to_handle="product_desc",
+        ncores=ncores,
     )
 
     df = handle_description(
         df,
         col_to_handle="marks_n_numbers",
+        ncores=ncores,
     )
 
     df = handle_numeric_outliers(
@@ -301,6 +352,11 @@ def main(
         cols_name_suffix="outliers_off",
         outliers_treshold=0.99,
         return_original_cols=True,  #! True
+        sketch_dir=dir_outliers_sketches,
+        period=data_period,
+        update_sketches=False,  # saved by the 1st pass
+        group_cols=["hscode_02", "container_size"],
+        min_group_size=1000,
     )
 
     df = handle_weight_outliers(
@@ -309,15 +365,40 @@ def main(
         cols_name_suffix="outliers_off",
         outliers_treshold=0.99,
         return_original_cols=True,  #! True
+        sketch_dir=dir_outliers_sketches,
+        period=data_period,
+        update_sketches=False,  # saved by the 1st pass
+    )
+
+    df = handle_trade_lanes(
+        df,
+        port_from="port_of_lading",
+        port_to="port_of_unlading",
+        col_lane="lane",
+        lane_aggs={"teu_outliers_off": "sum", "arrival_date_delay": "median"},
+    )
+
+    # Store the containers' data as the native list columns
+    df = handle_listed_data(
+        df,
+        cols_to_handle=COLS_LISTED,
+        as_lists=True,
     )
+    # Store the container IDs as the ISO 6346 int64 keys
+    df = handle_container_ids(df, col_to_handle="container_id")
 
     # Convert datetime to string
     df["report_month"] = df["report_month"].dt.strftime("%Y%m")
 
+    # The compact dtypes are widened over the years by the schemas,
+    # the reader reconciles them w/ the files written before
+    df = cols_compact_dtypes(df, path_to_schema=path_to_schema)
+    df_hscodes = cols_compact_dtypes(df_hscodes, path_to_schema=path_to_hscodes_schema)
+
     winsound.Beep(frequency=3000, duration=400)
     print(f"\nDONE. Preprocessing {timing(tic)}")
 
-    return df
+    return df, df_hscodes
 
 
 # %% RUN ========================================================================
@@ -422,14 +503,31 @@ if __name__ == "__main__":
         "2022": RARS_2022,
     }
 
+    # The 1st pass: the outliers' sketches of all the periods,
+    # so the 2nd pass caps all of them by the same merged sketches
+    diagnostics.set_level("off")
+    for year, rar in RARS.items():
+        print(f"\n--------------  {year}: outliers' sketches  ---------------------")
+        main(
+            rars_folder_path=s3_data_local_path / "raw/xpm/us",
+            rars_names=rar,
+            data_period=year,
+            outliers_sketches_only=True,
+        )
+
+    # "off", "counters" or "samples": the last displays the samples of rows
+    diagnostics.set_level("counters")
+
     for year, rar in RARS.items():
         print(f"\n--------------  {year}  ------------------------------------")
-        df = main(
+        df, df_hscodes = main(
             rars_folder_path=s3_data_local_path / "raw/xpm/us",
             rars_names=rar,
+            data_period=year,
         )
 
-        display(df.info(show_counts=True))
+        if diagnostics.samples:
+            display(df.info(show_counts=True))
 
         FILE_NAME = "xpm_processed_US"
         DATA_PERIOD = year
@@ -443,14 +541,22 @@ if __name__ == "__main__":
 
             print(f"Save data as PARQUET: {path_to_save}")
             tic = time.time()
-            df.to_parquet(
-                path=path_to_save,
-                engine="auto",
-                compression="snappy",
-                index=False,
-            )
+            write_parquet_sorted_cols(df, path_to_save, compression="snappy")
             print(f"Saving {timing(tic)}")
 
+            # The bridge table of the shipments & their HS codes
+            path_to_save = dir_to_save / f"{FILE_NAME}_hscodes-{DATA_PERIOD}.parquet"
+            print(f"Save data as PARQUET: {path_to_save}")
+            tic = time.time()
+            write_parquet_sorted_cols(df_hscodes, path_to_save, compression="snappy")
+            print(f"Saving {timing(tic)}")
+
+        # * Append the counters to the metrics log -----------------------------
+        if diagnostics.counters:
+            path_to_save = s3_data_local_path / "processed/xpm/us" / f"{FILE_NAME}_metrics.csv"
+            print(f"Save the metrics log: {path_to_save}")
+            diagnostics.save(path_to_save, period=DATA_PERIOD)
+
         # # * Write DF to CSV.GZ -------------------------------------------------
         # TO_CSV = True
         # if TO_CSV:
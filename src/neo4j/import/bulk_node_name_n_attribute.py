@@ -96,6 +96,7 @@ def make_data(node_label, node_cols):
         processed_files_names=PROCESSED_FILES_NAMES,
         cols_to_read=None,
         drop_dupes=False,  #! Should be False
+        address_table_path=PROCESSED_FOLDER_PATH / "xpm_addresses_US.parquet",
     )
 
     print(f"Do some data processing ..........................................")
@@ -109,11 +110,11 @@ def make_data(node_label, node_cols):
     df.sort_values(by=[COL_NAME, "arrival_date_actual"], inplace=True)
 
     # Get last address\attribute
-    df[COL_ATTR_LAST] = df.groupby([COL_NAME])[COL_ATTR].transform("last")
+    df[COL_ATTR_LAST] = df.groupby([COL_NAME], observed=True)[COL_ATTR].transform("last")
 
     print(f"Calculate aggregated stuff .......................................")
     df = (
-        df.groupby(by=[COL_NAME, COL_ATTR_LAST], dropna=False)
+        df.groupby(by=[COL_NAME, COL_ATTR_LAST], dropna=False, observed=True)
         .agg(
             cargo_count_last=("cargo_count", "last"),
             cargo_count_max=("cargo_count", "max"),
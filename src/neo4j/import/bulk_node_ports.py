@@ -27,6 +27,7 @@ from mgbol.config import s3_data_local_path
 from mgbol.config import s3_neo4j_local_path
 
 from mgbol.utils import timing
+from mgbol.utils_special import CONTAINER_KEY_NA
 from mgbol.neo4j.xpm.utils import read_xport_processed_data
 
 
@@ -116,10 +117,7 @@ def make_data(node_label, node_col_name):
     # Handle NA's
     cols_na = [node_col_name] + node_cols_local
     df[cols_na] = df[cols_na].fillna(value="N/A")
-    df["container_id"] = df["container_id"].fillna(value="XXXXXXXXXXX")
-
-    # Put containers_id into list
-    df["container_id"] = df["container_id"].str.split(", ")
+    # The containers' ids are the lists of int64 keys, NA's are filled after exploding
     # df["container_count"] = df["container_id"].apply(len)
 
     print(f"Create spatial variable ...")
@@ -134,20 +132,29 @@ def make_data(node_label, node_col_name):
     # Sort before getting last info
     df.sort_values(by=[node_col_code, "arrival_date_actual"], inplace=True)
     # Get last name
-    df[node_col_name] = df.groupby([node_col_code])[node_col_name].transform("last")
+    df[node_col_name] = df.groupby([node_col_code], observed=True)[node_col_name].transform(
+        "last"
+    )
 
     print(f"Calculate aggregated stuff .......................................")
     print(f"Calculate containers count ...")
     cols_con = [node_col_code, "arrival_date_actual", "container_id"]
     df_con = df.explode("container_id")[cols_con]
-    df_con.groupby(cols_con).size().sort_values()
+    df_con["container_id"] = (
+        df_con["container_id"].fillna(value=CONTAINER_KEY_NA).astype("int64")
+    )
+    df_con.groupby(cols_con, observed=True).size().sort_values()
     df_con.drop_duplicates(inplace=True)
-    df_con = df_con.groupby([node_col_code]).size().reset_index(name="container_count")
+    df_con = (
+        df_con.groupby([node_col_code], observed=True)
+        .size()
+        .reset_index(name="container_count")
+    )
 
     print(f"Calculate aggregations ...")
     cols = [node_col_name, node_col_code] + node_cols_local + ["location"]
     df = (
-        df.groupby(by=cols, dropna=False)
+        df.groupby(by=cols, dropna=False, observed=True)
         .agg(
             delay_count=("arrival_date_delay", lambda x: x[x > 0].count()),
             delay_days_q50=("arrival_date_delay", "median"),
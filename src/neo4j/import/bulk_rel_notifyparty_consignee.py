@@ -24,6 +24,7 @@ from mgbol.config import s3_data_local_path
 from mgbol.config import s3_neo4j_local_path
 
 from mgbol.utils import timing
+from mgbol.utils_special import CONTAINER_KEY_NA
 from mgbol.neo4j.xpm.utils import read_xport_processed_data
 
 
@@ -82,10 +83,7 @@ def main():
     df[[NODE_OUT_COL_NAME, NODE_IN_COL_NAME]] = df[[NODE_OUT_COL_NAME, NODE_IN_COL_NAME]].fillna(
         "N/A"
     )
-    df["container_id"] = df["container_id"].fillna(value="XXXXXXXXXXX")
-
-    # Put containers_id into list
-    df["container_id"] = df["container_id"].str.split(", ")
+    # The containers' ids are the lists of int64 keys, NA's are filled after exploding
 
     # # Sort before getting last info
     # df.sort_values(
@@ -106,17 +104,20 @@ def main():
         "container_id",
     ]
     df_con = df.explode("container_id")[cols_con]
-    df_con.groupby(cols_con).size().sort_values()
+    df_con["container_id"] = (
+        df_con["container_id"].fillna(value=CONTAINER_KEY_NA).astype("int64")
+    )
+    df_con.groupby(cols_con, observed=True).size().sort_values()
     df_con.drop_duplicates(inplace=True)
     df_con = (
-        df_con.groupby([NODE_OUT_COL_NAME, NODE_IN_COL_NAME])
+        df_con.groupby([NODE_OUT_COL_NAME, NODE_IN_COL_NAME], observed=True)
         .size()
         .reset_index(name="container_count")
     )
 
     print(f"Calculate aggregations ...")
     df = (
-        df.groupby(by=[NODE_OUT_COL_NAME, NODE_IN_COL_NAME], dropna=False)
+        df.groupby(by=[NODE_OUT_COL_NAME, NODE_IN_COL_NAME], dropna=False, observed=True)
         .agg(
             delay_count=("arrival_date_delay", lambda x: x[x > 0].count()),
             delay_days_last=("arrival_date_delay", "last"),
@@ -96,7 +96,7 @@ def main():
 
     print(f"Calculate aggregated stuff .......................................")
     df = (
-        df.groupby(by=[NODE_OUT_COL_NAME, NODE_IN_COL_NAME], dropna=False)
+        df.groupby(by=[NODE_OUT_COL_NAME, NODE_IN_COL_NAME], dropna=False, observed=True)
         .agg(
             cargo_count_last=("cargo_count", "last"),
             cargo_count_max=("cargo_count", "max"),
@@ -9,17 +9,29 @@ import winsound
 
 import numpy as np
 import pandas as pd
+import pyarrow.parquet as pq
+from pandas.api.types import union_categoricals
 
 from IPython.display import display
 from pprint import pprint
 
 from mgbol.utils import timing
 from mgbol.utils import drop_duplicated
+from mgbol.utils_special import AddressCanonicalizer
+from mgbol.utils_special import encode_container_id_lists
 
 
 # ------------------------------------------------------------------------------
 # --------------- L O A D I N G   &   S A V I N G    S T U F F -----------------
 # ------------------------------------------------------------------------------
+COLS_LISTED = [
+    "container_desc_code",
+    "container_id",
+    "container_load_status",
+    "container_size",
+    "container_type",
+    "container_type_of_service",
+]
 
 
 def read_xport_processed_data(
@@ -27,6 +39,8 @@ def read_xport_processed_data(
     processed_files_names: list,  # or None
     cols_to_read: list,  # or None
     drop_dupes=True,
+    address_table_path=None,
+    cols_listed=COLS_LISTED,
     **kwargs,
 ):
     """Read parquet-files w/ processed Xportmine BoL data
@@ -37,6 +51,14 @@ def read_xport_processed_data(
         processed_files_names (list of str or None): files' names w/o extension.
         cols_to_read (list of str or None): Columns' names to read.
         drop_dupes (bool): Either check for duplicates
+        address_table_path (Path or None): Path to the addresses' side table.
+            If given the '<ADDRESS>_key' columns are read instead of '<ADDRESS>'
+            and decoded back into the '<ADDRESS>' columns w/ the canonical text.
+            The files processed before w/o the key columns keep the plain text.
+        cols_listed (list of str): Columns w/ the lists of items. They are
+            native list columns, the comma joined strings of the data
+            processed before are split into the lists ('container_id' into
+            the lists of ISO 6346 keys).
         **kwargs: kwargs for pandas.read_parquet()
     Returns:
         Pandas DataFrame : Data combined into one DF
@@ -45,27 +67,77 @@ def read_xport_processed_data(
     print(f"\nRead the Xportmine processed data ..............................")
     tic_main = time.time()
 
-    df = pd.DataFrame()  # empty DF for interim result
+    dfs = []  # DFs for interim result
 
     print(f"---- Get processed data for the columns:")
     pprint("All columns..." if cols_to_read is None else cols_to_read)
 
     for file in processed_files_names:
         print(f"---- Read processed data from the <{file}> ...")
+        file_path = processed_folder_path / f"{file}.parquet"
+
+        # Read the address keys where the file has them, else the plain text
+        file_cols = cols_to_read
+        if address_table_path is not None and cols_to_read is not None:
+            schema_names = set(pq.read_schema(file_path).names)
+            file_cols = [
+                f"{x}_key"
+                if x.endswith("_address") and f"{x}_key" in schema_names
+                else x
+                for x in cols_to_read
+            ]
 
         _df = pd.read_parquet(
-            path=processed_folder_path / f"{file}.parquet",
-            columns=cols_to_read,
-            engine="fastparquet",
+            path=file_path,
+            columns=file_cols,
+            engine="pyarrow",  # reads the list columns natively
         )
-
-        # Concatenate the data
-        df = pd.concat([df, _df], axis=0, ignore_index=True)
+        for col in [x for x in cols_listed if x in _df.columns]:
+            if isinstance(_df[col].dropna().head(1).squeeze(), str):
+                print(f"\tSplit the listed '{col}' into the lists ...")
+                _df[col] = _df[col].str.split(", ")
+                if col == "container_id":
+                    _df[col] = encode_container_id_lists(_df[col])
+
+        dfs.append(_df)
         del _df
 
+    # The categorical columns get the same categories to stay categorical
+    # after concatenation, w/ the 'N/A' for filling the N/A
+    cols_category = {x for _df in dfs for x in _df.select_dtypes("category").columns}
+    for col in cols_category:
+        categories = union_categoricals(
+            [_df[col].astype("category") for _df in dfs if col in _df.columns],
+            ignore_order=True,
+        ).categories.union(["N/A"])
+        for _df in [x for x in dfs if col in x.columns]:
+            _df[col] = _df[col].astype(pd.CategoricalDtype(categories))
+
+    # Concatenate the data
+    df = pd.concat(dfs, axis=0, ignore_index=True)
+    del dfs
+
+    if address_table_path is not None:
+        print(f"Decode addresses w/ the side table ...")
+        table = pd.read_parquet(address_table_path)
+        for col in [x for x in df.columns if x.endswith("_address_key")]:
+            col_address = col[: -len("_key")]
+            addresses = AddressCanonicalizer.decode_keys(df[col], table)
+            if col_address in df.columns:
+                # The rows of the files w/o the keys keep their plain text
+                addresses = addresses.where(df[col].notna(), df[col_address])
+            df[col_address] = addresses
+            df.drop(columns=col, inplace=True)
+
     if drop_dupes:
         print(f"Dropping duplicates ...")
-        df.drop_duplicates(inplace=True)
+        # The lists are unhashable, compare them as the tuples
+        tuples = {
+            x: df[x].map(tuple, na_action="ignore")
+            for x in cols_listed
+            if x in df.columns
+        }
+        df = df[~df.assign(**tuples).duplicated()]
 
     print(f"\nLoaded dataset has # {len(df):,} records ...")
     # display(df.info(show_counts=True))
@@ -4,16 +4,20 @@
 """
 
 #%% Import needed python libraryies and project config info
+import json
 import time
 import numpy as np
 import pandas as pd
 import geopandas as gpd
+import pyarrow as pa
+import pyarrow.parquet as pq
 from sklearn import metrics
 
 from IPython.display import display
 from pprint import pprint
 
 import multiprocessing as mp
+from pathlib import Path
 from tqdm import tqdm  # progress bar
 
 
@@ -88,6 +92,20 @@ def save_df_as_parquet(df, dir_to_save, file_to_save):
     del df_pq
 
 
+def write_parquet_sorted_cols(df, path_to_save, compression="snappy"):
+    """Write the DF to Parquet w/ the columns in sorted order. The handle_*
+    stages add & replace the columns in place, so the order is applied once
+    here: to the Arrow table w/o copying the columns.
+
+    Args:
+        df (Pandas DF): DF to write
+        path_to_save (Path or str): Parquet file
+        compression (str, optional): Defaults to "snappy".
+    """
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    pq.write_table(table.select(sorted(table.column_names)), path_to_save, compression=compression)
+
+
 def save_gdf_as_parquet(gdf, dir_to_save, file_to_save):
     print(f"\nSave the GeoDataFrame as <{file_to_save}.parquet> ...")
     tic = time.time()
@@ -292,6 +310,23 @@ def drop_duplicated(df, subset=None):
     return df
 
 
+def factorize_rows(df, cols):
+    """Encode the unique combinations of the columns' values (NaNs included)
+
+    Returns:
+        tuple of numpy arrays : (code of combination for each row,
+            position of the first row for each code)
+    """
+    codes = np.zeros(len(df), dtype=np.int64)
+    for col in cols:
+        col_codes, col_uniques = pd.factorize(df[col])
+        codes = codes * (len(col_uniques) + 1) + (col_codes + 1)
+        # Keep the codes compact to avoid the overflow
+        codes, _ = pd.factorize(codes)
+    first_rows = np.unique(codes, return_index=True)[1]
+    return codes, first_rows
+
+
 def cols_reorder(df):
     cols = df.columns.to_list()
     cols.sort()
@@ -404,6 +439,179 @@ def cols_coerce_all_to_dtypes(df):
     return df
 
 
+def _get_int_dtype(min_value, max_value):
+    for dtype in (np.int8, np.int16, np.int32):
+        info = np.iinfo(dtype)
+        if info.min <= min_value and max_value <= info.max:
+            return np.dtype(dtype).name
+    return "int64"
+
+
+def cols_profile_dtypes(df, max_cat_ratio=0.1):
+    """Profile the cardinality & the ranges of the columns and get
+    their compact dtypes where lossless:
+        the strings of low cardinality -> 'category' (the others keep
+            their 'str' or 'object' dtype),
+        the ints -> the smallest int of their range,
+        the floats -> 'float32' if they come back exactly.
+    The other columns keep their dtypes.
+
+    Args:
+        df (Pandas DF): DF to profile
+        max_cat_ratio (float, optional): max ratio of the uniques to the not N/A
+            values for the 'category'. Defaults to 0.1.
+    Returns:
+        dict : {column: dtype's name}
+    """
+    schema = {}
+    for col in df.columns:
+        sr = df[col]
+        dtype = sr.dtype.name
+        # The strings are 'str' in pandas >= 3.0 and 'object' before
+        is_string = pd.api.types.is_string_dtype(sr) or pd.api.types.is_object_dtype(sr)
+        if is_string and pd.api.types.infer_dtype(sr, skipna=True) == "string":
+            num_values = sr.notna().sum()
+            if sr.nunique() <= max_cat_ratio * num_values:
+                dtype = "category"
+        elif dtype in ("int16", "int32", "int64") and len(sr) > 0:
+            dtype = _get_int_dtype(sr.min(), sr.max())
+        elif dtype == "float64":
+            values = sr.to_numpy()
+            with np.errstate(over="ignore"):
+                values32 = values.astype(np.float32)
+            if np.array_equal(values32.astype(np.float64), values, equal_nan=True):
+                dtype = "float32"
+        schema[col] = dtype
+    return schema
+
+
+def _widen_dtypes(dtype_saved, dtype_new):
+    """Get the dtype fitting the values of both schemas"""
+    if dtype_saved == dtype_new:
+        return dtype_saved
+    ints = ("int8", "int16", "int32", "int64")
+    if dtype_saved in ints and dtype_new in ints:
+        return np.promote_types(dtype_saved, dtype_new).name
+    if {dtype_saved, dtype_new} <= set(ints + ("float32", "float64")):
+        return "float64"
+    if {dtype_saved, dtype_new} <= {"category", "str", "object"}:
+        # The string column keeps its saved form: the categories are lossless
+        return dtype_saved
+    return dtype_new
+
+
+def cols_compact_dtypes(df, path_to_schema=None, max_cat_ratio=0.1):
+    """Convert the columns to their compact dtypes, see cols_profile_dtypes().
+    If the schema is persisted, the dtypes are widened to fit the schema
+    saved by the frames processed before and the schema is updated.
+    The widening never narrows the later files, but the Parquet files written
+    before keep their dtypes: the reader reconciles them on concatenation
+    (the categories are unioned, the ints & floats upcast).
+
+    Args:
+        df (Pandas DF): DF to compact
+        path_to_schema (Path or None, optional): JSON w/ the schema.
+            Defaults to None.
+        max_cat_ratio (float, optional): Defaults to 0.1.
+    Returns:
+        Pandas DF: DF w/ the compact dtypes
+    """
+    print(f"\nCompact the columns' dtypes ....................................")
+    tic = time.time()
+    diagnostics.count("dtypes", memory_bytes_before=lambda: df.memory_usage(deep=True).sum())
+
+    schema = cols_profile_dtypes(df, max_cat_ratio=max_cat_ratio)
+    if path_to_schema is not None and Path(path_to_schema).exists():
+        with open(path_to_schema, "r") as f:
+            schema_saved = json.load(f)
+        for col in schema:
+            if col in schema_saved:
+                schema[col] = _widen_dtypes(schema_saved[col], schema[col])
+        schema = {**schema_saved, **schema}
+
+    cols = {}
+    for col in df.columns:
+        if schema[col] != df[col].dtype.name:
+            print(f"\t<{col}>: {df[col].dtype.name} -> {schema[col]}")
+            cols[col] = df[col].astype(schema[col])
+    df = df.assign(**cols)
+
+    if path_to_schema is not None:
+        with open(path_to_schema, "w") as f:
+            json.dump(schema, f, indent=4, sort_keys=True)
+
+    diagnostics.count("dtypes", memory_bytes_after=lambda: df.memory_usage(deep=True).sum())
+    print(f"Compacted the dtypes {timing(tic)}")
+
+    return df
+
+
+# ------------------------------------------------------------------------------
+# ------------------------------- D A T E S ------------------------------------
+# ------------------------------------------------------------------------------
+def dates_units_per_day(dtype):
+    """Get the number of the datetime64 units in a day, e.g. 86_400 * 10**6 for 'us'"""
+    unit, count = np.datetime_data(dtype)
+    return np.timedelta64(1, "D") // np.timedelta64(count, unit)
+
+
+def dates_get_years(dates):
+    """Get the years of the datetime64 array w/o the .dt accessor.
+
+    Args:
+        dates (np.array): datetime64 dates
+    Returns:
+        np.array : int64 years, the values for NaT are meaningless
+    """
+    return dates.astype("M8[Y]").astype(np.int64) + 1970
+
+
+def dates_replace_years(dates, years):
+    """Replace the years of the dates arithmetically: the month, the day
+    and the time of the day are kept. Feb-29 goes to Feb-28 of a non leap year
+    as the pd.DateOffset(years=n) does. The unit of the dates is kept,
+    e.g. the 'us' of pandas, as the 'ns' overflows beyond the year 2262.
+
+    Args:
+        dates (np.array): datetime64 dates
+        years (np.array or int): new years
+    Returns:
+        np.array : datetime64 dates in the same unit, NaT for NaT
+    """
+    dates = np.asarray(dates)
+    dtype = dates.dtype
+    days = dates.astype("M8[D]")
+    months = days.astype("M8[M]")
+    day_of_month = (days - months).astype(np.int64)  # 0-based
+    month_of_year = months.astype(np.int64) % 12  # 0-based
+
+    years = np.asarray(years, dtype=np.int64)
+    new_months = ((years - 1970) * 12 + month_of_year).astype("M8[M]")
+    new_days = new_months.astype("M8[D]")
+    month_len = ((new_months + 1).astype("M8[D]") - new_days).astype(np.int64)
+    new_days = new_days + np.minimum(day_of_month, month_len - 1)
+
+    results = new_days.astype(dtype) + (dates - days.astype(dtype))
+    results[np.isnat(dates)] = np.datetime64("NaT")
+    return results
+
+
+def dates_diff_days(dates_to, dates_from):
+    """Get the days between the dates as the Series.dt.days does: floored.
+
+    Args:
+        dates_to (np.array): datetime64 dates
+        dates_from (np.array): datetime64 dates, cast to the unit of 'dates_to'
+    Returns:
+        np.array : float64 days, NaN for NaT
+    """
+    dates_to = np.asarray(dates_to)
+    dates_from = np.asarray(dates_from, dtype=dates_to.dtype)
+    units_per_day = dates_units_per_day(dates_to.dtype)
+    diffs = (dates_to.view(np.int64) - dates_from.view(np.int64)) // units_per_day
+    return np.where(np.isnat(dates_to) | np.isnat(dates_from), np.nan, diffs)
+
+
 # ------------------------------------------------------------------------------
 # -------------------------- U T I L I T I E S ---------------------------------
 # ------------------------------------------------------------------------------
@@ -412,6 +620,122 @@ def timing(tic):
     return f"for: {int(min)}min {int(sec)}sec"
 
 
+# ------------------------------------------------------------------------------
+# ------------------------- D I A G N O S T I C S ------------------------------
+# ------------------------------------------------------------------------------
+class Diagnostics:
+    """Diagnostics of the pipeline's stages w/ the levels:
+        'off': nothing is computed,
+        'counters': the counters are computed w/ the vectorized reductions,
+            printed and kept in the metrics log,
+        'samples': the samples of the rows are displayed as well.
+    The counters & samples can be passed as the callables:
+    they are evaluated only when the level requires them.
+
+    Args:
+        level (str, optional): Defaults to "counters".
+        n_samples (int, optional): rows in a sample. Defaults to 10.
+        seed (int, optional): Defaults to 42.
+    """
+
+    LEVELS = ("off", "counters", "samples")
+    LOG_COLS = ["stage", "counter", "value", "time"]
+
+    def __init__(self, level="counters", n_samples=10, seed=42):
+        self.set_level(level)
+        self.n_samples = n_samples
+        self.seed = seed
+        self.log = []
+
+    def set_level(self, level):
+        if level not in self.LEVELS:
+            raise ValueError(f"Diagnostics level should be one of {self.LEVELS}: {level}")
+        self.level = level
+
+    @property
+    def counters(self):
+        return self.level != "off"
+
+    @property
+    def samples(self):
+        return self.level == "samples"
+
+    def count(self, stage, **counters):
+        """Compute, print & log the counters of the stage.
+
+        Returns:
+            dict : the counters' values, empty for the 'off' level
+        """
+        if not self.counters:
+            return {}
+        values = {}
+        for name, value in counters.items():
+            values[name] = int(value() if callable(value) else value)
+            self.log.append(
+                {"stage": stage, "counter": name, "value": values[name], "time": time.time()}
+            )
+            print(f"\t{name}: # {values[name]:,}")
+        return values
+
+    def count_values(self, stage, sr, name=None):
+        """Count the N/A, the not N/A & the unique values of the Series"""
+        if not self.counters:
+            return {}
+        name = sr.name if name is None else name
+        num_na = int(sr.isna().to_numpy().sum())
+        return self.count(
+            stage,
+            **{
+                f"{name}_na": num_na,
+                f"{name}_records": len(sr) - num_na,
+                f"{name}_uniques": sr.nunique,
+            },
+        )
+
+    def sample(self, stage, rows):
+        """Display the random sample of the rows: DF or the callable returning DF"""
+        if not self.samples:
+            return
+        rows = rows() if callable(rows) else rows
+        n = min(self.n_samples, len(rows))
+        print(f"\t[{stage}] Sample of # {n:,} of # {len(rows):,} rows:")
+        display(rows.sample(n=n, random_state=self.seed))
+
+    def to_frame(self):
+        """Get the metrics log as DF"""
+        return pd.DataFrame(self.log, columns=self.LOG_COLS)
+
+    def save(self, path, **fields):
+        """Append the metrics log w/ the constant fields (e.g. the data period)
+        to the CSV file & clear the log"""
+        df = self.to_frame().assign(**fields)
+        df["time"] = pd.to_datetime(df["time"], unit="s")
+        df.to_csv(path, mode="a", header=not Path(path).exists(), index=False)
+        self.log = []
+
+
+# The diagnostics shared by the pipeline's stages
+diagnostics = Diagnostics()
+
+
+# ------------------------------------------------------------------------------
+# ------------------------------- G E O ----------------------------------------
+# ------------------------------------------------------------------------------
+EARTH_RADIUS_KM = 6371.0088  # mean Earth radius
+
+
+def calc_haversine_km(lat1, lon1, lat2, lon2):
+    """Great-circle distance in km between the points given in degrees.
+    Works on the scalars and on the numpy arrays of the same shape.
+    """
+    lat1, lon1, lat2, lon2 = map(np.radians, (lat1, lon1, lat2, lon2))
+    a = (
+        np.sin((lat2 - lat1) / 2) ** 2
+        + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+
 # ------------------------------------------------------------------------------
 # --------------------------- O U T L I E R S ----------------------------------
 # ------------------------------------------------------------------------------
@@ -480,3 +804,448 @@ def outliers_ridoff(df, df_out):
     print(f"Totally deleted {sum(idx)} outliers...")
     print(f"Data w/o outliers has: {len(df)} rows X {len(df.columns)} cols")
     return df
+
+
+class QuantileSketch:
+    """Mergeable streaming sketch of the quantiles of the non-negative values:
+    the counts over the log-spaced bins w/ the relative accuracy guaranteed
+    for all quantiles (the DDSketch). The sketches of the chunks, the months
+    and the years are merged by adding their counts, so the quantiles
+    are got out-of-core and the same over all the data seen.
+
+    Args:
+        relative_accuracy (float, optional): Defaults to 0.01.
+        min_value (float, optional): values below are counted as zeros.
+            Defaults to 1e-6.
+        max_value (float, optional): values above are counted in the last bin.
+            Defaults to 1e15.
+    """
+
+    def __init__(self, relative_accuracy=0.01, min_value=1e-6, max_value=1e15):
+        self.relative_accuracy = relative_accuracy
+        self.min_value = min_value
+        self.max_value = max_value
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.key_min = self._get_keys(np.array([min_value]))[0]
+        num_bins = self._get_keys(np.array([max_value]))[0] - self.key_min + 1
+        self.counts = np.zeros(num_bins, dtype=np.int64)
+        self.zero_count = 0
+
+    def _get_keys(self, values):
+        return np.ceil(np.log(values) / np.log(self.gamma)).astype(np.int64)
+
+    @property
+    def count(self):
+        return int(self.zero_count + self.counts.sum())
+
+    def update(self, values):
+        """Add the values to the sketch, the NaNs are skipped"""
+        values = np.asarray(values, dtype=np.float64)
+        values = values[~np.isnan(values)]
+        if (values < 0).any():
+            raise ValueError("QuantileSketch takes the non-negative values only")
+        is_zero = values < self.min_value
+        self.zero_count += int(is_zero.sum())
+        values = np.minimum(values[~is_zero], self.max_value)
+        self.counts += np.bincount(
+            self._get_keys(values) - self.key_min,
+            minlength=len(self.counts),
+        )[: len(self.counts)]
+        return self
+
+    def merge(self, other):
+        """Add the counts of the sketch w/ the same parameters"""
+        if len(self.counts) != len(other.counts) or self.gamma != other.gamma:
+            raise ValueError("The sketches w/ different parameters can't be merged")
+        self.counts += other.counts
+        self.zero_count += other.zero_count
+        return self
+
+    def quantile(self, q):
+        """Get the q-quantile w/ the relative accuracy, NaN for the empty sketch"""
+        if self.count == 0:
+            return np.nan
+        rank = q * (self.count - 1)
+        if rank < self.zero_count:
+            return 0.0
+        i = np.searchsorted(np.cumsum(self.counts), rank - self.zero_count, side="right")
+        key = min(i, len(self.counts) - 1) + self.key_min
+        return 2 * self.gamma**key / (self.gamma + 1)
+
+    def save(self, path):
+        np.savez(
+            path,
+            counts=self.counts,
+            params=[self.relative_accuracy, self.min_value, self.max_value, self.zero_count],
+        )
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as f:
+            relative_accuracy, min_value, max_value, zero_count = f["params"]
+            sketch = cls(relative_accuracy, min_value, max_value)
+            sketch.counts = f["counts"]
+            sketch.zero_count = int(zero_count)
+        return sketch
+
+
+class GroupQuantileSketches:
+    """The QuantileSketch per group kept sparse: the counts of the (group, bin)
+    pairs. The groups are keyed by their values, so the sketches of the periods
+    are merged per group even if the periods have the different groups.
+
+    Args:
+        relative_accuracy (float, optional): Defaults to 0.01.
+        min_value (float, optional): Defaults to 1e-6.
+        max_value (float, optional): Defaults to 1e15.
+            See QuantileSketch for the args.
+    """
+
+    def __init__(self, relative_accuracy=0.01, min_value=1e-6, max_value=1e15):
+        self.layout = QuantileSketch(relative_accuracy, min_value, max_value)
+        self.keys = np.array([], dtype=str)
+        self.groups = np.array([], dtype=np.int64)  # positions of the keys
+        self.bins = np.array([], dtype=np.int64)  # -1 for the zeros
+        self.counts = np.array([], dtype=np.int64)
+
+    def _add(self, keys, groups, bins, counts):
+        """Add the counts of the (group, bin) pairs w/ the groups' positions in keys"""
+        all_keys, inverse = np.unique(np.concatenate([self.keys, keys]), return_inverse=True)
+        groups = inverse[np.concatenate([self.groups, groups + len(self.keys)])]
+        width = len(self.layout.counts) + 1
+        pairs, pairs_inverse = np.unique(
+            groups * width + np.concatenate([self.bins, bins]) + 1,
+            return_inverse=True,
+        )
+        self.counts = np.bincount(
+            pairs_inverse.ravel(),
+            weights=np.concatenate([self.counts, counts]),
+            minlength=len(pairs),
+        ).astype(np.int64)
+        self.keys = all_keys
+        self.groups = pairs // width
+        self.bins = pairs % width - 1
+        return self
+
+    def update(self, values, codes, keys):
+        """Add the values to the sketches of their groups, the NaNs are skipped.
+
+        Args:
+            values (np.array): non-negative values
+            codes (np.array): group's code of each value
+            keys (np.array of str): key of each group's code
+        """
+        values = np.asarray(values, dtype=np.float64)
+        is_valid = ~np.isnan(values)
+        values, codes = values[is_valid], np.asarray(codes)[is_valid]
+        if (values < 0).any():
+            raise ValueError("GroupQuantileSketches takes the non-negative values only")
+        is_zero = values < self.layout.min_value
+        bins = np.full(len(values), -1, dtype=np.int64)
+        bins[~is_zero] = (
+            self.layout._get_keys(np.minimum(values[~is_zero], self.layout.max_value))
+            - self.layout.key_min
+        )
+        counts = np.ones(len(values), dtype=np.int64)
+        return self._add(np.asarray(keys, dtype=str), codes, bins, counts)
+
+    def merge(self, other):
+        """Add the counts of the sketches w/ the same parameters"""
+        if (
+            len(self.layout.counts) != len(other.layout.counts)
+            or self.layout.gamma != other.layout.gamma
+        ):
+            raise ValueError("The sketches w/ different parameters can't be merged")
+        return self._add(other.keys, other.groups, other.bins, other.counts)
+
+    def quantiles(self, q):
+        """Get the q-quantiles of all the groups w/ the relative accuracy
+
+        Returns:
+            tuple : (keys of the groups, quantiles (NaN for the empty group),
+                # of the values in each group)
+        """
+        totals = np.bincount(self.groups, weights=self.counts, minlength=len(self.keys))
+        totals = totals.astype(np.int64)
+        if len(self.counts) == 0:
+            return self.keys, np.full(len(self.keys), np.nan), totals
+        # The pairs are sorted by the groups & bins w/ the zeros first,
+        # so the rank of the group is searched from its offset
+        offsets = np.cumsum(totals) - totals
+        ranks = q * np.maximum(totals - 1, 0)
+        i = np.searchsorted(np.cumsum(self.counts), offsets + ranks, side="right")
+        i = np.minimum(i, len(self.counts) - 1)
+        gamma = self.layout.gamma
+        values = 2 * gamma ** (self.bins[i] + self.layout.key_min) / (gamma + 1)
+        results = np.where(self.bins[i] < 0, 0.0, values)
+        results[totals == 0] = np.nan
+        return self.keys, results, totals
+
+    def save(self, path):
+        layout = self.layout
+        np.savez(
+            path,
+            keys=self.keys,
+            groups=self.groups,
+            bins=self.bins,
+            counts=self.counts,
+            params=[layout.relative_accuracy, layout.min_value, layout.max_value],
+        )
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as f:
+            sketches = cls(*f["params"])
+            sketches.keys = f["keys"]
+            sketches.groups = f["groups"]
+            sketches.bins = f["bins"]
+            sketches.counts = f["counts"]
+        return sketches
+
+
+def _get_group_keys(df, group_cols, rows):
+    """Get the keys of the groups by the values of their rows (NaNs included)"""
+    values = df[group_cols].iloc[rows].astype(object)
+    values = values.where(values.notna(), None)
+    return np.array(
+        [json.dumps(x, default=str) for x in values.itertuples(index=False, name=None)],
+        dtype=str,
+    )
+
+
+def _get_group_sketch_dir(sketch_dir, group_cols):
+    return Path(sketch_dir) / f"groups-{'-'.join(group_cols)}"
+
+
+def _get_sketch(values, chunk_size=1_000_000):
+    """Get the quantile sketch of the values updated by the chunks"""
+    sketch = QuantileSketch()
+    for i in range(0, len(values), chunk_size):
+        sketch.update(values[i : i + chunk_size])
+    return sketch
+
+
+def outliers_update_sketches(
+    df,
+    cols_to_check,
+    sketch_dir,
+    period="all",
+    chunk_size=1_000_000,
+    group_cols=None,
+):
+    """Save the quantile sketches of the columns for the period: the 1st pass
+    of the capping over many periods, see outliers_get_caps().
+    Re-processing of a period replaces its sketch.
+
+    Args:
+        df (Pandas DF): DF w/ the non-negative values
+        cols_to_check (list of str): columns to cap
+        sketch_dir (Path): dir w/ the sketches of the periods
+        period (str, optional): name of the data period. Defaults to "all".
+        chunk_size (int, optional): Defaults to 1_000_000.
+        group_cols (list of str or None, optional): columns of the groups,
+            if given the sketches of the groups are saved as well,
+            see outliers_update_group_sketches(). Defaults to None.
+    """
+    print(f"\nUpdate the sketches of outliers for the period <{period}> ...")
+    Path(sketch_dir).mkdir(parents=True, exist_ok=True)
+    for col in cols_to_check:
+        values = df[col].to_numpy(dtype=np.float64, na_value=np.nan)
+        sketch = _get_sketch(values, chunk_size)
+        sketch.save(Path(sketch_dir) / f"{col}-{period}.npz")
+        print(f"\t{col.upper()}: # {sketch.count:,} values")
+    if group_cols is not None:
+        outliers_update_group_sketches(df, cols_to_check, group_cols, sketch_dir, period)
+
+
+def outliers_update_group_sketches(df, cols_to_check, group_cols, sketch_dir, period="all"):
+    """Save the quantile sketches of the groups for the period into
+    the sub-dir of 'sketch_dir' named by the 'group_cols', w/ the groups
+    keyed by their values. Re-processing of a period replaces its sketches.
+    """
+    print(f"Update the sketches of outliers by the groups {group_cols} ...")
+    dir_groups = _get_group_sketch_dir(sketch_dir, group_cols)
+    dir_groups.mkdir(parents=True, exist_ok=True)
+    codes, first_rows = factorize_rows(df, group_cols)
+    keys = _get_group_keys(df, group_cols, first_rows)
+    for col in cols_to_check:
+        values = df[col].to_numpy(dtype=np.float64, na_value=np.nan)
+        sketches = GroupQuantileSketches().update(values, codes, keys)
+        sketches.save(dir_groups / f"{col}-{period}.npz")
+
+
+def outliers_merge_group_sketches(col, sketch_dir, group_cols):
+    """Merge the sketches of the groups of the column for all the periods saved"""
+    sketches = GroupQuantileSketches()
+    for path in sorted(_get_group_sketch_dir(sketch_dir, group_cols).glob(f"{col}-*.npz")):
+        sketches.merge(GroupQuantileSketches.load(path))
+    return sketches
+
+
+def outliers_merge_sketches(col, sketch_dir):
+    """Merge the sketches of the column for all the periods saved"""
+    sketch = QuantileSketch()
+    for path in sorted(Path(sketch_dir).glob(f"{col}-*.npz")):
+        sketch.merge(QuantileSketch.load(path))
+    return sketch
+
+
+def outliers_get_caps(
+    df,
+    cols_to_check,
+    treshold=0.99,
+    sketch_dir=None,
+    period="all",
+    chunk_size=1_000_000,
+    update_sketches=True,
+):
+    """Get the caps of the outliers from the quantile sketches updated w/ the DF
+    by the chunks. If 'sketch_dir' is given, the caps are got from the merged
+    sketches of all the periods saved there.
+
+    The caps are the same for all the periods only if their sketches are all
+    saved before any capping, in two passes:
+        1st: outliers_update_sketches() for each period,
+        2nd: outliers_get_caps(update_sketches=False) for each period.
+    W/ 'update_sketches' the sketch of the period is saved right before
+    its caps, so the caps cover only the periods processed so far: the periods
+    capped earlier have to be re-run to get the same caps.
+
+    Args:
+        df (Pandas DF): DF w/ the non-negative values
+        cols_to_check (list of str): columns to cap
+        treshold (float, optional): quantile of the cap. Defaults to 0.99.
+        sketch_dir (Path or None, optional): Defaults to None.
+        period (str, optional): name of the data period. Defaults to "all".
+        chunk_size (int, optional): Defaults to 1_000_000.
+        update_sketches (bool, optional): Whether save the sketches of the period
+            first (the one pass). Defaults to True.
+    Raises:
+        FileNotFoundError: w/o 'update_sketches' if the period isn't sketched
+    Returns:
+        dict : {column: cap}
+    """
+    print(f"\nGet the caps of outliers w/ {treshold} quantile treshold...")
+    if sketch_dir is not None and update_sketches:
+        outliers_update_sketches(df, cols_to_check, sketch_dir, period, chunk_size)
+
+    caps = {}
+    for col in cols_to_check:
+        if sketch_dir is None:
+            values = df[col].to_numpy(dtype=np.float64, na_value=np.nan)
+            sketch = _get_sketch(values, chunk_size)
+        elif not (Path(sketch_dir) / f"{col}-{period}.npz").exists():
+            raise FileNotFoundError(
+                f"No sketch of <{col}> for the period <{period}> in {sketch_dir}: "
+                f"save it w/ outliers_update_sketches() first"
+            )
+        else:
+            sketch = outliers_merge_sketches(col, sketch_dir)
+
+        caps[col] = sketch.quantile(treshold)
+        print(f"\t{col.upper()}: cap = {caps[col]} over # {sketch.count:,} values")
+    return caps
+
+
+def outliers_get_group_caps(
+    df,
+    cols_to_check,
+    group_cols,
+    caps_global,
+    treshold=0.99,
+    min_group_size=1000,
+    sketch_dir=None,
+    period="all",
+    update_sketches=True,
+):
+    """Get the caps of the outliers conditional on the groups, e.g. the HS
+    chapter x the container size, broadcast back to the rows by the groups' codes.
+    If 'sketch_dir' is given, the caps are got from the sketches of the groups
+    merged over all the periods saved, so they are the same for all of them
+    as the global caps, see outliers_get_caps() for the passes.
+    Else the caps are the exact quantiles of the groups in the DF only.
+    The groups w/ less than 'min_group_size' values get the global caps.
+
+    Args:
+        df (Pandas DF): DF w/ the values & the groups
+        cols_to_check (list of str): columns to cap
+        group_cols (list of str): columns of the groups (NaNs included)
+        caps_global (dict): {column: global cap} for the sparse groups
+        treshold (float, optional): quantile of the cap. Defaults to 0.99.
+        min_group_size (int, optional): Defaults to 1000.
+        sketch_dir (Path or None, optional): Defaults to None.
+        period (str, optional): name of the data period. Defaults to "all".
+        update_sketches (bool, optional): Whether save the sketches of the period
+            first (the one pass). Defaults to True.
+    Raises:
+        FileNotFoundError: w/o 'update_sketches' if the period isn't sketched
+    Returns:
+        dict : {column: np.array of the caps for each row}
+    """
+    print(f"\nGet the caps of outliers by the groups {group_cols} ...")
+    if len(df) == 0:
+        return caps_global
+    codes, first_rows = factorize_rows(df, group_cols)
+    if sketch_dir is not None:
+        if update_sketches:
+            outliers_update_group_sketches(df, cols_to_check, group_cols, sketch_dir, period)
+        dir_groups = _get_group_sketch_dir(sketch_dir, group_cols)
+        keys = _get_group_keys(df, group_cols, first_rows)
+
+    caps = {}
+    for col in cols_to_check:
+        if sketch_dir is None:
+            values = df[col].to_numpy(dtype=np.float64, na_value=np.nan)
+            caps_group, num_valid = _get_group_quantiles(values, codes, treshold)
+        elif not (dir_groups / f"{col}-{period}.npz").exists():
+            raise FileNotFoundError(
+                f"No sketches of <{col}> by the groups {group_cols} for the period "
+                f"<{period}> in {sketch_dir}: save them w/ outliers_update_sketches() first"
+            )
+        else:
+            sketches = outliers_merge_group_sketches(col, sketch_dir, group_cols)
+            keys_sketch, caps_sketch, counts_sketch = sketches.quantiles(treshold)
+            # The groups missing in the sketches get -1, i.e. the last empty item,
+            # so they are sparse & get the global caps
+            idxs = pd.Index(keys_sketch).get_indexer(keys)
+            caps_group = np.append(caps_sketch, np.nan)[idxs]
+            num_valid = np.append(counts_sketch, 0)[idxs]
+
+        is_sparse = num_valid < min_group_size
+        caps_group[is_sparse] = caps_global[col]
+        diagnostics.count(
+            "outliers",
+            **{
+                f"{col}_groups": len(first_rows),
+                f"{col}_groups_sparse": is_sparse.sum(),
+            },
+        )
+        caps[col] = caps_group[codes]
+    return caps
+
+
+def _get_group_quantiles(values, codes, treshold):
+    """Get the exact quantiles of the groups: the rows are sorted by the groups
+    once and the quantiles of all the groups are got from the segments
+    of the sorted values.
+
+    Returns:
+        tuple : (quantile of each group, # of the not NaN values in each group)
+    """
+    num_groups = codes.max() + 1
+    order = np.argsort(codes, kind="stable")
+    codes_sorted = codes[order]
+    starts = np.searchsorted(codes_sorted, np.arange(num_groups))
+    values = values[order]
+    # Sort the values within the groups: the NaNs go to the segments' ends
+    values = values[np.lexsort((values, codes_sorted))]
+    num_valid = np.bincount(codes_sorted, weights=~np.isnan(values), minlength=num_groups)
+    num_valid = num_valid.astype(np.int64)
+
+    # The linear interpolation as the pd.Series.quantile() does
+    pos = treshold * np.maximum(num_valid - 1, 0)
+    lo = np.floor(pos).astype(np.int64)
+    hi = np.ceil(pos).astype(np.int64)
+    values_lo = values[np.minimum(starts + lo, len(values) - 1)]
+    values_hi = values[np.minimum(starts + hi, len(values) - 1)]
+    return values_lo + (values_hi - values_lo) * (pos - lo), num_valid
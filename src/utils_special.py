@@ -4,24 +4,39 @@
 """
 
 # %% Import needed python libraryies and project config info
+import pickle
+import re
 import sys
 import winsound
 import time
 
 import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
 
 import nltk
+from scipy import sparse
+from scipy.sparse.csgraph import connected_components
+from sklearn.feature_extraction.text import CountVectorizer
+from sklearn.feature_extraction.text import TfidfTransformer
+from sklearn.feature_extraction.text import TfidfVectorizer
+from sklearn.preprocessing import normalize
 from unidecode import unidecode
 from string_grouper import group_similar_strings
+from sparse_dot_topn_for_blocks import awesome_cossim_topn
 
 import multiprocessing as mp
+from functools import lru_cache
+from functools import partial
+from pathlib import Path
 from tqdm import tqdm  # progress bar
 
 # %% Load project's stuff -------------------------------------------------------
 sys.path.extend([".", "./.", "././.", "..", "../..", "../../.."])
 
 from mgbol.utils import timing
+from mgbol.utils import diagnostics
 
 # ------------------------------------------------------------------------------
 # ---------------------- F U Z Z Y   M A T C H I N G ---------------------------
@@ -109,6 +124,85 @@ def do_parallel_works_with_df(df_to_process, func, ncores):
     return df_processed
 
 
+def _apply_to_list(values, func):
+    return [func(x) for x in values]
+
+
+def transform_on_uniques(sr, func, ncores=1, vectorized=False):
+    """Apply the transform to the unique values of the Series only
+    and broadcast the results back to the rows w/ the codes of the values.
+
+    Args:
+        sr (pd.Series): values to transform
+        func (callable): transform of a single value, or if 'vectorized'
+            of the pd.Series of the unique values returning the pd.Series
+            or the DataFrame aligned w/ it. Should be picklable if ncores > 1.
+        ncores (int, optional): number of processes for the single values
+        vectorized (bool, optional): Whether the func takes the Series
+
+    Returns:
+        pd.Series or DataFrame : results aligned w/ the Series, NaN for NaNs
+    """
+    codes, uniques = pd.factorize(sr)
+    uniques = np.asarray(uniques, dtype=object)
+    print(f"\tTransform # {len(uniques):,} unique values of # {len(sr):,} rows ...")
+    if vectorized:
+        results = func(pd.Series(uniques, dtype=object))
+    elif ncores > 1:
+        results = do_parallel_works_with_list(
+            uniques,
+            partial(_apply_to_list, func=func),
+            ncores,
+        )
+    else:
+        results = _apply_to_list(uniques, func)
+    if not isinstance(results, (pd.Series, pd.DataFrame)):
+        results = pd.Series(results, dtype=object)
+    # The code -1 of NaNs isn't in the index, so it gets NaN
+    results = results.reset_index(drop=True).reindex(codes)
+    results.index = sr.index
+    if isinstance(results, pd.Series):
+        results.name = sr.name
+    return results
+
+
+def split_listed_items(sr, sep=","):
+    """Split the strings into the lists of the items: remove the whitespaces,
+    split by 'sep' and keep the unique non empty items in order of appearance.
+    Done w/ the vectorized Arrow kernels over the unique strings only.
+
+    Args:
+        sr (pd.Series): strings w/ the listed items
+        sep (str, optional): separator of the items
+
+    Returns:
+        pa.ListArray : lists aligned w/ the Series, null for NaNs & 'N/A'
+    """
+    codes, uniques = pd.factorize(sr)
+    strings = pa.array(np.asarray(uniques, dtype=object), type=pa.string())
+    strings = pc.replace_substring_regex(strings, pattern=r"\s+", replacement="")
+    lists = pc.split_pattern(strings, pattern=sep)
+
+    # Drop the empty & duplicated items of each list
+    items = pd.DataFrame(
+        {
+            "parent": pc.list_parent_indices(lists).to_numpy(),
+            "item": pc.list_flatten(lists).to_numpy(zero_copy_only=False),
+        }
+    )
+    items = items[items["item"] != ""].drop_duplicates()
+    lengths = np.bincount(items["parent"], minlength=len(strings))
+    offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int32)
+    lists = pa.ListArray.from_arrays(
+        pa.array(offsets),
+        pa.array(items["item"].to_numpy(), type=pa.string()),
+    )
+    # Broadcast to the rows, the code -1 of NaNs & 'N/A' gets null
+    is_na = np.append(np.asarray(uniques, dtype=object) == "N/A", True)
+    codes = np.where(is_na[codes], -1, codes)
+    return lists.take(pa.array(codes, mask=codes < 0))
+
+
 # ------------------------------------------------------------------------------
 # ----------------------- D E D U P L I C A T I O N ----------------------------
 # ------------------------------------------------------------------------------
@@ -259,6 +353,292 @@ LONG_WORDS = {
 }
 
 
+@lru_cache(maxsize=None)
+def get_nltk_stop_words(language="english", upper=False):
+    """Get NLTK stop words as they are or UPPERCASED.
+    Downloads them only if missing"""
+    try:
+        words = nltk.corpus.stopwords.words(language)
+    except LookupError:
+        nltk.download("stopwords", quiet=True)
+        words = nltk.corpus.stopwords.words(language)
+    return frozenset(w.upper() if upper else w for w in words)
+
+
+class CompanyNameNormalizer:
+    """Compiled normalizer for the companies' names.
+    All rules are applied to a name in one pass and only over the unique names:
+        - remove '2+' digits sequences and 'C/O' marks
+        - unify 'SA DE CV', 'LLC', 'USA' and remove parenthesis
+        - unidecode
+        - replace '&' and '+' with AND and remove punctuations
+        - remove stop words & NLTK stop words
+        - replace long words w/ their short forms and mark them in the bitmask
+        - remove extra whitespaces, replace empty strings & UNKNOWN with None
+    The stop words and long words are matched w/ the one compiled alternation each.
+
+    Args:
+        decode (bool, optional): Whether use unidecoding
+        puncts (bool, optional): Whether remove punctuation
+        stop_words (list of strings, optional): Whether remove stop words
+        long_words (dict of strings, optional): Whether replace long words
+        upper_nltk_stop_words (bool, optional): Whether match the UPPERCASED
+            NLTK stop words (AND, THE, OF, S, ...). It changes the grouping,
+            the names are uppercased so the NLTK words as they are
+            don't match them. Defaults to False.
+    """
+
+    RULES = [
+        (re.compile(r"\d{2,}"), " "),
+        (re.compile(r"(C\W{1}O)"), " "),
+        (re.compile(r"(S\W?A\W*DE\W?C\W?V)"), " SA DE CV "),
+        (re.compile(r"(\W+L\W?L\W?C)"), " LLC "),
+        (re.compile(r"(\W+U\W?S\W?A)"), " USA "),
+        (re.compile(r"(\(.*\))"), " "),
+    ]
+    RE_AND = re.compile(r"[&+]")
+    RE_PUNCTS = re.compile(r"[^0-9A-Z]")
+    RE_SPACES = re.compile(r"\s+")
+
+    def __init__(
+        self,
+        decode=True,
+        puncts=True,
+        stop_words=STOP_WORDS,
+        long_words=LONG_WORDS,
+        upper_nltk_stop_words=False,
+    ):
+        self.decode = decode
+        self.puncts = puncts
+
+        self.re_stop_words = None
+        self.nltk_stop_words = frozenset()
+        if stop_words is not None:
+            # Stop words are matched on the whole words after the punctuations
+            words = {self._clean(w) for w in stop_words}
+            words = sorted(filter(None, words), key=len, reverse=True)
+            self.re_stop_words = re.compile(
+                r"\b(?:" + "|".join(map(re.escape, words)) + r")\b"
+            )
+            self.nltk_stop_words = get_nltk_stop_words(upper=upper_nltk_stop_words)
+
+        self.long_words = {} if long_words is None else dict(long_words)
+        if len(self.long_words) > 63:
+            raise ValueError("Bitmask of long words holds up to 63 words")
+        # Bit of each long word in the bitmask is its position in the dict
+        self.long_words_bits = {k: 1 << i for i, k in enumerate(self.long_words)}
+        self.re_long_words = None
+        if self.long_words:
+            # Keep the order of dict: the earlier word wins at the same position
+            self.re_long_words = re.compile("|".join(map(re.escape, self.long_words)))
+
+    def _clean(self, name):
+        if self.puncts:
+            name = self.RE_AND.sub(" AND ", name)
+            name = self.RE_PUNCTS.sub(" ", name)
+        return self.RE_SPACES.sub(" ", name).strip()
+
+    def normalize_one(self, name):
+        """Normalize a name.
+
+        Returns:
+            tuple : (normalized name or None, bitmask of long words were replaced)
+        """
+        for pattern, repl in self.RULES:
+            name = pattern.sub(repl, name)
+        if self.decode:
+            name = unidecode(name)
+        name = self._clean(name)
+
+        if self.re_stop_words is not None:
+            name = self.re_stop_words.sub(" ", name)
+            name = " ".join(w for w in name.split() if w not in self.nltk_stop_words)
+
+        bitmask = 0
+        if self.re_long_words is not None:
+
+            def replace(match):
+                nonlocal bitmask
+                bitmask |= self.long_words_bits[match.group(0)]
+                return self.long_words[match.group(0)]
+
+            name = self.re_long_words.sub(replace, name)
+
+        name = self.RE_SPACES.sub(" ", name).strip()
+        if name in ("", "UNKNOWN"):
+            name = None
+        return name, bitmask
+
+    def normalize_list(self, names):
+        return [self.normalize_one(str(name)) for name in names]
+
+    def normalize(self, sr, ncores=1):
+        """Normalize the Series w/ names over its unique values only.
+
+        Args:
+            sr (pd.Series): names w/o NaNs
+            ncores (int, optional): number of processes for the unique names
+
+        Returns:
+            tuple : (pd.Series of the normalized names,
+                pd.Series of the int64 bitmasks of the long words were replaced)
+        """
+        codes, uniques = pd.factorize(sr)
+        if ncores > 1:
+            results = do_parallel_works_with_list(
+                list(uniques),
+                self.normalize_list,
+                ncores,
+            )
+        else:
+            results = self.normalize_list(uniques)
+        names, bitmasks = zip(*results) if results else ((), ())
+        names = np.array(names, dtype=object)[codes]
+        bitmasks = np.array(bitmasks, dtype=np.int64)[codes]
+        return (
+            pd.Series(names, index=sr.index, name=sr.name),
+            pd.Series(bitmasks, index=sr.index, name=sr.name),
+        )
+
+
+ADDRESS_ABBREVIATIONS = {
+    "APARTMENT": "APT",
+    "AVENIDA": "AV",
+    "AVENUE": "AVE",
+    "BOULEVARD": "BLVD",
+    "BUILDING": "BLDG",
+    "CENTER": "CTR",
+    "CENTRE": "CTR",
+    "COURT": "CT",
+    "DISTRICT": "DIST",
+    "DRIVE": "DR",
+    "EAST": "E",
+    "FLOOR": "FL",
+    "HIGHWAY": "HWY",
+    "INDUSTRIAL": "IND",
+    "LANE": "LN",
+    "NORTH": "N",
+    "NUMBER": "NO",
+    "PARKWAY": "PKWY",
+    "PLACE": "PL",
+    "PROVINCE": "PROV",
+    "ROAD": "RD",
+    "ROOM": "RM",
+    "SOUTH": "S",
+    "SQUARE": "SQ",
+    "STREET": "ST",
+    "SUITE": "STE",
+    "WEST": "W",
+}
+ADDRESS_KEY_NA = 0  # key of the missing address
+
+
+class AddressCanonicalizer:
+    """Canonicalizer of the companies' addresses over the unique values:
+        - UPPER & unidecode
+        - split into the alphanumeric tokens, i.e. drop the punctuations
+        - replace the tokens w/ their abbreviations
+        - join the tokens w/ single spaces, empty strings to None
+    The canonical address is hashed into the compact int64 key, so the main
+    frames carry the keys while the text is kept in the side table.
+
+    Args:
+        decode (bool, optional): Whether use unidecoding
+        abbreviations (dict of strings, optional): tokens to replace
+    """
+
+    RE_TOKENS = re.compile(r"[0-9A-Z]+")
+    TABLE_COLS = ["address_key", "address"]
+
+    def __init__(self, decode=True, abbreviations=ADDRESS_ABBREVIATIONS):
+        self.decode = decode
+        self.abbreviations = {} if abbreviations is None else dict(abbreviations)
+
+    def canonicalize_one(self, address):
+        address = address.upper()
+        if self.decode:
+            address = unidecode(address)
+        tokens = self.RE_TOKENS.findall(address)
+        address = " ".join(self.abbreviations.get(x, x) for x in tokens)
+        return address if address else None
+
+    def canonicalize_list(self, addresses):
+        return [self.canonicalize_one(str(x)) for x in addresses]
+
+    def canonicalize(self, sr, ncores=1):
+        """Canonicalize the Series w/ addresses over its unique values only.
+
+        Args:
+            sr (pd.Series): addresses, NaNs are kept
+            ncores (int, optional): number of processes for the unique addresses
+
+        Returns:
+            pd.Series : canonical addresses
+        """
+        codes, uniques = pd.factorize(sr)
+        if ncores > 1:
+            results = do_parallel_works_with_list(
+                list(uniques),
+                self.canonicalize_list,
+                ncores,
+            )
+        else:
+            results = self.canonicalize_list(uniques)
+        addresses = np.array(list(results) + [None], dtype=object)[codes]
+        return pd.Series(addresses, index=sr.index, name=sr.name)
+
+    @staticmethod
+    def hash_addresses(addresses):
+        """Get int64 keys of the canonical addresses, ADDRESS_KEY_NA for NaNs"""
+        addresses = pd.Series(addresses, dtype=object)
+        keys = np.full(len(addresses), ADDRESS_KEY_NA, dtype=np.int64)
+        notna = addresses.notna().to_numpy()
+        keys[notna] = pd.util.hash_array(
+            addresses[notna].to_numpy(), categorize=False
+        ).view(np.int64)
+        return keys
+
+    def encode(self, sr, ncores=1, canonical=False):
+        """Encode the addresses of the Series into the int64 keys.
+
+        Args:
+            sr (pd.Series): addresses
+            ncores (int, optional): number of processes for the unique addresses
+            canonical (bool, optional): Whether the addresses are canonical already
+
+        Returns:
+            tuple : (pd.Series of the keys,
+                DataFrame side table ['address_key', 'address'] of the unique keys)
+        """
+        if not canonical:
+            sr = self.canonicalize(sr, ncores=ncores)
+        codes, uniques = pd.factorize(sr)
+        keys = self.hash_addresses(uniques)
+        table = pd.DataFrame(
+            {"address_key": keys, "address": np.asarray(uniques, dtype=object)}
+        )
+        keys = np.append(keys, ADDRESS_KEY_NA)[codes]
+        return pd.Series(keys, index=sr.index, name=sr.name), table
+
+    @classmethod
+    def save_table(cls, table, path):
+        """Merge the side table w/ the saved one (if any) and save it"""
+        path = Path(path)
+        if path.exists():
+            table = pd.concat([pd.read_parquet(path), table], ignore_index=True)
+        table = table[cls.TABLE_COLS].drop_duplicates("address_key")
+        path.parent.mkdir(parents=True, exist_ok=True)
+        table.to_parquet(path, index=False)
+        print(f"Saved address table w/ # {len(table):,} addresses into <{path}>")
+
+    @staticmethod
+    def decode_keys(keys, table):
+        """Get the canonical addresses for the keys from the side table"""
+        idxs = pd.Index(table["address_key"]).get_indexer(np.asarray(keys))
+        addresses = np.append(table["address"].to_numpy(dtype=object), None)[idxs]
+        return pd.Series(addresses, index=getattr(keys, "index", None))
+
+
 def preprocess_column_to_group(
     df,
     col,
@@ -266,20 +646,24 @@ def preprocess_column_to_group(
     puncts=True,
     stop_words=STOP_WORDS,
     long_words=LONG_WORDS,
+    ncores=1,
 ):
-    """Do preprocessing for string column before grouping the stings
+    """Do preprocessing for string column before grouping the stings.
+    See CompanyNameNormalizer for the rules applied.
 
     Args:
         df (DataFrame): DataFrame w/ columns to dedupe
         col (string): column's name to dedupe
         decode (bool, optional): Whether use unidecoding
         puncts (bool, optional): Whether remove punctuation
-        spaces (bool, optional): Whether remove extra whitespaces
         stop_words (list of strings, optional): Whether remove stop words
         long_words (dict of strings, optional): Whether replace long words
+        ncores (int, optional): number of processes to normalize unique names
 
     Returns:
-        pd.Series: may be added to DF
+        tuple : (DataFrame w/ the '<col>_processed' column,
+            name of the '<col>_long_words' column w/ bitmasks of replaced long words,
+            name of the processed column)
     """
     print(f"\nDoing < {col.upper()} > columns preprocessing ..................")
     tic = time.time()
@@ -288,82 +672,25 @@ def preprocess_column_to_group(
     print(f"\tUPPERCASE ...")
     df[col] = df[col].str.strip().str.upper()
 
-    # Make a copy
     new = f"{col}_processed"
-    df[new] = df[col].copy()
-
-    # print(f"\tReplace NA's with 'UNKNOWN' ...")
-    # df[new] = df[new].fillna(value="UNKNOWN")
 
     len_before = len(df)
-    df.dropna(subset=[new], inplace=True)
+    df.dropna(subset=[col], inplace=True)
     print(f"\tDropped the NA's before preprocessing: # {len_before-len(df):,}")
 
     len_before = len(df)
     df.drop(labels=df[df[col].str.isdigit()].index, inplace=True)
     print(f"\tDropped the digits: # {len_before-len(df):,}")
 
-    print(f"\tRemove '2+' digits sequences and 'C/O' marks ...")
-    df[new] = df[new].str.replace(r"\d{2,}", " ", regex=True)
-    df[new] = df[new].str.replace(r"(C\W{1}O)", " ", regex=True)
-
-    print(f"\tReplace 'SA.DE.CV' & 'L.L.C' for further processing ...")
-    df[new] = df[new].str.replace(
-        r"(S\W?A\W*DE\W?C\W?V)",
-        " SA DE CV ",
-        regex=True,
+    print(f"\tNormalize names in one pass ...")
+    normalizer = CompanyNameNormalizer(
+        decode=decode,
+        puncts=puncts,
+        stop_words=stop_words,
+        long_words=long_words,
     )
-    df[new] = df[new].str.replace(r"(\W+L\W?L\W?C)", " LLC ", regex=True)
-
-    print(f"\tReplace 'U.S.A' & parenthesis for further processing ...")
-    df[new] = df[new].str.replace(r"(\W+U\W?S\W?A)", " USA ", regex=True)
-    df[new] = df[new].str.replace(r"(\(.*\))", " ", regex=True)
-
-    if decode:
-        print(f"\tUnidecode ...")
-        df[new] = df[new].apply(unidecode)
-
-    if puncts:
-        print(f"\tReplace '&' and '+' with AND ...")
-        df[new] = df[new].str.replace("&", " AND ", regex=False)
-        df[new] = df[new].str.replace("+", " AND ", regex=False)
-        print(f"\tRemove punctuations ...")
-        df[new] = df[new].str.replace(r"[^0-9A-Z]", " ", regex=True)
-
-    print(f"\tRemove extra whitespaces before removing stop words ...")
-    df[new] = df[new].str.replace(r"\s+", " ", regex=True)
-
-    if stop_words is not None:
-        print(f"\tRemove STUB stop words ...")
-        pattern = "|".join(stop_words)
-        df[new] = df[new].str.replace(pattern, " ", regex=False)
-
-        print(f"\tRemove NLTK stop words ...")
-        # Get list of stopwords
-        nltk.download("stopwords")
-        nltk_stop_words = nltk.corpus.stopwords.words("english")
-        # Remove stop words
-        df[new] = df[new].apply(
-            lambda x: " ".join(w for w in x.split() if w not in nltk_stop_words)
-        )
-
-    if long_words is not None:
-        long_words_idxs = {}
-        print(f"\tReplace STUB long words ...")
-        for k, v in long_words.items():
-            # save indecies
-            idxs = df[df[new].str.contains(k)].index.to_list()
-            long_words_idxs[(k, v)] = idxs
-
-            # replace
-            df[new] = df[new].str.replace(k, v)
-
-    print(f"\tRemove extra whitespaces after removing stop words ...")
-    df[new] = df[new].str.replace(r"\s+", " ", regex=True)
-
-    print(f"\tReplace empty strings & UNKNOWN with the None ...")
-    df[new] = df[new].replace(r"^\s*$", None, regex=True)
-    df[new] = df[new].replace("UNKNOWN", None, regex=False)
+    long_words_col_name = f"{col}_long_words"
+    df[new], df[long_words_col_name] = normalizer.normalize(df[col], ncores=ncores)
 
     len_before = len(df)
     df.dropna(subset=[new], inplace=True)
@@ -374,11 +701,364 @@ def preprocess_column_to_group(
     print(f"Preprocessing {timing(tic)}")
     processed_col_name = new
 
-    return df, long_words_idxs, processed_col_name
+    return df, long_words_col_name, processed_col_name
+
+
+def restore_long_words(groups, group_ids, bitmasks, long_words=LONG_WORDS):
+    """Return the long words into the groups' names. A short word is replaced back
+    in the group's name if its long word was replaced for any name in the group.
+
+    Args:
+        groups (pd.Series): groups' names
+        group_ids (pd.Series): groups' identifiers
+        bitmasks (pd.Series): bitmasks of the long words were replaced for names,
+            see CompanyNameNormalizer
+        long_words (dict of strings, optional): the same as used for bitmasks
+
+    Returns:
+        pd.Series : groups' names w/ the long words
+    """
+    # Combine the bitmasks within the groups. The rows w/o group (NaN id)
+    # get the code -1 and keep their own bitmasks
+    codes, _ = pd.factorize(group_ids)
+    bitmasks = bitmasks.to_numpy(dtype=np.int64)
+    group_bitmasks = bitmasks.copy()
+    valid = codes != -1
+    if valid.any():
+        codes_valid = codes[valid]
+        order = np.argsort(codes_valid, kind="stable")
+        codes_sorted = codes_valid[order]
+        starts = np.flatnonzero(np.r_[True, codes_sorted[1:] != codes_sorted[:-1]])
+        group_bitmasks[valid] = np.bitwise_or.reduceat(bitmasks[valid][order], starts)[
+            codes_valid
+        ]
+
+    # Restore words only for the unique pairs of (group, bitmask),
+    # the rows w/o the group's name stay NaN
+    has_group = groups.notna().to_numpy()
+    df_pairs = pd.DataFrame(
+        {"group": groups.to_numpy()[has_group], "bitmask": group_bitmasks[has_group]}
+    )
+    pairs_codes = df_pairs.groupby(["group", "bitmask"], sort=False).ngroup().to_numpy()
+    df_pairs = df_pairs.drop_duplicates()
+
+    words = list(long_words.items())
+
+    def restore(group, bitmask):
+        for i, (k, v) in enumerate(words):
+            if bitmask >> i & 1:
+                group = group.replace(v, k)
+        return group
+
+    restored = [
+        restore(g, m) if m else g for g, m in zip(df_pairs["group"], df_pairs["bitmask"])
+    ]
+    print(f"Groups w/ the long words restored: # {(df_pairs['bitmask'] != 0).sum():,}")
+
+    results = np.full(len(groups), np.nan, dtype=object)
+    results[has_group] = np.array(restored, dtype=object)[pairs_codes]
+    return pd.Series(results, index=groups.index, name=groups.name)
+
+
+def _get_centroid_reps(sims):
+    """Get the representative's position for each string from the sparse matrix
+    of the similarities: groups are the connected components and the centroid
+    is the member w/ the max sum of similarities in the group.
+    """
+    # Each string is similar to itself even w/o n-grams
+    sims = sims.tocsr() + sparse.identity(sims.shape[0], format="csr")
+    _, labels = connected_components(sims, directed=False)
+    weights = np.asarray(sims.sum(axis=1)).ravel()
+    order = np.lexsort((-weights, labels))
+    is_first = np.r_[True, labels[order][1:] != labels[order][:-1]]
+    centroids = np.empty(labels.max() + 1, dtype=np.int64)
+    centroids[labels[order][is_first]] = order[is_first]
+    return centroids[labels]
+
+
+def group_similar_strings_minhash(
+    strings_to_group,
+    ngram_size=3,
+    min_similarity=0.8,
+    num_perm=128,
+    n_bands=32,
+    window=10,
+    seed=42,
+    regex=r"[,-./]|\s",
+):
+    """Group the similar strings w/ MinHash LSH. The candidate pairs come from
+    the LSH buckets of the MinHash signatures of the strings' n-grams, then they
+    are verified w/ the exact cosine similarity of the TF-IDF vectors and the
+    groups are the connected components (centroid is the representative).
+    Memory is linear in the number of strings, unlike the sparse products.
+
+    Args:
+        strings_to_group (pd.Series): strings w/o NaNs
+        ngram_size (int, optional): The amount of characters in each n-gram.
+        min_similarity (float, optional): The minimum cosine similarity
+            for two strings to be considered a match.
+        num_perm (int, optional): number of hash functions for the signatures
+        n_bands (int, optional): number of LSH bands, 'num_perm' must divide by it.
+            More bands find more candidates w/ lower similarity.
+        window (int, optional): each string in a bucket is paired w/ the next
+            'window' strings in it, to bound the pairs in the big buckets.
+        seed (int, optional): seed for the hash functions
+        regex (str, optional): regex to cleanup the strings before n-gramming
+
+    Returns:
+        DataFrame : ['group_rep_index', 'group_rep'] aligned w/ the strings,
+            the same as 'group_similar_strings' returns
+    """
+    if num_perm % n_bands != 0:
+        raise ValueError(f"num_perm={num_perm} must be divisible by n_bands={n_bands}")
+    sr = strings_to_group
+    codes, uniques = pd.factorize(sr)
+    strings = [re.sub(regex, "", x) for x in uniques]
+
+    counts = CountVectorizer(
+        analyzer="char",
+        ngram_range=(ngram_size, ngram_size),
+        lowercase=False,
+        dtype=np.float32,
+    ).fit_transform(strings)
+    counts = counts.tocsr()
+    counts.sort_indices()
+    X = TfidfTransformer().fit_transform(counts).tocsr()
+
+    # MinHash signatures: min of the universal hashes (a*x + b) mod p over n-grams
+    prime = np.uint64((1 << 31) - 1)
+    rng = np.random.RandomState(seed)
+    a = rng.randint(1, prime, size=num_perm).astype(np.uint64)
+    b = rng.randint(0, prime, size=num_perm).astype(np.uint64)
+    has_ngrams = np.diff(counts.indptr) > 0
+    starts = counts.indptr[:-1][has_ngrams]
+    ngrams = counts.indices.astype(np.uint64)
+    signatures = np.empty((has_ngrams.sum(), num_perm), dtype=np.uint64)
+    for i in range(num_perm):
+        signatures[:, i] = np.minimum.reduceat((a[i] * ngrams + b[i]) % prime, starts)
+    rows = np.flatnonzero(has_ngrams)
+
+    # Candidate pairs: the neighbours w/in the same bucket of any band
+    pairs = []
+    r = num_perm // n_bands
+    for band in range(n_bands):
+        # Hash the band's rows of the signature into one key
+        band_keys = np.zeros(len(signatures), dtype=np.uint64)
+        for j in range(band * r, (band + 1) * r):
+            band_keys = band_keys * np.uint64(1_000_003) ^ signatures[:, j]
+        order = np.argsort(band_keys, kind="stable")
+        keys_sorted = band_keys[order]
+        for d in range(1, window + 1):
+            same = keys_sorted[d:] == keys_sorted[:-d]
+            pairs.append(np.column_stack([order[:-d][same], order[d:][same]]))
+    pairs = np.unique(np.concatenate(pairs), axis=0) if pairs else np.empty((0, 2), int)
+    pairs = rows[pairs]
+
+    # Verify the candidates w/ the exact similarity
+    sims = np.asarray(X[pairs[:, 0]].multiply(X[pairs[:, 1]]).sum(axis=1)).ravel()
+    matched = sims >= min_similarity
+    sims = sparse.csr_matrix(
+        (sims[matched], (pairs[matched, 0], pairs[matched, 1])),
+        shape=(len(strings), len(strings)),
+    )
+    reps = _get_centroid_reps(sims + sims.T)
+    print(f"\tMinHash LSH candidates: # {len(pairs):,}, matched: # {matched.sum():,}")
+
+    groups = _get_groups_frame(sr, codes, uniques, reps)
+    groups.columns = ["group_rep_index", "group_rep"]
+    return groups
+
+
+INT32_MAX = 2**31 - 1  # sparse_dot_topn overflows beyond it
+
+
+def plan_grouping_memory(
+    strings,
+    n_gram,
+    min_similarity,
+    ram_budget_gb,
+    max_n_matches=None,
+    sample_size=2_000,
+    seed=42,
+):
+    """Estimate the memory of grouping the strings before it starts and pick
+    the block layout for the RAM budget.
+
+    The rates of the candidates (pairs w/ any common n-gram) and the matches
+    (pairs w/ similarity >= 'min_similarity') are measured on a random sample
+    and scaled to all pairs. Then:
+        TF-IDF matrices: 2 copies x (nnz x 8 bytes + rows x 4 bytes)
+        string_grouper output: matches x 36 bytes (top-n CSR + matches list),
+            per block pair: its matches x 12 bytes + dense accumulators
+        cascade: per chunk of rows the top-n buffers of max_n_matches x 8 bytes
+            per row + dense accumulators
+    The sample's self-similarities are dropped from the rates and each string
+    gets exactly 1 self-match on top.
+
+    Args:
+        strings (array of str): unique strings to group
+        n_gram (int): n-gram size (the smallest one for the cascade)
+        min_similarity (float): The minimum cosine similarity
+        ram_budget_gb (float): RAM budget for the grouping in GB
+        max_n_matches (int or None, optional): max matches per row (incl. itself)
+        sample_size (int, optional): strings to sample for the rates
+        seed (int, optional): random seed of the sample
+
+    Raises:
+        MemoryError: if even the block independent part exceeds the budget
+
+    Returns:
+        dict : estimates in bytes w/ 'n_blocks' for string_grouper
+            and 'chunk_size' for the NgramCascadeGrouper
+    """
+    strings = np.asarray(strings, dtype=object)
+    n = len(strings)
+    budget = ram_budget_gb * 1024**3
+
+    rng = np.random.default_rng(seed)
+    sample = strings[rng.choice(n, size=min(n, sample_size), replace=False)]
+    X = TfidfVectorizer(
+        analyzer="char",
+        ngram_range=(n_gram, n_gram),
+        lowercase=False,
+        dtype=np.float32,
+    ).fit_transform(sample.tolist())
+    sims = (X @ X.T).tocsr()
+    sims.setdiag(0)
+    sims.eliminate_zeros()
+    m = len(sample)
+    n_pairs = max(m * (m - 1), 1)
+    candidates_rate = sims.nnz / n_pairs
+    matches_rate = float((sims.data >= min_similarity).sum()) / n_pairs
+
+    nnz_per_row = X.nnz / m
+    matches_per_row = 1.0 + matches_rate * (n - 1)
+    if max_n_matches is not None:
+        matches_per_row = min(matches_per_row, max_n_matches)
+    matches = n * matches_per_row
+    candidates_per_row = 1.0 + candidates_rate * (n - 1)
+
+    bytes_matrices = 2 * (n * nnz_per_row * 8 + (n + 1) * 4)
+    bytes_output = matches * 36
+    available = budget - bytes_matrices - bytes_output
+    if available <= 0:
+        raise MemoryError(
+            f"Grouping of # {n:,} strings needs at least "
+            f"{(bytes_matrices + bytes_output) / 1024**3:.2f} GB "
+            f"but RAM budget is {ram_budget_gb:.2f} GB"
+        )
+
+    # string_grouper: split the right operand by its empirical rule for speed
+    # and the left one as much as needed for the budget & int32 overflow
+    n_right = max(1, round(n / 8e4))
+    right_rows = int(np.ceil(n / n_right))
+    bytes_accum = right_rows * 12
+    n_left = int(
+        max(
+            1,
+            np.ceil(matches * 12 / (n_right * max(available - bytes_accum, 1))),
+            np.ceil(matches / (n_right * INT32_MAX)),
+        )
+    )
+    n_left = min(n_left, n)
+    bytes_block = matches / (n_left * n_right) * 12 + bytes_accum
+
+    # NgramCascadeGrouper: rows per top-n product of the similarities,
+    # the kernel preallocates its buffers for all 'ntop' values of the rows
+    ntop = n if max_n_matches is None else min(max_n_matches, n)
+    bytes_accum = n * 12
+    chunk_size = int(np.clip((available - bytes_accum) / (ntop * 8 + 4), 1, n))
+    bytes_chunk = chunk_size * (ntop * 8 + 4) + bytes_accum
+
+    return {
+        "n_strings": n,
+        "candidates_per_row": candidates_per_row,
+        "matches_per_row": matches_per_row,
+        "bytes_matrices": bytes_matrices,
+        "bytes_output": bytes_output,
+        "bytes_block": bytes_block,
+        "bytes_chunk": bytes_chunk,
+        "n_blocks": (n_left, n_right),
+        "chunk_size": chunk_size,
+    }
+
+
+def print_memory_plan(plan, engine="string_grouper"):
+    bytes_step = plan["bytes_block"] if engine == "string_grouper" else plan["bytes_chunk"]
+    estimate = plan["bytes_matrices"] + plan["bytes_output"] + bytes_step
+    print(f"\tMemory plan for # {plan['n_strings']:,} strings:")
+    print(f"\t\tmatches per row: ~{plan['matches_per_row']:,.1f}")
+    print(f"\t\tcandidates per row: ~{plan['candidates_per_row']:,.1f}")
+    if engine == "string_grouper":
+        print(f"\t\tn_blocks: {plan['n_blocks']}")
+    else:
+        print(f"\t\tchunk_size: {plan['chunk_size']:,}")
+    print(f"\t\testimated peak: {estimate / 1024**3:.3f} GB")
+    return estimate
 
 
-def do_ngram_grouping(df, n_gram, min_similarity, col_name=None, **kwargs):
+def print_memory_measured(estimate, peak, stage="memory", name="grouping"):
+    """Print & log the estimated memory against the measured peak RSS"""
+    print(
+        f"\tMemory estimated: {estimate / 1024**3:.3f} GB, "
+        f"process peak RSS: {peak / 1024**3:.3f} GB ({peak / max(estimate, 1):.0%})"
+    )
+    diagnostics.count(
+        stage,
+        **{f"{name}_bytes_estimated": estimate, f"{name}_peak_rss_bytes": peak},
+    )
+
+
+def get_peak_rss():
+    """Peak resident set size of the process in bytes: the max RSS on POSIX,
+    the peak working set on Windows (w/ psutil)"""
+    if sys.platform == "win32":
+        import psutil
+
+        return psutil.Process().memory_info().peak_wset
+    import resource
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # In KB on Linux and in bytes on macOS
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def measure_peak_memory(func, *args, **kwargs):
+    """Call the func and get the peak RSS of the process after it. All memory
+    counts (the C++ buffers of sparse_dot_topn too) at no cost, but the peak
+    is over the process' lifetime, i.e. the memory held before the call as well.
+    In the workers of handle_companies() the process is the worker.
+
+    Returns:
+        tuple : (func's result, peak in bytes)
     """
+    result = func(*args, **kwargs)
+    return result, get_peak_rss()
+
+
+def do_ngram_grouping(
+    df,
+    n_gram,
+    min_similarity,
+    col_name=None,
+    engine="string_grouper",
+    ram_budget_gb=None,
+    measure_memory=True,
+    **kwargs,
+):
+    """
+    engine: str.
+        'string_grouper' - cosine TF-IDF grouping w/ the group_similar_strings()
+        'minhash' - MinHash LSH grouping w/ the group_similar_strings_minhash()
+            for the very large sets of strings, kwargs go to it then.
+    ram_budget_gb: float or None.
+        If given for 'string_grouper' the n_blocks are picked by the
+        plan_grouping_memory() before grouping.
+    measure_memory: bool.
+        If True w/ 'ram_budget_gb' the estimated memory is logged against
+        the process peak RSS, see measure_peak_memory().
+        Default is True.
+
     For the group_similar_strings():
         :param ngram_size: int.
             The amount of characters in each n-gram.
@@ -425,19 +1105,395 @@ def do_ngram_grouping(df, n_gram, min_similarity, col_name=None, **kwargs):
     tic = time.time()
     print(f"\nStart grouping entities w/ NGRAM = {n_gram} ----------------")
     cols_added = [f"group_id_{n_gram}ng", f"group_{n_gram}ng"]
-    df[cols_added] = group_similar_strings(
-        strings_to_group=df[col_name],
-        ngram_size=n_gram,
+    if engine == "minhash":
+        df[cols_added] = group_similar_strings_minhash(
+            strings_to_group=df[col_name],
+            ngram_size=n_gram,
+            min_similarity=min_similarity,
+            **kwargs,
+        ).to_numpy()
+    elif engine == "string_grouper":
+        if ram_budget_gb is None:
+            df[cols_added] = group_similar_strings(
+                strings_to_group=df[col_name],
+                ngram_size=n_gram,
+                min_similarity=min_similarity,
+                group_rep="centroid",
+                **kwargs,
+            )
+        else:
+            plan = plan_grouping_memory(
+                df[col_name].unique(),
+                n_gram=n_gram,
+                min_similarity=min_similarity,
+                ram_budget_gb=ram_budget_gb,
+                max_n_matches=kwargs.get("max_n_matches"),
+            )
+            estimate = print_memory_plan(plan, engine)
+            kwargs["n_blocks"] = plan["n_blocks"]
+            func = partial(
+                group_similar_strings,
+                strings_to_group=df[col_name],
+                ngram_size=n_gram,
+                min_similarity=min_similarity,
+                group_rep="centroid",
+                **kwargs,
+            )
+            if measure_memory:
+                df[cols_added], peak = measure_peak_memory(func)
+                print_memory_measured(estimate, peak, name=f"{col_name}_{n_gram}ng")
+            else:
+                df[cols_added] = func()
+    else:
+        raise ValueError(f"Unknown grouping engine: {engine}")
+    print(f"\nNGRAM = {n_gram} grouping {timing(tic)} ...")
+    winsound.Beep(frequency=2000, duration=200)
+
+    return df, cols_added
+
+
+class NgramCascadeGrouper:
+    """Groups the similar strings in the cascade of passes w/ decreasing n-grams.
+    Each pass works only on the unique representatives of the previous pass
+    and its groups are connected components of the pairs w/ cosine similarity
+    of the TF-IDF vectors >= 'min_similarity', and the representative is the
+    centroid, i.e. the member w/ the max sum of similarities (as in string_grouper).
+    The n-gram counts are cached per n-gram size: the next pass w/ the same size
+    only slices the rows of the cached matrix and refits IDF on them.
+
+    Args:
+        n_grams (list of int, optional): n-gram sizes of the passes
+        min_similarity (float, optional): The minimum cosine similarity
+            for two strings to be considered a match.
+        chunk_size (int, optional): rows per sparse product of the similarities
+        max_n_matches (int, optional): max matches kept per string (incl. itself),
+            so the product of the chunk holds <= chunk_size * max_n_matches values
+        regex (str, optional): regex to cleanup the strings before n-gramming
+    """
+
+    def __init__(
+        self,
+        n_grams=(6, 5, 4, 3, 3),
+        min_similarity=0.8,
+        chunk_size=50_000,
+        max_n_matches=20,  # as string_grouper
+        regex=r"[,-./]|\s",
+    ):
+        self.n_grams = list(n_grams)
+        self.min_similarity = min_similarity
+        self.chunk_size = chunk_size
+        self.max_n_matches = max_n_matches
+        self.regex = re.compile(regex)
+        self._counts = {}  # n-gram size -> (rows of strings, counts matrix)
+
+    def _get_tfidf(self, strings, n_gram):
+        rows, counts = self._counts.get(n_gram, (None, None))
+        if rows is not None and all(x in rows for x in strings):
+            counts = counts[[rows[x] for x in strings]]
+        else:
+            counts = CountVectorizer(
+                analyzer="char",
+                ngram_range=(n_gram, n_gram),
+                lowercase=False,
+                dtype=np.float32,
+            ).fit_transform([self.regex.sub("", x) for x in strings])
+            self._counts[n_gram] = ({x: i for i, x in enumerate(strings)}, counts)
+        return TfidfTransformer().fit_transform(counts)
+
+    def _group_pass(self, strings, n_gram):
+        """Get the position of the representative for each of the unique strings"""
+        X = self._get_tfidf(strings, n_gram).astype(np.float32).tocsr()
+        XT = X.T.tocsr()
+        # The top-n kernel keeps only the values > lower_bound, i.e. >= min_similarity
+        lower_bound = np.nextafter(np.float32(self.min_similarity), np.float32(0))
+        chunks = []
+        for start in range(0, X.shape[0], self.chunk_size):
+            A = X[start : start + self.chunk_size]
+            sims = awesome_cossim_topn(
+                A,
+                XT,
+                ntop=self.max_n_matches,
+                row_ntop_array=np.zeros(A.shape[0], dtype=np.int32),
+                lower_bound=lower_bound,
+            )
+            chunks.append(sims)
+        return _get_centroid_reps(sparse.vstack(chunks).tocsr())
+
+    def group_uniques(self, strings, verbose=True):
+        """Get the position of the final representative for each unique string"""
+        strings = np.asarray(strings, dtype=object)
+        reps = np.arange(len(strings))
+        for n_gram in self.n_grams:
+            tic = time.time()
+            # Work only on the current unique representatives
+            current, inverse = np.unique(reps, return_inverse=True)
+            pass_reps = self._group_pass(strings[current].tolist(), n_gram)
+            reps = current[pass_reps][inverse]
+            if verbose:
+                print(
+                    f"NGRAM = {n_gram}: # {len(current):,} -> # {len(np.unique(reps)):,} "
+                    f"groups {timing(tic)}"
+                )
+        return reps
+
+    def group(self, sr):
+        """Group the strings of the Series.
+
+        Args:
+            sr (pd.Series): strings w/o NaNs
+
+        Returns:
+            DataFrame : ['group_id', 'group'] aligned w/ the strings, where
+                'group_id' is the index of the first row w/ the group's string
+        """
+        codes, uniques = pd.factorize(sr)
+        reps = self.group_uniques(uniques)
+        return _get_groups_frame(sr, codes, uniques, reps)
+
+
+def _get_groups_frame(sr, codes, uniques, reps):
+    """Broadcast the representatives of the unique strings to the rows of Series"""
+    strings = np.asarray(uniques, dtype=object)
+    # Index of the first row for each unique string
+    first_rows = sr.index.to_numpy()[np.unique(codes, return_index=True)[1]]
+    return pd.DataFrame(
+        {
+            "group_id": first_rows[reps][codes].astype(np.int64),
+            "group": strings[reps][codes],
+        },
+        index=sr.index,
+    )
+
+
+def do_ngram_cascade_grouping(
+    df,
+    n_grams,
+    min_similarity,
+    col_name,
+    chunk_size=50_000,
+    ram_budget_gb=None,
+    max_n_matches=20,
+    measure_memory=True,
+    **kwargs,
+):
+    """Group the strings w/ the NgramCascadeGrouper.
+    If 'ram_budget_gb' is given the chunk_size is picked by the
+    plan_grouping_memory() for the smallest n-gram before grouping,
+    and w/ 'measure_memory' the estimated memory is logged against
+    the process peak RSS, see measure_peak_memory().
+    The other kwargs of the group_similar_strings() (e.g. 'n_blocks')
+    are not applicable for the cascade and raise the TypeError.
+
+    Returns:
+        tuple : (DataFrame w/ the added columns, names of the added columns:
+            ['group_id_<n>ng', 'group_<n>ng'] for the last n-gram size)
+    """
+    if kwargs:
+        raise TypeError(f"Not applicable for the cascade grouping: {sorted(kwargs)}")
+
+    tic = time.time()
+    print(f"\nStart cascade grouping entities w/ NGRAMS = {n_grams} ----------")
+    cols_added = [f"group_id_{n_grams[-1]}ng", f"group_{n_grams[-1]}ng"]
+    grouper = NgramCascadeGrouper(
+        n_grams=n_grams,
         min_similarity=min_similarity,
-        group_rep="centroid",
-        **kwargs,
+        chunk_size=chunk_size,
+        max_n_matches=max_n_matches,
     )
-    print(f"\nNGRAM = {n_gram} grouping {timing(tic)} ...")
+    if ram_budget_gb is None:
+        groups = grouper.group(df[col_name])
+    else:
+        plan = plan_grouping_memory(
+            df[col_name].unique(),
+            n_gram=min(n_grams),
+            min_similarity=min_similarity,
+            ram_budget_gb=ram_budget_gb,
+            max_n_matches=max_n_matches,
+        )
+        estimate = print_memory_plan(plan, engine="cascade")
+        grouper.chunk_size = plan["chunk_size"]
+        if measure_memory:
+            groups, peak = measure_peak_memory(grouper.group, df[col_name])
+            print_memory_measured(estimate, peak, name=f"{col_name}_cascade")
+        else:
+            groups = grouper.group(df[col_name])
+    # Column by column to keep the int64 'group_id'
+    for col, col_groups in zip(cols_added, ["group_id", "group"]):
+        df[col] = groups[col_groups]
+    print(f"\nNGRAMS = {n_grams} cascade grouping {timing(tic)} ...")
     winsound.Beep(frequency=2000, duration=200)
 
     return df, cols_added
 
 
+def get_blocks_by_rare_tokens(strings, n_rare_tokens=2, max_freq=None):
+    """Put each string into the blocks of its 'n_rare_tokens' rarest tokens.
+    The strings w/ the same rare token get into the same block, and w/
+    n_rare_tokens > 1 the blocks overlap, so the matches are found across them.
+
+    Args:
+        strings (array of str): unique strings
+        n_rare_tokens (int, optional): number of blocks per string
+        max_freq (int or None, optional): the tokens in more strings are skipped
+
+    Returns:
+        list of numpy arrays : positions of the strings in each block
+    """
+    tokens = pd.Series(strings, dtype=object).str.split().explode().dropna()
+    df_tokens = pd.DataFrame({"pos": tokens.index, "token": tokens.to_numpy()})
+    df_tokens = df_tokens.drop_duplicates()
+    df_tokens["freq"] = df_tokens["token"].map(df_tokens["token"].value_counts())
+    if max_freq is not None:
+        df_tokens = df_tokens[df_tokens["freq"] <= max_freq]
+    df_tokens = (
+        df_tokens.sort_values(["pos", "freq", "token"])
+        .groupby("pos", sort=False)
+        .head(n_rare_tokens)
+    )
+    blocks = df_tokens.groupby("token", sort=False)["pos"].apply(np.asarray)
+    # The strings w/o tokens make the block on their own
+    no_tokens = np.setdiff1d(np.arange(len(strings)), df_tokens["pos"].to_numpy())
+    return [x for x in blocks.to_list() + [no_tokens] if len(x) > 0]
+
+
+def _split_oversized_blocks(strings, blocks, max_task_size, n_rare_tokens=2):
+    """Split the blocks larger than 'max_task_size' by the further rare tokens.
+    The strings of the block are re-blocked on their rarest tokens within it,
+    skipping the tokens shared by all of them (e.g. the block's own token).
+    The blocks which do not shrink this way, e.g. the same tokens in all strings,
+    are chunked w/ the half-chunk overlap, so the groups connect across them.
+    """
+    results = []
+    stack = list(blocks)
+    while stack:
+        block = stack.pop()
+        if len(block) <= max_task_size:
+            results.append(block)
+            continue
+        sub_blocks = get_blocks_by_rare_tokens(
+            strings[block],
+            n_rare_tokens=n_rare_tokens,
+            max_freq=len(block) - 1,
+        )
+        if max(len(x) for x in sub_blocks) < len(block):
+            stack.extend(block[x] for x in sub_blocks)
+        else:
+            step = max(max_task_size // 2, 1)
+            results.extend(
+                block[start : start + max_task_size]
+                for start in range(0, len(block) - step, step)
+            )
+    return results
+
+
+def _pack_blocks(blocks, max_task_size):
+    """Pack the blocks greedily into the tasks up to 'max_task_size' strings.
+    The singleton blocks are skipped: nothing to group there.
+    """
+    tasks, task, size = [], [], 0
+    for block in sorted(blocks, key=len, reverse=True):
+        if len(block) < 2:
+            continue
+        if task and size + len(block) > max_task_size:
+            tasks.append(np.unique(np.concatenate(task)))
+            task, size = [], 0
+        task.append(block)
+        size += len(block)
+    if task:
+        tasks.append(np.unique(np.concatenate(task)))
+    return tasks
+
+
+def _group_task(strings, n_grams, min_similarity, chunk_size, max_n_matches):
+    grouper = NgramCascadeGrouper(
+        n_grams=n_grams,
+        min_similarity=min_similarity,
+        chunk_size=chunk_size,
+        max_n_matches=max_n_matches,
+    )
+    return grouper.group_uniques(strings, verbose=False)
+
+
+def do_blocked_grouping(
+    sr,
+    n_grams=(6, 5, 4, 3, 3),
+    min_similarity=0.8,
+    ncores=None,
+    n_rare_tokens=2,
+    max_task_size=200_000,
+    chunk_size=50_000,
+    max_n_matches=20,
+):
+    """Group the strings by blocks in the process pool.
+    The unique strings are partitioned into the overlapping blocks by their rare
+    tokens, the blocks over 'max_task_size' are split further by the rare tokens
+    within them, the blocks are packed into the tasks of bounded size and each task
+    is grouped w/ the NgramCascadeGrouper in the separate process.
+    The groups from different tasks are reconciled by the union-find over
+    the (string, representative) links, i.e. the connected components.
+
+    Args:
+        sr (pd.Series): strings w/o NaNs
+        n_grams (list of int, optional): n-gram sizes of the cascade passes
+        min_similarity (float, optional): The minimum cosine similarity
+        ncores (int, optional): number of processes. Defaults to all cores.
+        n_rare_tokens (int, optional): number of blocks per string
+        max_task_size (int, optional): max number of strings per task
+        chunk_size (int, optional): rows per sparse product of the similarities
+        max_n_matches (int, optional): max matches kept per string
+
+    Returns:
+        DataFrame : ['group_id', 'group'] aligned w/ the strings
+    """
+    tic = time.time()
+    ncores = mp.cpu_count() if ncores is None else ncores
+    codes, uniques = pd.factorize(sr)
+    strings = np.asarray(uniques, dtype=object)
+
+    blocks = get_blocks_by_rare_tokens(strings, n_rare_tokens=n_rare_tokens)
+    blocks = _split_oversized_blocks(strings, blocks, max_task_size, n_rare_tokens)
+    tasks = _pack_blocks(blocks, max_task_size)
+    print(f"Unique strings: # {len(strings):,}")
+    print(f"\tBlocks: # {len(blocks):,}, tasks: # {len(tasks):,} on # {ncores} cores")
+
+    group_task_partial = partial(
+        _group_task,
+        n_grams=list(n_grams),
+        min_similarity=min_similarity,
+        chunk_size=chunk_size,
+        max_n_matches=max_n_matches,
+    )
+    pool = mp.Pool(ncores)
+    tasks_reps = pool.map(group_task_partial, [strings[x].tolist() for x in tasks])
+    pool.close()  # close out processes
+    pool.join()  # join processes
+
+    # Union-find over the links: string -> its representative in the task
+    links_from = np.concatenate([np.arange(len(strings))] + tasks)
+    links_to = np.concatenate(
+        [np.arange(len(strings))] + [x[reps] for x, reps in zip(tasks, tasks_reps)]
+    )
+    graph = sparse.csr_matrix(
+        (np.ones(len(links_from), dtype=np.int8), (links_from, links_to)),
+        shape=(len(strings), len(strings)),
+    )
+    _, labels = connected_components(graph, directed=False)
+
+    # The representative of the merged group is the most often chosen one
+    df_links = pd.DataFrame({"label": labels[links_to], "rep": links_to})
+    rep_counts = df_links.value_counts(["label", "rep"]).reset_index(name="count")
+    rep_counts = rep_counts.sort_values(
+        ["label", "count", "rep"],
+        ascending=[True, False, True],
+    )
+    label_reps = rep_counts.drop_duplicates("label").set_index("label")["rep"]
+    reps = label_reps.reindex(np.arange(labels.max() + 1)).to_numpy()[labels]
+
+    print(f"\tGroups: # {len(np.unique(reps)):,}")
+    print(f"Blocked grouping {timing(tic)}")
+    return _get_groups_frame(sr, codes, uniques, reps)
+
+
 def drop_mismatches_id_name(df, col_id, col_name):
     """Find out and drop the inconsistent data when the same 'identifier'
         have a 2 or more different entities, e.x. Consignee_name
@@ -472,3 +1528,510 @@ def drop_mismatches_id_name(df, col_id, col_name):
     df.drop(index=idxs_drop, inplace=True)
 
     return df
+
+
+# ------------------------------------------------------------------------------
+# ---------------------- E N T I T Y   R E G I S T R Y -------------------------
+# ------------------------------------------------------------------------------
+class EntityRegistry:
+    """Persistent registry of the canonical entities (groups of names).
+    Keeps for each group its stable ID, representative name and the sum of
+    the TF-IDF vectors of its names (i.e. centroid). The new names are matched
+    only against the groups' centroids, the names w/o close enough group are
+    grouped among themselves w/ 'group_similar_strings' into the new groups.
+    The vocabulary & IDF are fitted on the first batch of names and then frozen.
+
+    Args:
+        ngram_size (int, optional): The amount of characters in each n-gram.
+        min_similarity (float, optional): The minimum cosine similarity
+            for a name to be matched with a group.
+    """
+
+    FILES = {
+        "groups": "groups.parquet",
+        "members": "members.parquet",
+        "centroids": "centroids.npz",
+        "vectorizer": "vectorizer.pkl",
+    }
+
+    def __init__(self, ngram_size=3, min_similarity=0.8):
+        self.ngram_size = ngram_size
+        self.min_similarity = min_similarity
+        self.vectorizer = None
+        self.groups = pd.DataFrame(
+            {
+                "group_id": pd.Series(dtype=np.int64),
+                "group": pd.Series(dtype=object),
+                "count": pd.Series(dtype=np.int64),
+            }
+        )
+        self.members = {}  # name -> group_id
+        self.centroids = None  # sums of TF-IDF vectors, row per group_id
+
+    def __len__(self):
+        return len(self.groups)
+
+    @classmethod
+    def load(cls, path):
+        path = Path(path)
+        with open(path / cls.FILES["vectorizer"], "rb") as f:
+            params, vectorizer = pickle.load(f)
+        registry = cls(**params)
+        registry.vectorizer = vectorizer
+        registry.groups = pd.read_parquet(path / cls.FILES["groups"])
+        members = pd.read_parquet(path / cls.FILES["members"])
+        registry.members = dict(zip(members["name"], members["group_id"]))
+        registry.centroids = sparse.load_npz(path / cls.FILES["centroids"]).tocsr()
+        print(f"Loaded entity registry w/ # {len(registry):,} groups from <{path}>")
+        return registry
+
+    def save(self, path):
+        path = Path(path)
+        path.mkdir(parents=True, exist_ok=True)
+        with open(path / self.FILES["vectorizer"], "wb") as f:
+            params = {
+                "ngram_size": self.ngram_size,
+                "min_similarity": self.min_similarity,
+            }
+            pickle.dump((params, self.vectorizer), f)
+        self.groups.to_parquet(path / self.FILES["groups"], index=False)
+        pd.DataFrame(
+            {
+                "name": list(self.members.keys()),
+                "group_id": np.fromiter(self.members.values(), dtype=np.int64),
+            }
+        ).to_parquet(path / self.FILES["members"], index=False)
+        sparse.save_npz(path / self.FILES["centroids"], self.centroids)
+        print(f"Saved entity registry w/ # {len(self):,} groups into <{path}>")
+
+    def _match_centroids(self, X, chunk_size):
+        """Get the closest group and its similarity for each row of X:
+        -1 & 0 for the rows w/o the group of the min_similarity at least"""
+        X = X.astype(np.float32).tocsr()
+        C = normalize(self.centroids).astype(np.float32).T.tocsr()
+        # The top-n kernel keeps only the values > lower_bound, i.e. >= min_similarity
+        lower_bound = np.nextafter(np.float32(self.min_similarity), np.float32(0))
+        best_idxs = np.full(X.shape[0], -1, dtype=np.int64)
+        best_sims = np.zeros(X.shape[0])
+        for start in range(0, X.shape[0], chunk_size):
+            A = X[start : start + chunk_size]
+            sims = awesome_cossim_topn(
+                A,
+                C,
+                ntop=1,
+                row_ntop_array=np.zeros(A.shape[0], dtype=np.int32),
+                lower_bound=lower_bound,
+            )
+            rows = start + np.flatnonzero(np.diff(sims.indptr))
+            best_idxs[rows] = sims.indices
+            best_sims[rows] = sims.data
+        return best_idxs, best_sims
+
+    def resolve(self, names, chunk_size=100_000, **kwargs):
+        """Get the groups for the names and register the new names.
+
+        Args:
+            names (pd.Series): preprocessed names w/o NaNs
+            chunk_size (int, optional): rows of the new names per sparse product
+            **kwargs: kwargs for 'group_similar_strings' for the new groups
+
+        Returns:
+            DataFrame : ['group_id', 'group'] aligned w/ the names
+        """
+        tic = time.time()
+        codes, uniques = pd.factorize(names)
+        uniques = pd.Series(uniques, dtype=object)
+        is_new = ~uniques.isin(self.members.keys()).to_numpy()
+        new_names = uniques[is_new].reset_index(drop=True)
+        print(f"Registry groups: # {len(self):,}")
+        print(f"Unique names: # {len(uniques):,}, new of them: # {len(new_names):,}")
+
+        if len(new_names) > 0:
+            if self.vectorizer is None:
+                self.vectorizer = TfidfVectorizer(
+                    analyzer="char",
+                    ngram_range=(self.ngram_size, self.ngram_size),
+                    lowercase=False,
+                    dtype=np.float32,
+                ).fit(new_names)
+            X = self.vectorizer.transform(new_names)
+
+            # Match the new names w/ the existing groups
+            new_group_ids = np.full(len(new_names), -1, dtype=np.int64)
+            if len(self) > 0:
+                best_idxs, best_sims = self._match_centroids(X, chunk_size)
+                matched = best_sims >= self.min_similarity
+                new_group_ids[matched] = best_idxs[matched]
+            print(f"\tMatched w/ the existing groups: # {(new_group_ids != -1).sum():,}")
+
+            # Group the rest names among themselves into the new groups
+            rest = np.flatnonzero(new_group_ids == -1)
+            if len(rest) > 0:
+                grouped = group_similar_strings(
+                    strings_to_group=new_names[rest].reset_index(drop=True),
+                    ngram_size=self.ngram_size,
+                    min_similarity=self.min_similarity,
+                    group_rep="centroid",
+                    **kwargs,
+                )
+                rep_idxs, reps = pd.factorize(grouped.iloc[:, 0])
+                new_group_ids[rest] = len(self) + rep_idxs
+                new_groups = pd.DataFrame(
+                    {
+                        "group_id": np.arange(len(self), len(self) + len(reps)),
+                        "group": new_names[rest].to_numpy()[reps],
+                        "count": 0,
+                    }
+                )
+                self.groups = pd.concat([self.groups, new_groups], ignore_index=True)
+                print(f"\tCreated the new groups: # {len(new_groups):,}")
+
+            # Update the centroids & counts
+            assign = sparse.csr_matrix(
+                (
+                    np.ones(len(new_names), dtype=np.float32),
+                    (new_group_ids, np.arange(len(new_names))),
+                ),
+                shape=(len(self), len(new_names)),
+            )
+            sums = assign @ X
+            if self.centroids is not None:
+                old = self.centroids
+                old.resize((len(self), old.shape[1]))
+                sums = sums + old
+            self.centroids = sums.tocsr()
+            self.groups["count"] += np.bincount(new_group_ids, minlength=len(self))
+            self.members.update(zip(new_names, new_group_ids.tolist()))
+
+        group_ids = uniques.map(self.members).to_numpy(dtype=np.int64)[codes]
+        print(f"Resolved names by registry {timing(tic)}")
+
+        return pd.DataFrame(
+            {
+                "group_id": group_ids,
+                "group": self.groups["group"].to_numpy()[group_ids],
+            },
+            index=names.index,
+        )
+
+
+class EntityMappingStore:
+    """Persisted mapping of the raw names (stripped & UPPER) to their entities:
+    group ID, canonical name and the group's address.
+
+    The names are keyed by their 64-bit hashes ('pd.util.hash_array') in
+    the open addressing hash table w/ linear probing, which is kept in
+    the .npy files and memory-mapped on load: lookups read only the probed
+    slots and the batch lookups are vectorized over the whole batch.
+    The hits are verified against the members' names kept as the UTF-8 bytes
+    & offsets (memory-mapped too), so an unknown name colliding w/ the hash
+    of a member is unknown. The groups' table is small and read into memory.
+
+    Args:
+        path (Path or str): folder of the store
+    """
+
+    FILES = {
+        "slot_keys": "slot_keys.npy",
+        "slot_rows": "slot_rows.npy",
+        "member_group_ids": "member_group_ids.npy",
+        "member_offsets": "member_offsets.npy",
+        "member_chars": "member_chars.npy",
+        "members": "members.parquet",
+        "groups": "groups.parquet",
+    }
+
+    def __init__(self, path):
+        path = Path(path)
+        self.slot_keys = np.load(path / self.FILES["slot_keys"], mmap_mode="r")
+        self.slot_rows = np.load(path / self.FILES["slot_rows"], mmap_mode="r")
+        self.member_group_ids = np.load(
+            path / self.FILES["member_group_ids"], mmap_mode="r"
+        )
+        self.member_offsets = np.load(path / self.FILES["member_offsets"], mmap_mode="r")
+        self.member_chars = np.load(path / self.FILES["member_chars"], mmap_mode="r")
+        self.groups = pd.read_parquet(path / self.FILES["groups"]).set_index("group_id")
+        self._mask = np.uint64(len(self.slot_keys) - 1)
+
+    def __len__(self):
+        return len(self.member_group_ids)
+
+    @staticmethod
+    def normalize_names(names):
+        return pd.Series(names, dtype=object).str.strip().str.upper()
+
+    @staticmethod
+    def hash_names(names):
+        return pd.util.hash_array(np.asarray(names, dtype=object), categorize=False)
+
+    @staticmethod
+    def encode_names(names):
+        """Get the UTF-8 bytes of the names w/ their offsets in them"""
+        arr = pa.array(np.asarray(names, dtype=object), type=pa.large_string())
+        if len(arr) == 0:
+            return np.zeros(1, dtype=np.int64), np.empty(0, dtype=np.uint8)
+        offsets = np.frombuffer(arr.buffers()[1], dtype=np.int64)[: len(arr) + 1]
+        chars = np.frombuffer(arr.buffers()[2] or b"", dtype=np.uint8)
+        return offsets, chars[: offsets[-1]]
+
+    @classmethod
+    def build(cls, path, names, groups, addresses=None, group_ids=None):
+        """Build the store from the names & their groups and save it.
+
+        Args:
+            path (Path or str): folder of the store
+            names (array of str): raw names
+            groups (array of str): canonical names of the raw names
+            addresses (array of str, optional): addresses of the raw names,
+                the first one of each group is kept
+            group_ids (array of int, optional): IDs of the groups of the raw names,
+                e.g. the stable IDs of the EntityRegistry. If None the groups
+                are numbered in order of their canonical names.
+
+        Returns:
+            EntityMappingStore : loaded store
+        """
+        tic = time.time()
+        path = Path(path)
+        path.mkdir(parents=True, exist_ok=True)
+
+        df = pd.DataFrame(
+            {
+                "name": cls.normalize_names(names).to_numpy(),
+                "group": np.asarray(groups, dtype=object),
+                "address": None if addresses is None else np.asarray(addresses, dtype=object),
+                "group_id": np.nan if group_ids is None else np.asarray(group_ids),
+            }
+        )
+        cols_required = ["name", "group"] + ([] if group_ids is None else ["group_id"])
+        df = df.dropna(subset=cols_required).drop_duplicates("name")
+
+        if group_ids is None:
+            df_groups = df.groupby("group", sort=True)["address"].first().reset_index()
+            df_groups.insert(0, "group_id", np.arange(len(df_groups), dtype=np.int64))
+            member_group_ids = df_groups.set_index("group")["group_id"][df["group"]].to_numpy()
+        else:
+            member_group_ids = df["group_id"].to_numpy(dtype=np.int64)
+            df_groups = (
+                df.assign(group_id=member_group_ids)
+                .groupby("group_id", sort=True)[["group", "address"]]
+                .first()
+                .reset_index()
+            )
+
+        keys = cls.hash_names(df["name"])
+        if len(np.unique(keys)) != len(keys):
+            raise ValueError("Hash collision of the names, can't build the store")
+        slot_keys, slot_rows = cls._build_hash_table(keys)
+
+        np.save(path / cls.FILES["slot_keys"], slot_keys)
+        np.save(path / cls.FILES["slot_rows"], slot_rows)
+        np.save(path / cls.FILES["member_group_ids"], member_group_ids)
+        member_offsets, member_chars = cls.encode_names(df["name"])
+        np.save(path / cls.FILES["member_offsets"], member_offsets)
+        np.save(path / cls.FILES["member_chars"], member_chars)
+        pd.DataFrame(
+            {"name": df["name"].to_numpy(), "group_id": member_group_ids}
+        ).to_parquet(path / cls.FILES["members"], index=False)
+        df_groups.to_parquet(path / cls.FILES["groups"], index=False)
+        print(
+            f"Saved entity mapping store w/ # {len(df):,} names "
+            f"& # {len(df_groups):,} groups into <{path}> {timing(tic)}"
+        )
+        return cls(path)
+
+    @staticmethod
+    def _build_hash_table(keys):
+        """Insert the keys into the table w/ linear probing, at load factor <= 0.5"""
+        n_slots = 1 << int(np.ceil(np.log2(max(2 * len(keys), 2))))
+        mask = np.uint64(n_slots - 1)
+        slot_keys = np.zeros(n_slots, dtype=np.uint64)
+        slot_rows = np.full(n_slots, -1, dtype=np.int64)
+
+        pos = (keys & mask).astype(np.int64)
+        pending = np.arange(len(keys))
+        while len(pending) > 0:
+            free = slot_rows[pos[pending]] == -1
+            candidates = pending[free]
+            # One key per free slot in a round, the rest probe further
+            _, first = np.unique(pos[candidates], return_index=True)
+            placed = candidates[first]
+            slot_keys[pos[placed]] = keys[placed]
+            slot_rows[pos[placed]] = placed
+            pending = np.setdiff1d(pending, placed, assume_unique=True)
+            pos[pending] = (pos[pending] + 1) & (n_slots - 1)
+        return slot_keys, slot_rows
+
+    def _match_members(self, names, rows):
+        """Check the names are the same as the members' names of the rows"""
+        offsets, chars = self.encode_names(names)
+        lengths = np.diff(offsets)
+        starts = np.asarray(self.member_offsets[rows])
+        matched = lengths == np.asarray(self.member_offsets[rows + 1]) - starts
+        # Compare the bytes of the names of the same not zero lengths at once
+        idxs = np.flatnonzero(matched & (lengths > 0))
+        if len(idxs) > 0:
+            lengths = lengths[idxs]
+            firsts = np.cumsum(lengths) - lengths
+            within = np.arange(lengths.sum()) - np.repeat(firsts, lengths)
+            equal = (
+                chars[np.repeat(offsets[idxs], lengths) + within]
+                == self.member_chars[np.repeat(starts[idxs], lengths) + within]
+            )
+            matched[idxs] = np.logical_and.reduceat(equal, firsts)
+        return matched
+
+    def lookup_rows(self, names):
+        """Get the row of the member for each of the raw names, -1 if unknown"""
+        names = self.normalize_names(names).fillna("").to_numpy()
+        keys = self.hash_names(names)
+        rows = np.full(len(keys), -1, dtype=np.int64)
+        pos = (keys & self._mask).astype(np.int64)
+        pending = np.arange(len(keys))
+        while len(pending) > 0:
+            slot_rows = self.slot_rows[pos[pending]]
+            empty = slot_rows == -1
+            hit = ~empty & (self.slot_keys[pos[pending]] == keys[pending])
+            rows[pending[hit]] = slot_rows[hit]
+            pending = pending[~(empty | hit)]
+            pos[pending] = (pos[pending] + 1) & int(self._mask)
+        # The keys of the members are unique: the hit of other name is unknown
+        found = np.flatnonzero(rows != -1)
+        rows[found[~self._match_members(names[found], rows[found])]] = -1
+        return rows
+
+    def lookup_group_ids(self, names):
+        """Get the group ID for each of the raw names, -1 if unknown"""
+        rows = self.lookup_rows(names)
+        group_ids = np.full(len(rows), -1, dtype=np.int64)
+        found = rows != -1
+        group_ids[found] = self.member_group_ids[rows[found]]
+        return group_ids
+
+    def get(self, name):
+        """Get the entity of the raw name as dict, None if unknown"""
+        group_id = self.lookup_group_ids([name])[0]
+        if group_id == -1:
+            return None
+        return {"group_id": group_id, **self.groups.loc[group_id].to_dict()}
+
+    def resolve(self, sr):
+        """Resolve the raw names of the Series to their entities.
+        The lookups are done on the unique names and broadcast to the rows.
+
+        Args:
+            sr (pd.Series): raw names
+
+        Returns:
+            DataFrame : ['group_id', 'group', 'address'] aligned w/ the Series,
+                'group_id' is -1 and the rest NaN for the unknown names
+        """
+        codes, uniques = pd.factorize(sr)
+        group_ids = np.append(self.lookup_group_ids(uniques), -1)[codes]
+        found = group_ids != -1
+        df = pd.DataFrame(
+            {
+                "group_id": group_ids,
+                "group": np.nan,
+                "address": np.nan,
+            },
+            index=sr.index,
+        ).astype({"group": object, "address": object})
+        group_rows = self.groups.index.get_indexer(group_ids[found])
+        for col in ["group", "address"]:
+            df.loc[found, col] = self.groups[col].to_numpy()[group_rows]
+        return df
+
+
+# ------------------------------------------------------------------------------
+# ------------------------- C O N T A I N E R S --------------------------------
+# ------------------------------------------------------------------------------
+CONTAINER_KEY_NA = -1  # key of the missing container ID
+# ISO 6346 values of the letters A..Z: from 10 skipping the multiples of 11
+ISO6346_LETTER_VALUES = np.array(
+    [x for x in range(10, 39) if x % 11 != 0][:26],
+    dtype=np.int64,
+)
+RE_CONTAINER_ID = r"[A-Z]{4}[0-9]{7}"
+
+
+def get_container_check_digits(letters, digits):
+    """ISO 6346 check digits for the arrays of the owner code & category letters
+    (n, 4) as 0..25 and the serial digits (n, 6)"""
+    values = np.concatenate([ISO6346_LETTER_VALUES[letters], digits], axis=1)
+    return (values << np.arange(10)).sum(axis=1) % 11 % 10
+
+
+def encode_container_ids(ids):
+    """Pack the ISO 6346 container IDs into the int64 keys:
+        owner code & category (4 letters, base 26) << 24 | serial << 4 | check digit
+    The IDs w/o the 'AAAU1234567' format get the negative keys from their hashes,
+    so they are still distinct; NaNs get CONTAINER_KEY_NA. Vectorized over
+    the unique IDs.
+
+    Args:
+        ids (array of str): container IDs
+
+    Returns:
+        tuple of numpy arrays : (int64 keys, whether the check digit is valid)
+    """
+    codes, uniques = pd.factorize(pd.Series(ids, dtype=object).str.strip().str.upper())
+    uniques = pd.Series(uniques, dtype=object)
+    is_iso = uniques.str.fullmatch(RE_CONTAINER_ID).to_numpy(dtype=bool)
+
+    keys = np.empty(len(uniques), dtype=np.int64)
+    valid = np.zeros(len(uniques), dtype=bool)
+
+    chars = np.frombuffer(
+        uniques[is_iso].to_numpy().astype("S11").tobytes(),
+        dtype=np.uint8,
+    ).reshape(-1, 11)
+    letters = (chars[:, :4] - ord("A")).astype(np.int64)
+    digits = (chars[:, 4:] - ord("0")).astype(np.int64)
+    owner = letters @ (26 ** np.arange(3, -1, -1))
+    serial = digits[:, :6] @ (10 ** np.arange(5, -1, -1))
+    keys[is_iso] = (owner << 24) | (serial << 4) | digits[:, 6]
+    valid[is_iso] = get_container_check_digits(letters, digits[:, :6]) == digits[:, 6]
+
+    hashes = pd.util.hash_array(uniques[~is_iso].to_numpy(), categorize=False)
+    keys[~is_iso] = -((hashes >> np.uint64(2)).astype(np.int64)) - 2
+
+    keys = np.append(keys, CONTAINER_KEY_NA)[codes]
+    valid = np.append(valid, False)[codes]
+    return keys, valid
+
+
+def decode_container_keys(keys):
+    """Unpack the int64 keys into the container IDs, None for the negative keys"""
+    keys = np.asarray(keys, dtype=np.int64)
+    is_iso = keys >= 0
+    packed = keys[is_iso]
+    chars = np.empty((len(packed), 11), dtype=np.uint8)
+    owner = packed >> 24
+    for i in range(3, -1, -1):
+        owner, chars[:, i] = np.divmod(owner, 26)
+    chars[:, :4] += ord("A")
+    serial = (packed >> 4) & 0xFFFFF
+    for i in range(9, 3, -1):
+        serial, chars[:, i] = np.divmod(serial, 10)
+    chars[:, 10] = packed & 0xF
+    chars[:, 4:] += ord("0")
+    ids = np.full(len(keys), None, dtype=object)
+    ids[is_iso] = chars.view("S11").ravel().astype(str)
+    return ids
+
+
+def encode_container_id_lists(sr, return_valid=False):
+    """Encode the Series of the lists of container IDs into the lists of keys.
+
+    Returns:
+        pd.Series : numpy arrays of int64 keys, None for the missing lists
+            and if 'return_valid' the flags of valid check digits of all IDs
+    """
+    lists = pa.array(sr, type=pa.list_(pa.string()), from_pandas=True)
+    keys, valid = encode_container_ids(pc.list_flatten(lists).to_numpy(zero_copy_only=False))
+    lengths = pc.list_value_length(lists).fill_null(0).to_numpy()
+    keys = np.split(keys, np.cumsum(lengths)[:-1]) if len(sr) > 0 else []
+    keys = pd.Series(keys, index=sr.index, name=sr.name, dtype=object)
+    keys[sr.isna().to_numpy()] = None
+    return (keys, valid) if return_valid else keys